@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""Benchmark models: Stan code and generated data of a given size."""
+import os
+
+import numpy as np
+
+EIGHT_SCHOOLS_FILE = os.path.join(os.path.dirname(__file__), "..", "tests", "eight_schools_ncp.stan")
+
+REGRESSION = """
+data {
+  int<lower=0> N;
+  int<lower=0> K;
+  matrix[N, K] X;
+  vector[N] y;
+}
+
+parameters {
+  real alpha;
+  vector[K] beta;
+  real<lower=0> sigma;
+}
+
+model {
+  alpha ~ normal(0, 10);
+  beta ~ normal(0, 10);
+  sigma ~ normal(0, 5);
+  y ~ normal(alpha + X * beta, sigma);
+}
+"""
+
+
+def eight_schools(size=None):
+    """The eight schools model, with its data; `size` is ignored."""
+    with open(EIGHT_SCHOOLS_FILE) as f:
+        code = f.read()
+    data = dict(J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18])
+    return code, data
+
+
+def hierarchical(size, seed=0):
+    """The non-centered eight schools model scaled to `size` groups, with data drawn
+    from the model.
+    """
+    rng = np.random.RandomState(seed)
+    code, _ = eight_schools()
+    sigma = rng.uniform(5, 20, size)
+    theta = 5 + 5 * rng.normal(size=size)
+    data = dict(J=size, y=theta + sigma * rng.normal(size=size), sigma=sigma)
+    return code, data
+
+
+def regression(size, seed=0):
+    """Linear regression with `size` predictors and 10 observations per predictor,
+    with correlated predictors to make the posterior poorly conditioned.
+    """
+    rng = np.random.RandomState(seed)
+    n = 10 * size
+    X = rng.normal(size=(n, size)) + rng.normal(size=(n, 1))
+    beta = rng.normal(size=size)
+    data = dict(N=n, K=size, X=X, y=1 + X.dot(beta) + rng.normal(size=n))
+    return REGRESSION, data
+
+
+MODELS = {
+    "eight_schools": eight_schools,
+    "hierarchical": hierarchical,
+    "regression": regression,
+}
+"""Model name to function returning (stan_model_code, data_dict) for a size."""
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Benchmark compiling, tracing and sampling stan2tfp models.
+
+Every configuration (model, size, number of chains) is measured in stages:
+
+- compile_time: the compiler turning Stan code into TFP code, without cache
+- exec_time: executing the TFP code
+- trace_time: tracing the sampler on the first call of `sample`
+- xla_compile_time: XLA-compiling the traced sampler, by a call running no
+  iterations (see `instrumentation.Instrumentation`)
+- sample_time: continuing the chains for the main iterations only, with the
+  compiled sampler
+- leapfrogs_per_second, ess_per_second: leapfrog steps and the smallest bulk ESS
+  of any parameter element per second of sample_time
+
+Results are written as JSON and, with a baseline, compared with it: a time
+longer (or a rate lower) than the baseline by more than the tolerance is a
+regression, and makes the script exit with status 1.
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import types
+
+import numpy as np
+
+from models import MODELS
+from stan2tfp import Stan2tfp, compiler
+from stan2tfp.diagnostics import summary
+from stan2tfp.instrumentation import Instrumentation
+
+# metrics compared with the baseline, and whether higher is better
+METRICS = {
+    "compile_time": False,
+    "exec_time": False,
+    "trace_time": False,
+    "xla_compile_time": False,
+    "sample_time": False,
+    "leapfrogs_per_second": True,
+    "ess_per_second": True,
+}
+
+CONFIGURATIONS = [
+    ("eight_schools", None, [1, 4, 16]),
+    ("hierarchical", 100, [4]),
+    ("hierarchical", 1000, [4]),
+    ("regression", 10, [4]),
+    ("regression", 100, [4]),
+]
+
+QUICK_CONFIGURATIONS = [
+    ("eight_schools", None, [4]),
+    ("hierarchical", 100, [4]),
+    ("regression", 10, [4]),
+]
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(name, size, nchain, num_main_iters, num_warmup_iters, seed=0):
+    """Measure one configuration, see the module documentation.
+
+    Returns
+    -------
+    dict
+        The configuration and its metrics.
+    """
+    stan_model_code, data_dict = MODELS[name](size)
+    tfp_code, compile_time = _timed(compiler.compile_model, stan_model_code)
+    module = types.ModuleType("benchmark_model")
+    _, exec_time = _timed(exec, tfp_code, module.__dict__)
+
+    # the instrumented first call times tracing and XLA compilation on their own,
+    # and draws the same samples as an uninstrumented one
+    instrumentation = Instrumentation()
+    model = Stan2tfp.from_tfp_code(tfp_code, stan_model_code, data_dict, instrumentation=instrumentation)
+    stats = ("leapfrogs",)
+    model.sample(nchain, num_main_iters, num_warmup_iters, stats=stats, seed=seed)
+    trace_time = instrumentation.stats.phases.get("trace", 0.0)
+    xla_compile_time = instrumentation.stats.phases.get("xla_compile", 0.0)
+    # continue the warmed-up chains: the same compiled sampler, without warmup
+    (mcmc_trace, traced), sample_time = _timed(
+        model.sample, nchain, num_main_iters, 0, stats=stats, seed=seed + 1, init=model.sampler_state
+    )
+    leapfrogs = float(np.sum(traced["leapfrogs"]))
+    ess = float(np.min(summary(mcmc_trace)["ess_bulk"]))
+    return dict(
+        model=name,
+        size=size,
+        nchain=nchain,
+        num_main_iters=num_main_iters,
+        num_warmup_iters=num_warmup_iters,
+        compile_time=compile_time,
+        exec_time=exec_time,
+        trace_time=trace_time,
+        xla_compile_time=xla_compile_time,
+        sample_time=sample_time,
+        leapfrogs_per_second=leapfrogs / sample_time,
+        ess_per_second=ess / sample_time,
+    )
+
+
+def _key(result):
+    return "{}/{}/{}".format(result["model"], result["size"], result["nchain"])
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of `results` with respect to `baseline`.
+
+    Returns
+    -------
+    list of string
+        One description per metric worse than its baseline value by more than `tolerance` (a fraction).
+    """
+    baseline = {_key(result): result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        reference = baseline.get(_key(result))
+        if reference is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            new, old = result[metric], reference.get(metric)
+            if not old:
+                continue
+            change = (new - old) / old
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    "{} {}: {:.4g} -> {:.4g} ({:+.0%})".format(_key(result), metric, old, new, change)
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        "--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results.json"),
+        help="file of the results, results.json next to this script by default",
+    )
+    parser.add_argument("--baseline", help="results to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative slowdown, 0.25 by default")
+    parser.add_argument("--quick", action="store_true", help="only run the small configurations")
+    parser.add_argument("--num-main-iters", type=int, default=1000)
+    parser.add_argument("--num-warmup-iters", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    results = []
+    for name, size, nchains in QUICK_CONFIGURATIONS if args.quick else CONFIGURATIONS:
+        for nchain in nchains:
+            result = run_benchmark(name, size, nchain, args.num_main_iters, args.num_warmup_iters)
+            print(
+                "{}: compile {compile_time:.2f}s, exec {exec_time:.2f}s, trace {trace_time:.2f}s, "
+                "XLA compile {xla_compile_time:.2f}s, "
+                "sample {sample_time:.2f}s, {leapfrogs_per_second:.0f} leapfrogs/s, "
+                "{ess_per_second:.1f} ESS/s".format(_key(result), **result)
+            )
+            results.append(result)
+
+    with open(args.output, "w") as f:
+        json.dump(dict(platform=platform.platform(), python=platform.python_version(), results=results), f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
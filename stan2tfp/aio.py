@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""Compiling and sampling from an asyncio event loop.
+
+Compilation runs in asyncio subprocesses, and work that blocks in TensorFlow
+(executing a model's TFP code, sampling) runs in a `SamplingExecutor`, so a single
+event loop can serve many fits at once.
+"""
+from asyncio.subprocess import PIPE
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import threading
+
+from stan2tfp import compiler
+from stan2tfp.cache import CompilerCache
+from stan2tfp.instrumentation import phase
+from stan2tfp.stan2tfp import Stan2tfp
+
+DEFAULT_MAX_CONCURRENCY = 4
+
+_default_executor_lock = threading.Lock()
+_default_executor = None
+
+
+class SamplingExecutor():
+    """Runs blocking calls in a pool of threads, at most `max_concurrency` at a time.
+
+    TensorFlow releases the GIL while it computes, so fits in different threads run
+    in parallel; bounding their number keeps them from competing for cores and
+    memory. Calls beyond the bound wait in line without blocking the event loop.
+
+    Parameters
+    ----------
+    max_concurrency : int, optional
+        Largest number of calls running at once, 4 by default.
+    """
+
+    def __init__(self, max_concurrency=DEFAULT_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self._executor = ThreadPoolExecutor(max_concurrency)
+
+    async def run(self, fn, *args, **kwargs):
+        """Await `fn(*args, **kwargs)`, called in one of the threads."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def shutdown(self, wait=True):
+        """Stop the threads once the running calls are done."""
+        self._executor.shutdown(wait)
+
+
+def default_executor():
+    """The `SamplingExecutor` used when none is given, created on first use."""
+    global _default_executor
+    with _default_executor_lock:
+        if _default_executor is None:
+            _default_executor = SamplingExecutor()
+        return _default_executor
+
+
+async def compile_stan_file(stan_file_path, compiler_path=None):
+    """Compile a Stan file in an asyncio subprocess, see `compiler.compile_stan_file`."""
+    if compiler_path is None:
+        compiler_path = compiler.default_compiler_path()
+    proc = await asyncio.create_subprocess_exec(compiler_path, stan_file_path, stdout=PIPE, stderr=PIPE)
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0 or not stdout:
+        raise compiler.StanCompilerError(stan_file_path, proc.returncode, stderr.decode("UTF-8", "replace"))
+    return stdout
+
+
+async def compile_model(stan_model_code, stan_file_path=None, compiler_path=None, compiler_cache=None):
+    """TFP code of a Stan model, compiled in an asyncio subprocess unless
+    `compiler_cache` holds it; see `compiler.compile_model`.
+    """
+    if compiler_path is None:
+        compiler_path = compiler.default_compiler_path()
+    # small local file operations; the compiler binary is only hashed once per process
+    key, tfp_code = compiler.cache_lookup(compiler_cache, stan_model_code, compiler_path)
+    if tfp_code is not None:
+        return tfp_code
+    with compiler.model_file(stan_model_code, stan_file_path) as path:
+        tfp_code = await compile_stan_file(path, compiler_path)
+    if key is not None:
+        compiler_cache.put(key, tfp_code)
+    return tfp_code
+
+
+async def create_model(
+    stan_file_path=None, stan_model_code=None, data_dict=None, compiler_cache=True, executor=None,
+    precision="float64", instrumentation=None,
+):
+    """Awaitable `Stan2tfp` constructor.
+
+    The model is compiled in an asyncio subprocess, and its TFP code executed in
+    `executor`. Parameters are those of `Stan2tfp`.
+
+    Parameters
+    ----------
+    executor : SamplingExecutor, optional
+        Where to execute the TFP code, `default_executor()` by default.
+
+    Returns
+    -------
+    Stan2tfp
+        The model.
+    """
+    if stan_file_path is not None:
+        with open(stan_file_path) as f:
+            stan_model_code = f.read()
+    elif stan_model_code is None:
+        raise ValueError("Either stan_model_code or stan_file_path must be provided to create a Model object")
+    if compiler_cache is True:
+        compiler_cache = CompilerCache()
+    with phase(instrumentation, "compile"):
+        tfp_code = await compile_model(stan_model_code, stan_file_path, compiler_cache=compiler_cache or None)
+    executor = executor or default_executor()
+    return await executor.run(
+        Stan2tfp.from_tfp_code, tfp_code, stan_model_code, data_dict, precision, instrumentation
+    )
+
+
+async def sample_async(model, executor=None, **kwargs):
+    """Await `model.sample(**kwargs)`, run in `executor` (`default_executor()` by default).
+
+    Concurrent fits of the same `Stan2tfp` instance each set its `sampler_state`;
+    use one instance per fit to keep them.
+    """
+    return await (executor or default_executor()).run(model.sample, **kwargs)
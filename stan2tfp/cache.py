@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""Persistent, content-addressed caches shared between processes."""
+import hashlib
+import io
+import json
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "stan2tfp")
+"""Cache directory unless the `STAN2TFP_CACHE_DIR` environment variable names another one."""
+DEFAULT_MAX_SIZE = 256 * 1024 * 1024
+DEFAULT_FIT_CACHE_SIZE = 4 * 1024 * 1024 * 1024
+
+_fingerprint_lock = threading.Lock()
+_fingerprints = {}
+
+
+def compiler_fingerprint(compiler_path):
+    """Hash identifying a compiler binary.
+
+    The hash of the binary's content is memoized for as long as its path, size and
+    modification time stay the same, so the binary is read at most once per process.
+
+    Parameters
+    ----------
+    compiler_path : string
+        Path of the compiler binary.
+
+    Returns
+    -------
+    string
+        Hex digest of the binary's content.
+    """
+    st = os.stat(compiler_path)
+    stamp = (os.path.abspath(compiler_path), st.st_size, st.st_mtime_ns)
+    with _fingerprint_lock:
+        if stamp in _fingerprints:
+            return _fingerprints[stamp]
+    h = hashlib.sha256()
+    with open(compiler_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    with _fingerprint_lock:
+        _fingerprints[stamp] = h.hexdigest()
+    return _fingerprints[stamp]
+
+
+def source_key(stan_model_code, compiler_path):
+    """Hash identifying the TFP code compiled from a Stan model by a compiler binary."""
+    h = hashlib.sha256()
+    h.update(compiler_fingerprint(compiler_path).encode("ascii"))
+    h.update(b"\0")
+    h.update(stan_model_code.encode("UTF-8"))
+    return h.hexdigest()
+
+
+class DiskCache():
+    """A directory of files keyed by content hashes, bounded in size.
+
+    Entries are written to a temporary file and atomically renamed into place, so
+    several processes may read and write the same directory concurrently: a reader
+    either sees a complete entry or none at all. Reading an entry refreshes its
+    modification time, and once the directory grows beyond `max_size` bytes the
+    least recently used entries are removed.
+
+    Parameters
+    ----------
+    cache_dir : string, optional
+        Directory holding the entries, `<cache directory>/<namespace>` by default, where the cache
+        directory is `STAN2TFP_CACHE_DIR` when set, read at construction, or else `DEFAULT_CACHE_DIR`.
+    max_size : int, optional
+        Maximal total size of the entries in bytes, 256MB by default.
+    """
+
+    namespace = "entries"
+    suffix = ""
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_MAX_SIZE):
+        if cache_dir is None:
+            cache_dir = os.path.join(os.environ.get("STAN2TFP_CACHE_DIR", DEFAULT_CACHE_DIR), self.namespace)
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def get(self, key):
+        """Return the bytes stored under `key`, or None on a cache miss."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = f.read()
+            os.utime(path)
+        except (FileNotFoundError, PermissionError):
+            return None
+        return value
+
+    def put(self, key, value):
+        """Store `value` (bytes) under `key` and evict old entries if needed."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        try:
+            with open(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def entries(self):
+        """List (mtime, size, path) of every entry, oldest first."""
+        entries = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if name.startswith(".tmp-") or not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in `max_size`."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                # another process evicted it first
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry."""
+        for _, _, path in self.entries():
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class CompilerCache(DiskCache):
+    """Cache of TFP code emitted by the compiler, keyed by the Stan source and the
+    identity of the compiler binary.
+    """
+
+    namespace = "tfp_code"
+    suffix = ".py"
+
+    def key(self, stan_model_code, compiler_path):
+        return source_key(stan_model_code, compiler_path)
+
+
+class FitCache(DiskCache):
+    """Cache of completed fits, keyed by the model, its data, the sampler settings
+    and the seed.
+
+    A fit is stored as a `.npz` file holding the trace, the traced sampler
+    statistics and the mean and standard deviation of every parameter. The cache is
+    bounded to 4GB by default.
+    """
+
+    namespace = "fits"
+    suffix = ".npz"
+
+    def __init__(self, cache_dir=None, max_size=DEFAULT_FIT_CACHE_SIZE):
+        super().__init__(cache_dir, max_size)
+
+    def key(self, stan_model_code, tfp_code, data_dict, settings):
+        """Hash identifying a fit.
+
+        Parameters
+        ----------
+        stan_model_code : string
+            The Stan model.
+        tfp_code : bytes
+            The TFP code it compiles to.
+        data_dict : dict
+            Data for the model; arrays are hashed by dtype, shape and raw bytes.
+        settings : dict
+            Sampler settings, including the seed; must be JSON serializable.
+
+        Returns
+        -------
+        string
+            Hex digest of the fit's inputs.
+        """
+        h = hashlib.sha256()
+        h.update(stan_model_code.encode("UTF-8"))
+        h.update(b"\0")
+        h.update(tfp_code)
+        for name in sorted(data_dict):
+            value = np.ascontiguousarray(data_dict[name])
+            h.update("\0{}\0{}\0{}\0".format(name, value.dtype.str, value.shape).encode("UTF-8"))
+            h.update(value.tobytes())
+        h.update(json.dumps(settings, sort_keys=True).encode("UTF-8"))
+        return h.hexdigest()
+
+    def load_fit(self, key):
+        """Return the (mcmc_trace, stats) stored under `key`, or None on a cache miss."""
+        value = self.get(key)
+        if value is None:
+            return None
+        with np.load(io.BytesIO(value)) as arrays:
+            mcmc_trace = [arrays["trace/{}".format(i)] for i in range(int(arrays["num_params"]))]
+            stats = {
+                name[len("stats/"):]: arrays[name] for name in arrays.files if name.startswith("stats/")
+            }
+        return mcmc_trace, stats
+
+    def load_summary(self, key):
+        """Return the per-parameter (means, sds) stored under `key`, or None on a cache miss."""
+        value = self.get(key)
+        if value is None:
+            return None
+        with np.load(io.BytesIO(value)) as arrays:
+            n = int(arrays["num_params"])
+            return (
+                [arrays["mean/{}".format(i)] for i in range(n)],
+                [arrays["sd/{}".format(i)] for i in range(n)],
+            )
+
+    def store_fit(self, key, mcmc_trace, stats):
+        """Store a fit under `key`.
+
+        Parameters
+        ----------
+        key : string
+            Hash of the fit's inputs, see `key`.
+        mcmc_trace : list
+            Draws of every parameter, shape (num_draws, nchain, ...).
+        stats : dict
+            Traced sampler statistics.
+        """
+        arrays = {"num_params": np.array(len(mcmc_trace))}
+        for i, draws in enumerate(mcmc_trace):
+            draws = np.asarray(draws)
+            arrays["trace/{}".format(i)] = draws
+            arrays["mean/{}".format(i)] = draws.mean(axis=(0, 1))
+            arrays["sd/{}".format(i)] = draws.std(axis=(0, 1), ddof=1)
+        for name, value in stats.items():
+            arrays["stats/{}".format(name)] = np.asarray(value)
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        self.put(key, buffer.getvalue())
@@ -1,15 +1,106 @@
 # -*- coding: utf-8 -*-
 
 """Console script for stan2tfp."""
+import os
 import sys
+import tempfile
+
 import click
 
+from stan2tfp import compiler
+from stan2tfp.cache import CompilerCache, source_key
+
+# first line of every generated module, identifying the source it was compiled from
+HEADER = "# stan2tfp source hash: {}\n"
+
+
+def output_path(stan_file, output_dir=None):
+    """Path of the module generated from `stan_file`: `<name>.py`, in `output_dir`
+    or next to the Stan file.
+    """
+    name = os.path.splitext(os.path.basename(stan_file))[0] + ".py"
+    return os.path.join(output_dir or os.path.dirname(stan_file), name)
+
+
+def is_up_to_date(path, key):
+    """Whether the module at `path` was generated from the source hashed as `key`."""
+    try:
+        with open(path) as f:
+            return f.readline() == HEADER.format(key)
+    except FileNotFoundError:
+        return False
+
+
+def write_module(output, key, tfp_code):
+    """Atomically write the module `output`, headed by the source hash `key`."""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), prefix=".tmp-")
+    try:
+        with open(fd, "wb") as f:
+            f.write(HEADER.format(key).encode("UTF-8"))
+            f.write(tfp_code)
+        os.replace(tmp_path, output)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
 
 @click.command()
-def main(args=None):
-    """Console script for stan2tfp."""
-    click.echo("Replace this message by putting your code into " "stan2tfp.cli.main")
-    click.echo("See click documentation at https://click.palletsprojects.com/")
+@click.argument("stan_files", nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "-o", "--output-dir", type=click.Path(file_okay=False),
+    help="Directory of the generated modules, next to each Stan file by default.",
+)
+@click.option(
+    "-j", "--jobs", type=click.IntRange(min=1), default=None,
+    help="Number of files compiled in parallel, the number of CPUs by default.",
+)
+@click.option("-f", "--force", is_flag=True, help="Recompile modules that are up to date.")
+@click.option("--no-cache", is_flag=True, help="Bypass the compiled model cache.")
+@click.option(
+    "--compiler", "compiler_path", type=click.Path(exists=True, dir_okay=False),
+    help="Compiler binary, the one bundled with stan2tfp by default.",
+)
+def main(stan_files, output_dir, jobs, force, no_cache, compiler_path):
+    """Compile Stan files to TFP Python modules.
+
+    Every STAN_FILES `<name>.stan` becomes a module `<name>.py`, whose `model` class
+    is the model. Modules generated from the same source by the same compiler are
+    skipped.
+    """
+    outputs = [output_path(stan_file, output_dir) for stan_file in stan_files]
+    if len(set(outputs)) < len(outputs):
+        raise click.UsageError("Several Stan files would be compiled to the same module")
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+
+    failed = 0
+    compiler_cache = None if no_cache else CompilerCache()
+    with compiler.CompilerPool(compiler_path, jobs, compiler_cache) as pool:
+        pending = []
+        for stan_file, output in zip(stan_files, outputs):
+            with open(stan_file) as f:
+                stan_model_code = f.read()
+            key = source_key(stan_model_code, pool.compiler_path)
+            future = None
+            if force or not is_up_to_date(output, key):
+                future = pool.submit(stan_model_code, stan_file)
+            pending.append((stan_file, output, key, future))
+        for stan_file, output, key, future in pending:
+            if future is None:
+                status = "up to date"
+            else:
+                try:
+                    write_module(output, key, future.result())
+                    status = "compiled"
+                except compiler.StanCompilerError as e:
+                    click.echo(str(e), err=True)
+                    status = "failed"
+                    failed += 1
+            click.echo("{} -> {}: {}".format(stan_file, output, status))
+    if failed:
+        click.echo("{} of {} files failed to compile".format(failed, len(stan_files)), err=True)
+        sys.exit(1)
     return 0
 
 
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+"""Compiling Stan models to TFP code.
+
+This module does not import TensorFlow, so tools that only compile models start
+quickly.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from subprocess import run, PIPE
+import os
+import re
+import sys
+import tempfile
+import threading
+
+from stan2tfp.cache import source_key
+
+PLATFORMS = ("darwin", "linux", "win32")
+
+PRECISIONS = ("float64", "float32")
+"""Floating point precisions a model can compute in; the compiler emits float64 code."""
+
+_FLOAT64 = re.compile(rb"\bfloat64\b")
+
+# stanc reports the location of an error as "..., line 3, column 4 ..."
+_LOCATION = re.compile(r"line (\d+), column (\d+)")
+
+
+class StanCompilerError(Exception):
+    """The compiler rejected a Stan model.
+
+    Attributes
+    ----------
+    stan_file_path : string
+        The compiled file.
+    returncode : int
+        Exit status of the compiler.
+    stderr : string
+        Error output of the compiler.
+    line, column : int
+        Location of the first error in the Stan file, None if the compiler did not report one.
+    """
+
+    def __init__(self, stan_file_path, returncode, stderr):
+        self.stan_file_path = stan_file_path
+        self.returncode = returncode
+        self.stderr = stderr
+        match = _LOCATION.search(stderr)
+        self.line, self.column = (int(match.group(1)), int(match.group(2))) if match else (None, None)
+        super().__init__(
+            "Compiling {} failed with exit status {}:\n{}".format(stan_file_path, returncode, stderr.strip())
+        )
+
+
+def default_compiler_path():
+    """Path of the compiler binary bundled with the package for this platform.
+
+    Raises
+    ------
+    OSError
+        If the platform is not supported.
+    """
+    plat = sys.platform
+    if plat not in PLATFORMS:
+        raise OSError("OS {} is not supported".format(plat))
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin", "{}-stan2tfp.exe".format(plat))
+
+
+def compile_stan_file(stan_file_path, compiler_path=None):
+    """Compile a Stan file.
+
+    Parameters
+    ----------
+    stan_file_path : string
+        Path of the Stan file.
+    compiler_path : string, optional
+        Path of the compiler binary, `default_compiler_path()` by default.
+
+    Returns
+    -------
+    bytes
+        The TFP code.
+
+    Raises
+    ------
+    StanCompilerError
+        If the compiler fails or emits no code.
+    """
+    if compiler_path is None:
+        compiler_path = default_compiler_path()
+    print("Compiling stan file to tfp file...")
+    proc = run([compiler_path, stan_file_path], stdout=PIPE, stderr=PIPE)
+    if proc.returncode != 0 or not proc.stdout:
+        raise StanCompilerError(stan_file_path, proc.returncode, proc.stderr.decode("UTF-8", "replace"))
+    return proc.stdout
+
+
+@contextmanager
+def model_file(stan_model_code, stan_file_path=None):
+    """Context manager giving the path of a file holding `stan_model_code`:
+    `stan_file_path` if given, or else a temporary file, removed on exit.
+    """
+    if stan_file_path is not None:
+        yield stan_file_path
+        return
+    fd, path = tempfile.mkstemp(suffix=".stan")
+    try:
+        with open(fd, "w") as f:
+            f.write(stan_model_code)
+        yield path
+    finally:
+        os.unlink(path)
+
+
+def cache_lookup(compiler_cache, stan_model_code, compiler_path):
+    """Look up the TFP code of a model in `compiler_cache`, which may be None.
+
+    Returns
+    -------
+    (key, tfp_code) : tuple
+        The cache key to store the code under once compiled (None without cache), and the cached code (None
+        on a miss).
+    """
+    if compiler_cache is None:
+        return None, None
+    key = compiler_cache.key(stan_model_code, compiler_path)
+    return key, compiler_cache.get(key)
+
+
+def compile_stan_model_code(stan_model_code, compiler_path=None):
+    """Compile a Stan model given as a string, see `compile_stan_file`."""
+    with model_file(stan_model_code) as path:
+        return compile_stan_file(path, compiler_path)
+
+
+def compile_model(stan_model_code, stan_file_path=None, compiler_path=None, compiler_cache=None):
+    """TFP code of a Stan model, calling the compiler only if `compiler_cache` does
+    not hold it yet.
+
+    Parameters
+    ----------
+    stan_model_code : string
+        The Stan model.
+    stan_file_path : string, optional
+        The file holding `stan_model_code`, compiled in place of a temporary copy.
+    compiler_path : string, optional
+        Path of the compiler binary, `default_compiler_path()` by default.
+    compiler_cache : CompilerCache, optional
+        Where to look up and store the TFP code; not cached by default.
+
+    Returns
+    -------
+    bytes
+        The TFP code.
+
+    Raises
+    ------
+    StanCompilerError
+        If the compiler fails.
+    """
+    if compiler_path is None:
+        compiler_path = default_compiler_path()
+    key, tfp_code = cache_lookup(compiler_cache, stan_model_code, compiler_path)
+    if tfp_code is not None:
+        return tfp_code
+    with model_file(stan_model_code, stan_file_path) as path:
+        tfp_code = compile_stan_file(path, compiler_path)
+    if key is not None:
+        compiler_cache.put(key, tfp_code)
+    return tfp_code
+
+
+def convert_precision(tfp_code, precision):
+    """TFP code computing in another floating point precision.
+
+    Every float64 dtype in the code emitted by the compiler (data conversions,
+    constants, distribution parameters) is replaced by `precision`.
+
+    Parameters
+    ----------
+    tfp_code : bytes
+        TFP code emitted by the compiler.
+    precision : string
+        One of `PRECISIONS`.
+
+    Returns
+    -------
+    bytes
+        The converted code; `tfp_code` itself for float64.
+
+    Raises
+    ------
+    ValueError
+        If `precision` is not one of `PRECISIONS`.
+    """
+    if precision not in PRECISIONS:
+        raise ValueError("Unknown precision {}, expected one of {}".format(precision, list(PRECISIONS)))
+    if precision == "float64":
+        return tfp_code
+    return _FLOAT64.sub(precision.encode("ascii"), tfp_code)
+
+
+class CompilerPool():
+    """Compiles many Stan models concurrently.
+
+    The compiler has no persistent or streaming mode, so each model is still compiled
+    by its own compiler process, but up to `max_workers` of them run at once from a
+    pool of threads kept for the life of the pool. Requests for a model that is
+    already being compiled share the pending compilation, and with a
+    `compiler_cache` previously compiled models are not compiled again.
+
+    Parameters
+    ----------
+    compiler_path : string, optional
+        Path of the compiler binary, `default_compiler_path()` by default.
+    max_workers : int, optional
+        Largest number of concurrent compilations, the number of CPUs by default.
+    compiler_cache : CompilerCache, optional
+        Where to look up and store the TFP code; not cached by default.
+    """
+
+    def __init__(self, compiler_path=None, max_workers=None, compiler_cache=None):
+        self.compiler_path = compiler_path or default_compiler_path()
+        self.compiler_cache = compiler_cache
+        self._executor = ThreadPoolExecutor(max_workers or os.cpu_count())
+        self._pending_lock = threading.Lock()
+        self._pending = {}
+
+    def submit(self, stan_model_code, stan_file_path=None):
+        """Start compiling a model, see `compile_model`.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Future of the TFP code; its exception is a `StanCompilerError` if the compiler fails.
+        """
+        key = source_key(stan_model_code, self.compiler_path)
+        with self._pending_lock:
+            future = self._pending.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(
+                compile_model, stan_model_code, stan_file_path, self.compiler_path, self.compiler_cache
+            )
+            self._pending[key] = future
+        # outside the lock, as the callback runs right away if the future is done
+        future.add_done_callback(lambda _: self._done(key))
+        return future
+
+    def _done(self, key):
+        with self._pending_lock:
+            self._pending.pop(key, None)
+
+    def submit_file(self, stan_file_path):
+        """Start compiling a Stan file, see `submit`."""
+        with open(stan_file_path) as f:
+            return self.submit(f.read(), stan_file_path)
+
+    def compile(self, stan_model_code):
+        """Compile a model and wait for its TFP code."""
+        return self.submit(stan_model_code).result()
+
+    def compile_files(self, stan_file_paths):
+        """Compile Stan files concurrently.
+
+        Returns
+        -------
+        list
+            The TFP code of every file, in order, or the exception (such as a `StanCompilerError`) raised
+            for it.
+        """
+        futures = [self.submit_file(path) for path in stan_file_paths]
+        return [future.exception() or future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        """Stop the worker threads once pending compilations are done."""
+        self._executor.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
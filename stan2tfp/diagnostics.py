@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""Posterior summaries and convergence diagnostics of sampled traces."""
+from collections import OrderedDict
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+dtype = tf.float64
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+def _split_chains(draws):
+    # halves of every chain, dropping the middle draw of odd-length chains
+    n = tf.shape(draws)[0]
+    half = n // 2
+    return tf.concat([draws[:half], draws[n - half:]], axis=1)
+
+
+def _rank_normalize(draws):
+    # normal scores of the ranks of all draws of each element, pooled over chains
+    shape = tf.shape(draws)
+    flat = tf.reshape(draws, [-1, shape[-1]])
+    ranks = tf.cast(tf.argsort(tf.argsort(flat, axis=0), axis=0), draws.dtype) + 1
+    size = tf.cast(tf.shape(flat)[0], draws.dtype)
+    return tf.reshape(tf.math.ndtri((ranks - 0.375) / (size + 0.25)), shape)
+
+
+def _ess(draws):
+    return tfp.mcmc.effective_sample_size(draws, filter_beyond_positive_pairs=True, cross_chain_dims=1)
+
+
+def _r_hat(draws):
+    return tfp.mcmc.potential_scale_reduction(draws, independent_chain_ndims=1)
+
+
+def _quantiles(draws, quantiles):
+    # quantiles between 0 and 1 of every element, pooled over chains, interpolated linearly
+    return tfp.stats.percentile(draws, 100 * quantiles, axis=[0, 1], interpolation="linear")
+
+
+@tf.function
+def _summarize(draws, quantiles):
+    """Summaries of draws of shape (num_draws, nchain, num_elements), one per element.
+
+    R-hat and ESS follow Vehtari et al. (2021): R-hat is the largest of the split
+    R-hats of the rank-normalized draws and of their rank-normalized distance to the
+    median, bulk ESS is the ESS of the rank-normalized split chains and tail ESS the
+    smallest ESS of the indicators of the 5% and 95% quantiles.
+    """
+    split = _split_chains(draws)
+    q05, median, q95 = tf.unstack(_quantiles(draws, tf.constant([0.05, 0.5, 0.95], draws.dtype)))
+    bulk = _rank_normalize(split)
+    folded = _rank_normalize(tf.abs(split - median))
+    size = tf.cast(tf.shape(draws)[0] * tf.shape(draws)[1], draws.dtype)
+    return OrderedDict([
+        ("mean", tf.reduce_mean(draws, axis=[0, 1])),
+        ("sd", tf.sqrt(tf.math.reduce_variance(draws, axis=[0, 1]) * size / (size - 1))),
+        ("quantiles", _quantiles(draws, quantiles)),
+        ("r_hat", tf.maximum(_r_hat(bulk), _r_hat(folded))),
+        ("ess_bulk", _ess(bulk)),
+        ("ess_tail", tf.minimum(
+            _ess(tf.cast(split <= q05, draws.dtype)), _ess(tf.cast(split <= q95, draws.dtype))
+        )),
+    ])
+
+
+def element_names(name, shape):
+    """Names of the elements of a parameter, such as `theta[0,1]`; the name itself for a scalar."""
+    if len(shape) == 0:
+        return [name]
+    return ["{}[{}]".format(name, ",".join(str(i) for i in index)) for index in np.ndindex(*shape)]
+
+
+class Summary():
+    """A table of posterior summaries, one row per parameter element.
+
+    Columns are numpy arrays with one value per row, accessed by name:
+    `summary["r_hat"]`. Printing the summary gives a fixed width table.
+
+    Parameters
+    ----------
+    names : list of string
+        Row names, see `element_names`.
+    columns : OrderedDict
+        Column name to array of values.
+    """
+
+    def __init__(self, names, columns):
+        self.names = list(names)
+        self.columns = OrderedDict(columns)
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def __len__(self):
+        return len(self.names)
+
+    def row(self, name):
+        """Summaries of element `name`, as a dictionary."""
+        i = self.names.index(name)
+        return OrderedDict((column, values[i]) for column, values in self.columns.items())
+
+    def __str__(self):
+        width = max([len("name")] + [len(name) for name in self.names])
+        lines = [" ".join(["{:<{}}".format("name", width)] + ["{:>9}".format(c) for c in self.columns])]
+        for i, name in enumerate(self.names):
+            cells = []
+            for column, values in self.columns.items():
+                fmt = "{:>9.0f}" if column.startswith("ess") else "{:>9.3g}"
+                cells.append(fmt.format(values[i]))
+            lines.append(" ".join(["{:<{}}".format(name, width)] + cells))
+        return "\n".join(lines)
+
+    def __repr__(self):
+        return str(self)
+
+
+def summary(mcmc_trace, names=None, quantiles=DEFAULT_QUANTILES):
+    """Summarize a trace: mean, sd, quantiles, split R-hat and bulk and tail ESS of
+    every parameter element.
+
+    All elements of all parameters are summarized at once, in a single TensorFlow
+    graph.
+
+    Parameters
+    ----------
+    mcmc_trace : list
+        Draws of every parameter, shape (num_draws, nchain, ...), as returned by
+        `Stan2tfp.sample`. At least two draws per chain are required.
+    names : list of string, optional
+        Parameter names, `param_0`, `param_1`, ... by default.
+    quantiles : tuple of float, optional
+        Quantiles to report, between 0 and 1; (0.05, 0.5, 0.95) by default.
+
+    Returns
+    -------
+    Summary
+        One row per parameter element, with columns `mean`, `sd`, one per quantile
+        (such as `5%`), `r_hat`, `ess_bulk` and `ess_tail`.
+    """
+    if names is None:
+        names = ["param_{}".format(i) for i in range(len(mcmc_trace))]
+    draws, rows = [], []
+    for name, x in zip(names, mcmc_trace):
+        # float32 traces are summarized in float64 as well
+        x = tf.cast(x, dtype)
+        draws.append(tf.reshape(x, tf.concat([tf.shape(x)[:2], [-1]], 0)))
+        rows.extend(element_names(name, x.shape[2:]))
+    result = _summarize(tf.concat(draws, axis=2), tf.constant(quantiles, dtype))
+    columns = OrderedDict([("mean", result["mean"]), ("sd", result["sd"])])
+    for q, values in zip(quantiles, tf.unstack(result["quantiles"])):
+        columns["{:g}%".format(100 * q)] = values
+    for column in ("r_hat", "ess_bulk", "ess_tail"):
+        columns[column] = result[column]
+    return Summary(rows, OrderedDict((c, np.asarray(v)) for c, v in columns.items()))
+
+
+class RunningMoments():
+    """Running mean and sum of squared deviations along the first axis, updated in
+    batches with Welford's (Chan's) algorithm.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        """Add the rows of `x`."""
+        x = np.asarray(x, np.float64)
+        n = x.shape[0]
+        if n == 0:
+            return
+        mean = x.mean(axis=0)
+        m2 = ((x - mean) ** 2).sum(axis=0)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = n, mean, m2
+            return
+        total = self.count + n
+        delta = mean - self.mean
+        self.mean = self.mean + delta * n / total
+        self.m2 = self.m2 + m2 + delta ** 2 * self.count * n / total
+        self.count = total
+
+    def variance(self):
+        """Unbiased variance of the rows added so far."""
+        return self.m2 / max(self.count - 1, 1)
+
+
+class OnlineDiagnostics():
+    """R-hat and ESS of a trace that arrives in chunks, without keeping the draws.
+
+    Running moments of every chain give the (non-split) R-hat. The ESS is a batch
+    means estimate, using the mean of every chain over each full chunk as a batch
+    and pooling the batches of all chains, so it also reflects disagreement between
+    chains. Both are computed for every parameter element.
+    """
+
+    def __init__(self):
+        self.draws = RunningMoments()
+        self.batch_means = RunningMoments()
+        self.batch_size = None
+
+    def update(self, mcmc_trace):
+        """Add a chunk of a trace, shaped as the output of `Stan2tfp.sample_chunks`."""
+        x = np.concatenate(
+            [np.reshape(np.asarray(p, np.float64), np.shape(p)[:2] + (-1,)) for p in mcmc_trace], axis=2
+        )
+        # moments per chain and element: draws along the first axis
+        self.draws.update(x)
+        if self.batch_size is None:
+            self.batch_size = x.shape[0]
+        if x.shape[0] == self.batch_size:
+            self.batch_means.update(x.mean(axis=0))
+
+    @property
+    def num_draws(self):
+        """Number of draws per chain added so far."""
+        return self.draws.count
+
+    def r_hat(self):
+        """Potential scale reduction of every element."""
+        n = self.draws.count
+        within = self.draws.variance().mean(axis=0)
+        between = self.draws.mean.var(axis=0, ddof=1)
+        return np.sqrt(((n - 1) / n * within + between) / within)
+
+    def ess(self):
+        """Batch means effective sample size of every element, 0 until there are two
+        batches per chain.
+        """
+        nchain = self.draws.mean.shape[0]
+        if self.batch_means.count < 2 * nchain:
+            return np.zeros(self.draws.mean.shape[1:])
+        n = self.draws.count
+        size = n * nchain
+        grand_mean = self.draws.mean.mean(axis=0)
+        m2 = self.draws.m2.sum(axis=0) + n * ((self.draws.mean - grand_mean) ** 2).sum(axis=0)
+        ess = size * (m2 / (size - 1)) / (self.batch_size * self.batch_means.variance())
+        return np.minimum(ess, size * np.log10(size))
+
+    def converged(self, max_r_hat=1.01, min_ess=400):
+        """Whether every element has an R-hat of at most `max_r_hat` and an ESS of at least `min_ess`."""
+        if self.draws.count < 2:
+            return False
+        return bool(np.all(self.r_hat() <= max_r_hat) and np.all(self.ess() >= min_ess))
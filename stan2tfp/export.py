@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""Exporting compiled samplers as SavedModels, to deploy models without the
+compiler, the TFP code or retracing.
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from stan2tfp import sampling
+
+FORMAT_VERSION = 2
+META_FILE = "stan2tfp.json"
+TFP_CODE_FILE = "model_tfp.py"
+STAN_CODE_FILE = "model.stan"
+
+
+def export(model, path, nchain=4, num_main_iters=1000, keep=None, stats=None, thin=1, metric=None):
+    """Save the compiled sampler and log density of a model as a SavedModel.
+
+    The sampler is traced for the data shapes of the model's current data and the
+    given settings, as in `Stan2tfp.sample`. Next to the SavedModel, `path` holds
+    the TFP and Stan code and a JSON file of metadata (parameter names and shapes,
+    integer data, input signature, settings and precision).
+
+    Parameters
+    ----------
+    model : Stan2tfp
+        A model instantiated with data.
+    path : string
+        Directory of the export.
+    nchain, num_main_iters, keep, stats, thin, metric
+        Settings of the sampler, see `Stan2tfp.sample`. All of `sampling.STATISTICS` are traced by default.
+
+    Returns
+    -------
+    string
+        `path`.
+    """
+    if model.model is None:
+        raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+    if stats is None:
+        stats = list(sampling.STATISTICS)
+    sampler = model.compiled_sampler(nchain, num_main_iters, keep, stats, thin, metric)
+    model_constructor = model.model_constructor
+    static = sampler.static
+
+    def log_prob(arrays, params):
+        return model_constructor(**static, **arrays).log_prob(params)
+
+    module = tf.Module()
+    module.sample = sampler._function
+    module.log_prob = tf.function(
+        log_prob,
+        input_signature=[
+            sampler.input_signature,
+            [tf.TensorSpec(shape, model.precision) for shape in sampler.state_shapes],
+        ],
+    )
+    tf.saved_model.save(module, path)
+
+    meta = dict(
+        format_version=FORMAT_VERSION,
+        names=model.parameter_names(),
+        state_shapes=[list(shape) for shape in sampler.state_shapes],
+        metric_shapes=[list(shape) for shape in sampler.metric_shapes],
+        static=static,
+        arrays={
+            name: dict(shape=spec.shape.as_list(), dtype=spec.dtype.name)
+            for name, spec in sampler.input_signature.items()
+        },
+        nchain=nchain,
+        num_main_iters=num_main_iters,
+        keep=None if keep is None else list(keep),
+        stats=list(stats),
+        thin=thin,
+        metric=metric,
+        precision=model.precision,
+    )
+    with open(os.path.join(path, META_FILE), "w") as f:
+        json.dump(meta, f, indent=2)
+    with open(os.path.join(path, TFP_CODE_FILE), "wb") as f:
+        # the code the sampler was traced from, in the model's precision
+        f.write(model._precision_tfp_code())
+    if model.stan_model_code is not None:
+        with open(os.path.join(path, STAN_CODE_FILE), "w") as f:
+            f.write(model.stan_model_code)
+    return path
+
+
+class ExportedModel():
+    """A sampler exported with `Stan2tfp.export`, ready to sample.
+
+    Loading restores the traced functions from the SavedModel: neither the compiler
+    nor the TFP code is run, and nothing is traced again. XLA compiles the sampler
+    on its first call.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the export.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        if meta["format_version"] != FORMAT_VERSION:
+            raise ValueError(
+                "{} has format version {}, expected {}".format(path, meta["format_version"], FORMAT_VERSION)
+            )
+        self.path = path
+        self.names = meta["names"]
+        self.state_shapes = [tuple(shape) for shape in meta["state_shapes"]]
+        self.metric_shapes = [tuple(shape) for shape in meta["metric_shapes"]]
+        self.static = meta["static"]
+        self.arrays = meta["arrays"]
+        self.nchain = meta["nchain"]
+        self.num_main_iters = meta["num_main_iters"]
+        self.keep = meta["keep"]
+        self.stats = meta["stats"]
+        self.thin = meta["thin"]
+        self.metric = meta["metric"]
+        self.precision = meta.get("precision", "float64")
+        self.sampler_state = None
+        self._module = tf.saved_model.load(path)
+
+    def parameter_names(self):
+        """Names of the model parameters, in the order of the trace."""
+        return list(self.names)
+
+    def get_tfp_code(self):
+        """The TFP code of the model, as a string."""
+        with open(os.path.join(self.path, TFP_CODE_FILE), "rb") as f:
+            return f.read().decode("UTF-8")
+
+    def _arrays(self, data_dict):
+        static, arrays = sampling.split_data(data_dict)
+        if static != self.static:
+            raise ValueError("Model was exported for {}, got {}".format(self.static, static))
+        for name, spec in self.arrays.items():
+            if name not in arrays or list(arrays[name].shape) != spec["shape"]:
+                raise ValueError(
+                    "Model was exported for {} of shape {}, got {}".format(
+                        name, spec["shape"], None if name not in arrays else list(arrays[name].shape)
+                    )
+                )
+            arrays[name] = arrays[name].astype(spec["dtype"])
+        return arrays
+
+    def sample(self, data_dict, num_warmup_iters=1000, seed=None, init=None):
+        """Draw samples from the model with the given data using NUTS.
+
+        The data must have the integers and array shapes the model was exported for.
+
+        Parameters
+        ----------
+        data_dict : dict
+            Data for the model.
+        num_warmup_iters : int, optional
+            Number of warmup iterations, 1000 by default.
+        seed : int, optional
+            Seed of the run, random by default.
+        init : sampling.SamplerState, optional
+            State to start the chains from, as for `Stan2tfp.sample`.
+
+        Returns
+        -------
+        (mcmc_trace, stats) : tuple
+            mcmc_trace - a list samples drawn from the model, of the exported parameters
+            stats - a dictionary of the exported sampler statistics
+
+            The final state of the chains is kept in `sampler_state`.
+        """
+        arrays = self._arrays(data_dict)
+        (mcmc_trace, stats), state = self._module.sample(
+            arrays,
+            tf.constant(num_warmup_iters, tf.int32),
+            sampling.make_seed(seed),
+            *sampling.init_arrays(init, self.state_shapes, self.metric_shapes, self.metric, self.precision),
+            tf.constant(init is not None),
+            tf.constant(False),
+        )
+        self.sampler_state = sampling.SamplerState(*state)
+        return mcmc_trace, stats
+
+    def log_prob(self, params, data_dict):
+        """Log density of the model with the given data.
+
+        Parameters
+        ----------
+        params : list
+            Value of every parameter for each of the `nchain` chains, shape (nchain, ...), in the constrained
+            space.
+        data_dict : dict
+            Data for the model.
+
+        Returns
+        -------
+        Tensor
+            Log density of each chain's parameters.
+        """
+        return self._module.log_prob(
+            self._arrays(data_dict), [np.asarray(p, self.precision) for p in params]
+        )
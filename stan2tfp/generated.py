@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""Derived quantities and posterior predictive draws, evaluated over all draws of a trace.
+
+The quantities are defined by a function of a single draw, which is vectorized
+over a chunk of draws with `tf.vectorized_map` and XLA-compiled once per model,
+data signature, function and chunk size: every chunk, the last one padded, runs
+through the same compiled function, which is cached with the compiled samplers
+(see `sampling.sampler_cache_info`).
+"""
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from stan2tfp import sampling
+
+CHUNK_SIZE = 1000
+"""Number of draws evaluated in one call, bounding the memory of the intermediate tensors."""
+
+
+class CompiledGenerator():
+    """Quantities of a chunk of draws, traced and XLA-compiled once for a model, a data signature and a function.
+
+    The data arrays, the draws and their seeds are inputs of the compiled function, so evaluating other
+    traces, or the same function with new data of the same shapes and dtypes, reuses it.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    static : dict
+        Integer data traced as constants, see `sampling.split_data`.
+    arrays : dict
+        Example data arrays defining the input signature, see `sampling.split_data`.
+    fn, names, chunk_size, precision
+        The quantities and settings, see `generate`.
+    """
+
+    def __init__(self, model_constructor, static, arrays, fn, names, chunk_size, precision):
+        self.model_constructor = model_constructor
+        self.static = dict(static)
+        self.fn = fn
+        self.names = list(names)
+        self.chunk_size = chunk_size
+        self.precision = precision
+        event_shapes = sampling.event_shapes(model_constructor(**static, **arrays))
+        self.trace_count = 0
+        self._function = tf.function(
+            self._evaluate,
+            input_signature=[
+                {
+                    name: tf.TensorSpec(value.shape, tf.as_dtype(value.dtype), name=name)
+                    for name, value in arrays.items()
+                },
+                [tf.TensorSpec((chunk_size,) + shape, tf.as_dtype(precision)) for shape in event_shapes],
+                tf.TensorSpec([chunk_size, 2], tf.int32),
+            ],
+            experimental_compile=True,
+        )
+
+    def _evaluate(self, arrays, params, seeds):
+        # only executed while tracing
+        self.trace_count += 1
+        model = self.model_constructor(**self.static, **arrays)
+
+        def one_draw(args):
+            params, seed = args
+            quantities = self.fn(model, dict(zip(self.names, params)), seed)
+            if not isinstance(quantities, dict):
+                raise ValueError("The quantities must be returned as a dict of tensors, got {}".format(quantities))
+            return quantities
+
+        return tf.vectorized_map(one_draw, (params, seeds))
+
+    def empty(self):
+        """The quantities of no draws: empty arrays with the shape of every quantity."""
+        outputs = self._function.get_concrete_function().structured_outputs
+        return {
+            name: np.zeros((0,) + tuple(d or 0 for d in value.shape[1:].as_list()), value.dtype.as_numpy_dtype)
+            for name, value in outputs.items()
+        }
+
+    def run(self, data_dict, draws, seeds):
+        """Quantities of draws of every parameter, shape (ndraw, ...), with seeds of shape (ndraw, 2)."""
+        arrays = sampling._check_static(self.static, data_dict, self.precision)
+        ndraw = len(draws[0])
+        chunks = []
+        for start in range(0, ndraw, self.chunk_size):
+            stop = min(start + self.chunk_size, ndraw)
+            # the last chunk repeats its final draw up to the chunk size, so as not to retrace
+            indices = np.minimum(np.arange(start, start + self.chunk_size), ndraw - 1)
+            quantities = self._function(arrays, [x[indices] for x in draws], seeds[indices])
+            chunks.append({name: np.asarray(value)[:stop - start] for name, value in quantities.items()})
+        return {name: np.concatenate([chunk[name] for chunk in chunks]) for name in chunks[0]}
+
+
+def compiled_generator(model_constructor, data_dict, fn, names, chunk_size=CHUNK_SIZE, precision="float64"):
+    """Return the `CompiledGenerator` for a model, data signature, function and chunk size.
+
+    They are cached together with the compiled samplers, see `sampling.sampler_cache_info`; `fn` is part of
+    the key, so pass the same function object to reuse the compiled generator.
+
+    Returns
+    -------
+    CompiledGenerator
+        The compiled evaluation; its `trace_count` counts traces (and XLA compilations).
+    """
+    static, arrays = sampling.split_data(data_dict, precision)
+    key = (
+        CompiledGenerator,
+        model_constructor,
+        tuple(sorted(static.items())),
+        tuple((name, a.shape, a.dtype.str) for name, a in sorted(arrays.items())),
+        fn,
+        tuple(names),
+        chunk_size,
+        precision,
+    )
+    return sampling._cached_sampler(key, lambda: CompiledGenerator(
+        model_constructor, static, arrays, fn, names, chunk_size, precision
+    ))
+
+
+def generate(
+    model_constructor, data_dict, fn, draws, names, chunk_size=CHUNK_SIZE, seed=None, precision="float64"
+):
+    """Evaluate quantities over draws, see `Stan2tfp.generate_quantities`.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    data_dict : dict
+        Data for the model.
+    fn : callable
+        Called as `fn(model, params, seed)` for a single draw, where `model` is the model instance with its data,
+        `params` maps every parameter name to its value and `seed` is a stateless seed of shape [2], distinct
+        for every draw. Returns a dict of tensors.
+    draws : list of ndarray
+        Draws of every parameter, in the order of `names`, shape (ndraw, ...).
+    names : list of string
+        Names of the parameters.
+    chunk_size : int, optional
+        Positive integer specifying the number of draws per call, `CHUNK_SIZE` by default.
+    seed : int, optional
+        Seed of the draws' seeds. Random by default.
+    precision : string, optional
+        Floating point precision of the model, 'float64' by default.
+
+    Returns
+    -------
+    dict
+        Every quantity returned by `fn`, shape (ndraw, ...); empty arrays without draws.
+    """
+    if chunk_size < 1:
+        raise ValueError("chunk_size must be a positive integer, got {}".format(chunk_size))
+    dtype = tf.as_dtype(precision).as_numpy_dtype
+    draws = [np.asarray(x, dtype) for x in draws]
+    ndraw = len(draws[0])
+    if ndraw == 0:
+        return compiled_generator(model_constructor, data_dict, fn, names, chunk_size, precision).empty()
+    generator = compiled_generator(model_constructor, data_dict, fn, names, min(chunk_size, ndraw), precision)
+    seeds = np.asarray(tfp.random.split_seed(sampling.make_seed(seed), ndraw))
+    return generator.run(data_dict, draws, seeds)
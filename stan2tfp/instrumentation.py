@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Opt-in timing and profiling of compiling, loading and sampling a model.
+
+An `Instrumentation` passed to `Stan2tfp` records how long every phase of a fit
+takes, how often samplers are traced, and the leapfrog steps, tree depth and
+divergences of every iteration, and reports them to optional callbacks as they
+happen. It can also write a TensorFlow profiler trace of a window of iterations.
+
+This module does not import TensorFlow; the profiler is imported when used.
+"""
+from collections import OrderedDict
+from contextlib import contextmanager
+import time
+
+import numpy as np
+
+PHASES = ("compile", "load", "init_model", "trace", "xla_compile", "warmup", "sampling")
+"""Phases of a fit, in the order they happen. Warmup is only timed apart from sampling in
+chunked fits, whose XLA compilation of the sampling chunks is estimated, see
+`Instrumentation`."""
+
+ITERATION_STATS = ("leapfrogs", "tree_depth", "diverging")
+"""Sampler statistics recorded for every iteration of an instrumented fit."""
+
+
+class FitStats():
+    """What an `Instrumentation` recorded.
+
+    Attributes
+    ----------
+    phases : OrderedDict
+        Seconds spent in every phase of `PHASES` so far, summed over all fits.
+    retraces : int
+        Number of times a sampler was traced, summed over all fits.
+    chunk_times : list of float
+        Seconds taken by every chunk of the latest fit, including XLA compilation; empty unless the fit
+        ran in chunks.
+    leapfrogs, tree_depth, diverging : ndarray
+        Statistics of every recorded iteration of every chain of the latest fit, shape (num_draws, nchain);
+        None before the first fit.
+    """
+
+    def __init__(self):
+        self.phases = OrderedDict()
+        self.retraces = 0
+        self.chunk_times = []
+        self.leapfrogs = None
+        self.tree_depth = None
+        self.diverging = None
+
+    def add_phase(self, name, seconds):
+        """Add `seconds` to the time of phase `name`."""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def start_fit(self):
+        """Forget the chunks and iterations of the previous fit."""
+        self.chunk_times = []
+        for name in ITERATION_STATS:
+            setattr(self, name, None)
+
+    def add_iterations(self, stats):
+        """Append the iterations of a chunk, given as a dictionary of (num_draws, nchain) arrays."""
+        for name in ITERATION_STATS:
+            values = np.asarray(stats[name])
+            previous = getattr(self, name)
+            setattr(self, name, values if previous is None else np.concatenate([previous, values]))
+
+    @property
+    def num_divergences(self):
+        """Number of divergent iterations of the latest fit, over all chains."""
+        return 0 if self.diverging is None else int(np.sum(self.diverging))
+
+    def __str__(self):
+        lines = ["{:<12} {:>9.3f}s".format(name, seconds) for name, seconds in self.phases.items()]
+        lines.append("{:<12} {:>9d}".format("retraces", self.retraces))
+        if self.leapfrogs is not None:
+            lines.append("{:<12} {:>9.1f}".format("leapfrogs", float(np.mean(self.leapfrogs))))
+            lines.append("{:<12} {:>9.2f}".format("tree_depth", float(np.mean(self.tree_depth))))
+            lines.append("{:<12} {:>9d}".format("divergences", self.num_divergences))
+        return "\n".join(lines)
+
+
+class Instrumentation():
+    """Records phase timings, retraces and per-iteration statistics of fits.
+
+    An instrumented `Stan2tfp.sample` runs the same compiled sampler, and draws the
+    same samples, as an uninstrumented one (see `sampling.CompiledSampler.run`).
+    Tracing is timed exactly, and so is XLA compilation, by a first call running no
+    iterations; warmup and sampling are timed together as 'sampling'.
+
+    Only `on_chunk` and the profiler need the chains to stop between iterations: with
+    either of them, fits run in chunks of `chunk_size` iterations, with warmup as a
+    call of its own (see `sampling.ChunkedSampler.run`), and the draws differ from
+    those of an unchunked fit with the same seed. The XLA compilation of a chunk is
+    then estimated as the time of its first run less that of the other chunks of the
+    same length.
+
+    Per-iteration statistics cover the iterations after warmup that are recorded
+    (see `thin`).
+
+    Parameters
+    ----------
+    chunk_size : int, optional
+        Positive integer specifying the number of iterations per chunk, 100 by default.
+    on_phase : callable, optional
+        Called as `on_phase(name, seconds)` at the end of every phase.
+    on_chunk : callable, optional
+        Called as `on_chunk(start, stats)` after every chunk, with the index of its first recorded draw and a
+        dictionary of its `ITERATION_STATS`, each of shape (num_draws, nchain).
+    profile_dir : string, optional
+        Directory of the TensorFlow profiler trace; the profiler does not run by default.
+    profile_iters : tuple of int, optional
+        The (start, stop) iterations after warmup to profile, all of them by default. The profiler runs for
+        whole chunks, so it covers every chunk overlapping the window.
+    """
+
+    def __init__(self, chunk_size=100, on_phase=None, on_chunk=None, profile_dir=None, profile_iters=None):
+        self.chunk_size = chunk_size
+        self.on_phase = on_phase
+        self.on_chunk = on_chunk
+        self.profile_dir = profile_dir
+        self.profile_iters = profile_iters
+        self.stats = FitStats()
+        self._profiling = False
+
+    @property
+    def chunked(self):
+        """Whether fits run in chunks: only for `on_chunk` or the profiler."""
+        return self.on_chunk is not None or self.profile_dir is not None
+
+    def record_phase(self, name, seconds):
+        """Add `seconds` to phase `name` and report it to `on_phase`."""
+        self.stats.add_phase(name, seconds)
+        if self.on_phase is not None:
+            self.on_phase(name, seconds)
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager timing phase `name`."""
+        start = time.perf_counter()
+        yield
+        self.record_phase(name, time.perf_counter() - start)
+
+    def record_chunk(self, start, seconds, stats):
+        """Record a chunk starting at draw `start`, see `on_chunk`."""
+        self.stats.chunk_times.append(seconds)
+        self.stats.add_iterations(stats)
+        if self.on_chunk is not None:
+            self.on_chunk(start, stats)
+
+    def _in_window(self, start, stop):
+        if self.profile_dir is None:
+            return False
+        if self.profile_iters is None:
+            return True
+        return start < self.profile_iters[1] and stop > self.profile_iters[0]
+
+    def start_profiler(self, start, stop):
+        """Start the profiler before the iterations [start, stop) if they overlap the window."""
+        if not self._profiling and self._in_window(start, stop):
+            import tensorflow as tf
+
+            tf.profiler.experimental.start(self.profile_dir)
+            self._profiling = True
+
+    def stop_profiler(self, stop=None):
+        """Stop the profiler after iteration `stop` if the window ends there, or in any case without `stop`."""
+        if not self._profiling:
+            return
+        if stop is None or (self.profile_iters is not None and stop >= self.profile_iters[1]):
+            import tensorflow as tf
+
+            tf.profiler.experimental.stop()
+            self._profiling = False
+
+
+@contextmanager
+def phase(instrumentation, name):
+    """Time phase `name` with `instrumentation`, doing nothing if it is None."""
+    if instrumentation is None:
+        yield
+    else:
+        with instrumentation.phase(name):
+            yield
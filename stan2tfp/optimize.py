@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""Posterior modes, found with L-BFGS in the unconstrained space.
+
+Several starting points are optimized at once, as a batch, in a single
+XLA-compiled call, traced once per model, data signature and settings and cached
+with the compiled samplers (see `sampling.compiled_sampler`).
+"""
+from collections import namedtuple
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from stan2tfp import sampling
+
+INIT_JITTER = 0.1
+"""Standard deviation of the noise added to the optima chains start from, in the unconstrained space."""
+
+OptimizationResult = namedtuple(
+    "OptimizationResult", ["position", "unconstrained", "log_prob", "converged", "num_iterations"]
+)
+OptimizationResult.__doc__ = """Optima found from every starting point.
+
+Attributes
+----------
+position : list of ndarray
+    The optimum of every start, one (nstart, ...) array per parameter in the constrained space.
+unconstrained : ndarray
+    The optima in the unconstrained space, all parameters flattened, shape (nstart, dim).
+log_prob : ndarray
+    The maximized log density at every optimum, shape (nstart,).
+converged : ndarray
+    Whether the optimization from every start converged, shape (nstart,).
+num_iterations : int
+    Number of L-BFGS iterations run.
+"""
+
+
+def _minimize(target, z, max_iters, tolerance):
+    def value_and_gradients(z):
+        return tfp.math.value_and_gradient(lambda z: -target(z), z)
+
+    results = tfp.optimizer.lbfgs_minimize(
+        value_and_gradients, z, tolerance=tolerance, max_iterations=max_iters
+    )
+    return results.position, -results.objective_value, results.converged, results.num_iterations
+
+
+class CompiledOptimizer():
+    """Batched L-BFGS traced and XLA-compiled once for a model, a data signature and settings.
+
+    The data arrays and the starting points are inputs of the compiled function, so optimizing again, from
+    other starts or with new data of the same shapes and dtypes, reuses it.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    static : dict
+        Integer data traced as constants, see `sampling.split_data`.
+    arrays : dict
+        Example data arrays defining the input signature, see `sampling.split_data`.
+    nstart, max_iters, tolerance, jacobian, precision
+        Settings of the optimization, see `optimize`.
+    """
+
+    def __init__(self, model_constructor, static, arrays, nstart, max_iters, tolerance, jacobian, precision):
+        self.model_constructor = model_constructor
+        self.static = dict(static)
+        self.nstart = nstart
+        self.max_iters = max_iters
+        self.tolerance = tolerance
+        self.jacobian = jacobian
+        self.precision = precision
+        self.event_shapes = sampling.event_shapes(model_constructor(**static, **arrays))
+        dim = sum(int(np.prod(shape)) for shape in self.event_shapes)
+        self.trace_count = 0
+        self._function = tf.function(
+            self._minimize,
+            input_signature=[
+                {
+                    name: tf.TensorSpec(value.shape, tf.as_dtype(value.dtype), name=name)
+                    for name, value in arrays.items()
+                },
+                tf.TensorSpec([nstart, dim], tf.as_dtype(precision)),
+            ],
+            experimental_compile=True,
+        )
+
+    def _minimize(self, arrays, z):
+        # only executed while tracing
+        self.trace_count += 1
+        model = self.model_constructor(**self.static, **arrays)
+        target = sampling.target_log_prob_fn(model, self.event_shapes, self.jacobian)
+        return _minimize(target, z, self.max_iters, self.tolerance)
+
+    def run(self, data_dict, z):
+        """Optimize from the starting points `z`, shape (nstart, dim) in the unconstrained space.
+
+        Returns
+        -------
+        OptimizationResult
+            The optimum found from every start.
+        """
+        arrays = sampling._check_static(self.static, data_dict, self.precision)
+        z, log_prob, converged, num_iterations = self._function(arrays, z)
+        model = self.model_constructor(**self.static, **arrays)
+        position = [
+            np.asarray(b.forward(x))
+            for b, x in zip(model.parameter_bijectors(), sampling.unflatten(z, self.event_shapes))
+        ]
+        return OptimizationResult(
+            position, np.asarray(z), np.asarray(log_prob), np.asarray(converged), int(num_iterations)
+        )
+
+
+def compiled_optimizer(
+    model_constructor, data_dict, nstart=4, max_iters=1000, tolerance=1e-8, jacobian=False, precision="float64"
+):
+    """Return the `CompiledOptimizer` for a model, data signature and settings.
+
+    They are cached together with the compiled samplers, see `sampling.sampler_cache_info`.
+
+    Returns
+    -------
+    CompiledOptimizer
+        The compiled optimization; its `trace_count` counts traces (and XLA compilations).
+    """
+    static, arrays = sampling.split_data(data_dict, precision)
+    key = (
+        CompiledOptimizer,
+        model_constructor,
+        tuple(sorted(static.items())),
+        tuple((name, a.shape, a.dtype.str) for name, a in sorted(arrays.items())),
+        nstart,
+        max_iters,
+        tolerance,
+        jacobian,
+        precision,
+    )
+    return sampling._cached_sampler(key, lambda: CompiledOptimizer(
+        model_constructor, static, arrays, nstart, max_iters, tolerance, jacobian, precision
+    ))
+
+
+def _starts(model_constructor, data_dict, nstart, seed, precision):
+    # random starts as for the chains: uniform(-2, 2) in the unconstrained space
+    static, arrays = sampling.split_data(data_dict, precision)
+    model = model_constructor(**static, **arrays)
+    states = sampling._initial_states(model, nstart, seed, tf.as_dtype(precision))
+    return tf.concat([tf.reshape(s, [nstart, -1]) for s in states], axis=1)
+
+
+def optimize(
+    model_constructor, data_dict, nstart=4, max_iters=1000, tolerance=1e-8, jacobian=False, seed=None,
+    precision="float64",
+):
+    """Find posterior modes from several random starting points, see `Stan2tfp.optimize`.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    data_dict : dict
+        Data for the model.
+    nstart : int, optional
+        Number of random starting points, 4 by default.
+    max_iters : int, optional
+        Largest number of L-BFGS iterations, 1000 by default.
+    tolerance : float, optional
+        Convergence tolerance of the gradient, 1e-8 by default.
+    jacobian : bool, optional
+        Whether to maximize the density in the unconstrained space, including the log Jacobian of the map to
+        the constrained space, rather than the posterior density of the constrained parameters. False by
+        default.
+    seed : int, optional
+        Seed of the starting points. Random by default.
+    precision : string, optional
+        Floating point precision of the model, 'float64' by default.
+
+    Returns
+    -------
+    OptimizationResult
+        The optimum found from every start.
+    """
+    optimizer = compiled_optimizer(model_constructor, data_dict, nstart, max_iters, tolerance, jacobian, precision)
+    z = _starts(model_constructor, data_dict, nstart, sampling.make_seed(seed), precision)
+    return optimizer.run(data_dict, z)
+
+
+def best(result):
+    """Index of the start reaching the highest finite log density.
+
+    Raises
+    ------
+    ValueError
+        If the optimization failed from every start.
+    """
+    finite = np.isfinite(result.log_prob) & np.all(np.isfinite(result.unconstrained), axis=1)
+    if not finite.any():
+        raise ValueError("The optimization failed from every starting point")
+    return int(np.argmax(np.where(finite, result.log_prob, -np.inf)))
+
+
+def jittered_optima(
+    model_constructor, data_dict, nchain=4, jitter=INIT_JITTER, max_iters=1000, seed=None, precision="float64"
+):
+    """A state starting every chain close to a mode, see `Stan2tfp.sample`.
+
+    The density NUTS samples, in the unconstrained space, is maximized from one
+    random start per chain. Starts that fail take the best optimum instead, and
+    every chain gets independent normal noise of scale `jitter`, so that the chains
+    do not start from the same point.
+
+    Returns
+    -------
+    sampling.SamplerState
+        Positions of the chains; the step size starts at its default.
+    """
+    start_seed, jitter_seed = tfp.random.split_seed(sampling.make_seed(seed))
+    optimizer = compiled_optimizer(model_constructor, data_dict, nchain, max_iters, 1e-8, True, precision)
+    result = optimizer.run(data_dict, _starts(model_constructor, data_dict, nchain, start_seed, precision))
+    z = result.unconstrained
+    finite = np.isfinite(result.log_prob) & np.all(np.isfinite(z), axis=1)
+    z = np.where(finite[:, None], z, z[best(result)])
+    z = z + jitter * np.asarray(tf.random.stateless_normal(z.shape, jitter_seed, dtype=z.dtype))
+    static, arrays = sampling.split_data(data_dict, precision)
+    model = model_constructor(**static, **arrays)
+    position = [
+        np.asarray(b.forward(x))
+        for b, x in zip(model.parameter_bijectors(), sampling.unflatten(tf.constant(z), optimizer.event_shapes))
+    ]
+    return sampling.SamplerState(position, None, None)
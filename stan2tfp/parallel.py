@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""Running groups of chains in separate processes."""
+from concurrent.futures import ProcessPoolExecutor
+import atexit
+import multiprocessing
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+from stan2tfp import sampling
+from stan2tfp.stan2tfp import load_tfp_code
+
+_pools_lock = threading.Lock()
+_pools = {}
+
+
+def _init_worker(num_threads):
+    if num_threads is not None:
+        tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(num_threads)
+
+
+def get_pool(processes, num_threads=None):
+    """Return the process pool with `processes` workers, starting it if needed.
+
+    Workers are started with the 'spawn' method, as TensorFlow does not survive a
+    fork, and are kept alive for later calls: a worker executes the TFP code of a
+    model and traces its sampler once, and reuses both for every later group of
+    chains of the same model.
+
+    :param processes: Number of worker processes
+    :type processes: int
+    :param num_threads: Number of TensorFlow threads per worker, defaults to
+        TensorFlow's choice
+    :type num_threads: int, optional
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    key = (processes, num_threads)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProcessPoolExecutor(
+                processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(num_threads,),
+            )
+        return _pools[key]
+
+
+@atexit.register
+def shutdown_pools():
+    """Shut down all worker processes."""
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.shutdown()
+        _pools.clear()
+
+
+def _run_chains(
+    tfp_code, data_dict, seeds, num_main_iters, num_warmup_iters, trace_options, metric, precision
+):
+    # every chain runs on its own with its own seed, so that it does not depend on
+    # the other chains of the group; all of them share one compiled sampler
+    model_constructor = load_tfp_code(tfp_code).model
+    sampler = sampling.compiled_sampler(
+        model_constructor, data_dict, 1, num_main_iters, trace_options=trace_options, metric=metric,
+        precision=precision,
+    )
+    chains = [tf.nest.map_structure(np.asarray, sampler(data_dict, num_warmup_iters, seed)) for seed in seeds]
+    return tf.nest.map_structure(_concatenate_chains, *chains)
+
+
+def _concatenate_chains(*parts):
+    # statistics without a chain axis, such as the adaptation step counter, are
+    # the same in every group
+    if np.ndim(parts[0]) < 2:
+        return parts[0]
+    return np.concatenate(parts, axis=1)
+
+
+def sample_in_processes(
+    tfp_code, data_dict, nchain=4, num_main_iters=1000, num_warmup_iters=1000,
+    trace_options=sampling.TraceOptions(), processes=None, num_threads=None, seed=None, metric=None,
+    precision="float64",
+):
+    """Draw samples using NUTS, running groups of chains in a pool of processes.
+
+    The `nchain` chains are split into `processes` groups of consecutive chains,
+    each group sampled by one worker, and the results are gathered along the chain
+    axis. Every chain has its own seed, derived from `seed` and its index, and the
+    chains of a group run one after another, so a chain does not depend on how the
+    chains are grouped.
+
+    :param tfp_code: the TFP model code
+    :type tfp_code: bytes
+    :param data_dict: data for the model
+    :type data_dict: dict
+    :param nchain: Number of chains to sample, defaults to 4
+    :type nchain: int, optional
+    :param num_main_iters: The number of samples to draw, defaults to 1000
+    :type num_main_iters: int, optional
+    :param num_warmup_iters: The number of warmup iterations, defaults to 1000
+    :type num_warmup_iters: int, optional
+    :param trace_options: what to record of every iteration, defaults to everything
+    :type trace_options: TraceOptions, optional
+    :param processes: Number of worker processes, defaults to `nchain`
+    :type processes: int, optional
+    :param num_threads: Number of TensorFlow threads per worker, defaults to
+        TensorFlow's choice
+    :type num_threads: int, optional
+    :param seed: seed from which the seed of every chain is derived; runs with the
+        same inputs and seed are identical, whatever the number of processes.
+        Defaults to a random seed
+    :type seed: int, optional
+    :param metric: mass matrix adapted during warmup, one of `sampling.METRICS`,
+        defaults to None
+    :type metric: str, optional
+    :param precision: dtype of the chains, matching `tfp_code`, defaults to float64
+    :type precision: str, optional
+    :return: Tuple of two elements, as `Stan2tfp.sample`, holding numpy arrays:
+        1. mcmc_trace - a list samples drawn from the model
+        2. pkr (previous kernel results) - kernel results or traced statistics
+    :rtype: tuple
+    """
+    if processes is None:
+        processes = nchain
+    processes = min(processes, nchain)
+    pool = get_pool(processes, num_threads)
+    # the i-th child of a SeedSequence only depends on its entropy and on i
+    seeds = [int(s.generate_state(1, np.uint64)[0] >> 2) for s in np.random.SeedSequence(seed).spawn(nchain)]
+    futures = [
+        pool.submit(
+            _run_chains, tfp_code, data_dict, [seeds[i] for i in group], num_main_iters, num_warmup_iters,
+            trace_options, metric, precision,
+        )
+        for group in np.array_split(np.arange(nchain), processes)
+    ]
+    results = [future.result() for future in futures]
+    return tf.nest.map_structure(_concatenate_chains, *results)
@@ -1,9 +1,16 @@
+from collections import OrderedDict, namedtuple
+import random
+import threading
+import time
+
 import tensorflow as tf
 import tensorflow_probability as tfp
 
 # from pprint import pprint
 import numpy as np
 
+from stan2tfp.instrumentation import ITERATION_STATS
+
 tfd = tfp.distributions
 tfb = tfp.bijectors
 dtype = tf.float64
@@ -15,6 +22,501 @@ def _step_size_setter_fn(pkr, new_step_size):
     )
 
 
+def make_seed(seed=None):
+    """Stateless seed for a sampling run.
+
+    :param seed: an integer, or None for a random seed
+    :type seed: int, optional
+    :return: seed of shape [2], as expected by the stateless random ops
+    :rtype: ndarray
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 62)
+    return np.array([seed % 2 ** 31, (seed // 2 ** 31) % 2 ** 31], np.int32)
+
+
+def _initial_states(model, nchain, seed, dtype=dtype):
+    shapes = model.parameter_shapes(nchain)
+    return [
+        tf.random.stateless_uniform(s, part_seed, -2, 2, dtype, name="initializer")
+        for s, part_seed in zip(shapes, tfp.random.split_seed(seed, n=len(shapes)))
+    ]
+
+
+def _make_kernel(model, step_sizes, num_warmup_iters, preconditioners=None):
+    bijectors = model.parameter_bijectors()
+    if preconditioners is not None:
+        # NUTS moves in the preconditioned space, mapped by the metric to the
+        # unconstrained space and on by the parameter bijectors
+        bijectors = [tfb.Chain([b, p]) for b, p in zip(bijectors, preconditioners)]
+    kernel = tfp.mcmc.TransformedTransitionKernel(
+        tfp.mcmc.nuts.NoUTurnSampler(
+            target_log_prob_fn=lambda *args: model.log_prob(args), step_size=step_sizes
+        ),
+        bijector=bijectors,
+    )
+
+    return tfp.mcmc.DualAveragingStepSizeAdaptation(
+        kernel,
+        target_accept_prob=tf.cast(0.8, dtype=tf.nest.flatten(step_sizes)[0].dtype),
+        # Adapt for the entirety of the trajectory.
+        num_adaptation_steps=num_warmup_iters,
+        step_size_setter_fn=_step_size_setter_fn,
+        step_size_getter_fn=lambda pkr: pkr.inner_results.step_size,
+        log_accept_prob_getter_fn=lambda pkr: pkr.inner_results.log_accept_ratio,
+    )
+
+
+def _initial_step_sizes(states):
+    return [1e-2 * tf.ones_like(s) for s in states]
+
+
+def _constrain(model, states):
+    return [
+        bijector.forward(state)
+        for bijector, state in zip(model.parameter_bijectors(), states)
+    ]
+
+
+def event_shapes(model):
+    """Shapes of the parameters of one chain.
+
+    :param model: an instance of the model class emitted by the compiler
+    :return: one shape per parameter, without the chain axis
+    :rtype: list of tuple
+    """
+    return [tuple(int(d) for d in shape[1:]) for shape in model.parameter_shapes(1)]
+
+
+def unflatten(z, event_shapes):
+    """Split flattened parameters into one tensor per parameter.
+
+    :param z: all parameters flattened in order, shape (..., dim)
+    :param event_shapes: shapes of the parameters, see `event_shapes`
+    :type event_shapes: list
+    :return: one (..., *event_shape) tensor per parameter
+    :rtype: list
+    """
+    sizes = [int(np.prod(shape)) for shape in event_shapes]
+    batch_shape = tf.shape(z)[:-1]
+    return [
+        tf.reshape(part, tf.concat([batch_shape, tf.constant(shape, tf.int32)], 0))
+        for part, shape in zip(tf.split(z, sizes, axis=-1), event_shapes)
+    ]
+
+
+def target_log_prob_fn(model, event_shapes, jacobian=True):
+    """Log density of flattened unconstrained parameters.
+
+    :param model: an instance of the model class emitted by the compiler
+    :param event_shapes: shapes of the parameters, see `event_shapes`
+    :type event_shapes: list
+    :param jacobian: whether to add the log Jacobian of the map to the constrained
+        space, giving the density NUTS samples, defaults to True
+    :type jacobian: bool, optional
+    :return: a function of z, shape (nchain, dim), returning the log density of
+        every row, evaluated as one chain of the model
+    """
+    bijectors = model.parameter_bijectors()
+
+    def target_log_prob(z):
+        parts = unflatten(z, event_shapes)
+        params = [b.forward(x) for b, x in zip(bijectors, parts)]
+        if not jacobian:
+            return model.log_prob(params)
+        log_det = tf.add_n([
+            b.forward_log_det_jacobian(x, event_ndims=len(shape))
+            for b, x, shape in zip(bijectors, parts, event_shapes)
+        ])
+        return model.log_prob(params) + log_det
+
+    return target_log_prob
+
+
+def _nuts_results(pkr):
+    # DualAveragingStepSizeAdaptation > TransformedTransitionKernel > NoUTurnSampler
+    return pkr.inner_results.inner_results
+
+
+def _mean_step_size(nuts):
+    # per chain, over every element of every parameter
+    step_sizes = tf.nest.flatten(nuts.step_size)
+    nchain = tf.shape(step_sizes[0])[0]
+    return tf.reduce_mean(tf.concat([tf.reshape(s, [nchain, -1]) for s in step_sizes], axis=1), axis=1)
+
+
+def _tree_depth(nuts):
+    # a tree of depth d takes 2**d - 1 leapfrog steps
+    leapfrogs = tf.cast(nuts.leapfrogs_taken, dtype)
+    return tf.cast(tf.math.ceil(tf.math.log(leapfrogs + 1) / np.log(2)), tf.int32)
+
+
+STATISTICS = OrderedDict([
+    ("step_size", _mean_step_size),
+    ("log_accept_ratio", lambda nuts: nuts.log_accept_ratio),
+    ("tree_depth", _tree_depth),
+    ("diverging", lambda nuts: nuts.has_divergence),
+    ("leapfrogs", lambda nuts: nuts.leapfrogs_taken),
+    ("target_log_prob", lambda nuts: nuts.target_log_prob),
+])
+"""Sampler statistics that can be traced, per chain and iteration. The step size is
+averaged over the step sizes of all parameters."""
+
+TraceOptions = namedtuple("TraceOptions", ["keep", "stats", "thin"])
+TraceOptions.__new__.__defaults__ = (None, None, 1)
+TraceOptions.__doc__ = """What to record of every iteration.
+
+:param keep: indices of the parameters to trace, all by default
+:type keep: tuple, optional
+:param stats: names of the `STATISTICS` to trace; by default the complete kernel
+    results are traced
+:type stats: tuple, optional
+:param thin: record one in every `thin` iterations, defaults to 1
+:type thin: int, optional
+"""
+
+
+def _make_trace_fn(options):
+    for name in options.stats or ():
+        if name not in STATISTICS:
+            raise ValueError(
+                "Unknown statistic {}, expected one of {}".format(name, list(STATISTICS))
+            )
+
+    def trace_fn(states, pkr):
+        if options.keep is not None:
+            states = [states[i] for i in options.keep]
+        if options.stats is None:
+            return states, pkr
+        nuts = _nuts_results(pkr)
+        return states, {name: STATISTICS[name](nuts) for name in options.stats}
+
+    return trace_fn
+
+
+def _bootstrap(kernel, current_state):
+    pkr = kernel.bootstrap_results(current_state)
+    # start the running average of the step size at the initial step size, which
+    # it then keeps when the chain is continued without adaptation
+    return pkr._replace(
+        log_averaging_step=tf.nest.map_structure(tf.math.log, pkr.new_step_size)
+    )
+
+
+def _sample_chain(
+    kernel, current_state, previous_kernel_results, num_results, num_burnin_steps, trace_fn, seed, thin=1,
+    max_results=None,
+):
+    """Run a Markov chain, tracing only what `trace_fn` returns.
+
+    Unlike `tfp.mcmc.sample_chain`, which always traces the complete state, only the
+    output of `trace_fn(state, kernel_results)` is accumulated. Every transition
+    draws a stateless seed split off `seed`, so the run is a deterministic function
+    of its inputs. Returns the trace and the final state and kernel results, from
+    which the chain can be continued. With `max_results`, the length of the trace,
+    `num_results` may be a tensor up to it; the rows after it are zeros.
+    """
+    if previous_kernel_results is None:
+        previous_kernel_results = _bootstrap(kernel, current_state)
+
+    def step(i, state, pkr, seed):
+        seed, step_seed = tfp.random.split_seed(seed)
+        state, pkr = kernel.one_step(state, pkr, seed=step_seed)
+        return i + 1, state, pkr, seed
+
+    def run_steps(num_steps, state, pkr, seed):
+        _, state, pkr, seed = tf.while_loop(
+            lambda i, state, pkr, seed: i < num_steps, step, (tf.constant(0), state, pkr, seed)
+        )
+        return state, pkr, seed
+
+    def result_step(i, state, pkr, seed, arrays):
+        if thin == 1:
+            _, state, pkr, seed = step(i, state, pkr, seed)
+        else:
+            state, pkr, seed = run_steps(thin, state, pkr, seed)
+        arrays = tf.nest.map_structure(
+            lambda ta, x: ta.write(i, x), arrays, trace_fn(state, pkr)
+        )
+        return i + 1, state, pkr, seed, arrays
+
+    state, pkr, seed = run_steps(num_burnin_steps, current_state, previous_kernel_results, seed)
+    arrays = tf.nest.map_structure(
+        lambda x: tf.TensorArray(
+            x.dtype, size=num_results if max_results is None else max_results, element_shape=x.shape
+        ),
+        trace_fn(state, pkr),
+    )
+    _, state, pkr, _, arrays = tf.while_loop(
+        lambda i, state, pkr, seed, arrays: i < num_results,
+        result_step,
+        (tf.constant(0), state, pkr, seed, arrays),
+    )
+    return tf.nest.map_structure(lambda ta: ta.stack(), arrays), state, pkr
+
+
+METRICS = ("diag", "dense")
+"""Mass matrices that can be adapted during warmup."""
+
+# Stan's warmup schedule: a fast initial buffer adapting the step size only,
+# slow windows doubling in size that also estimate the metric, and a fast
+# terminal buffer adapting the step size to the final metric
+INIT_BUFFER = 75
+TERM_BUFFER = 50
+BASE_WINDOW = 25
+
+
+def _check_metric(metric):
+    if metric is not None and metric not in METRICS:
+        raise ValueError("Unknown metric {}, expected one of {}".format(metric, list(METRICS)))
+
+
+def _is_dense(shape, metric):
+    # scalar parameters have a 1x1 metric either way
+    return metric == "dense" and len(shape) > 1
+
+
+def _metric_shapes(state_shapes, metric):
+    shapes = []
+    for shape in state_shapes:
+        if _is_dense(shape, metric):
+            size = int(np.prod(shape[1:]))
+            shapes.append((shape[0], size, size))
+        else:
+            shapes.append(tuple(shape))
+    return shapes
+
+
+def _unit_metric(states, metric):
+    metric_parts = []
+    for state in states:
+        if _is_dense(state.shape, metric):
+            size = int(np.prod(state.shape[1:]))
+            metric_parts.append(tf.eye(size, batch_shape=state.shape[:1], dtype=state.dtype))
+        else:
+            metric_parts.append(tf.ones_like(state))
+    return metric_parts
+
+
+def _preconditioners(states, inverse_metric, metric):
+    bijectors = []
+    for state, m in zip(states, inverse_metric):
+        if not _is_dense(state.shape, metric):
+            bijectors.append(tfb.Scale(tf.sqrt(m)))
+            continue
+        event_shape = state.shape[1:]
+        scale = tfb.ScaleMatvecTriL(scale_tril=tf.linalg.cholesky(m))
+        if len(event_shape) > 1:
+            size = int(np.prod(event_shape))
+            scale = tfb.Chain([
+                tfb.Reshape(event_shape, event_shape_in=[size]),
+                scale,
+                tfb.Reshape([size], event_shape_in=event_shape),
+            ])
+        bijectors.append(scale)
+    return bijectors
+
+
+def _zero_moments(states, metric):
+    means, m2s = [], []
+    for state in states:
+        if _is_dense(state.shape, metric):
+            size = int(np.prod(state.shape[1:]))
+            means.append(tf.zeros([state.shape[0], size], state.dtype))
+            m2s.append(tf.zeros([state.shape[0], size, size], state.dtype))
+        else:
+            means.append(tf.zeros_like(state))
+            m2s.append(tf.zeros_like(state))
+    return tf.constant(0, states[0].dtype), means, m2s
+
+
+def _update_moments(moments, draws, metric):
+    # Welford's running mean and sum of squared deviations, per chain
+    count, means, m2s = moments
+    count = count + 1
+    new_means, new_m2s = [], []
+    for x, mean, m2 in zip(draws, means, m2s):
+        dense = _is_dense(x.shape, metric)
+        if dense:
+            x = tf.reshape(x, [x.shape[0], -1])
+        delta = x - mean
+        mean = mean + delta / count
+        if dense:
+            m2 = m2 + delta[..., :, None] * (x - mean)[..., None, :]
+        else:
+            m2 = m2 + delta * (x - mean)
+        new_means.append(mean)
+        new_m2s.append(m2)
+    return count, new_means, new_m2s
+
+
+def _regularized_metric(moments):
+    # Stan's shrinkage of the window's estimate towards a small multiple of the
+    # identity
+    count, means, m2s = moments
+    weight = count / (count + 5)
+    jitter = 1e-3 * 5 / (count + 5)
+    inverse_metric = []
+    for mean, m2 in zip(means, m2s):
+        covariance = weight * m2 / tf.maximum(count - 1, 1)
+        if m2.shape.rank > mean.shape.rank:
+            covariance += jitter * tf.eye(m2.shape[-1], dtype=m2.dtype)
+        else:
+            covariance += jitter
+        inverse_metric.append(covariance)
+    return inverse_metric
+
+
+def _warmup_schedule(num_warmup_iters):
+    n = num_warmup_iters
+    small = INIT_BUFFER + BASE_WINDOW + TERM_BUFFER > n
+    init_buffer = tf.where(small, tf.cast(0.15 * tf.cast(n, dtype), tf.int32), INIT_BUFFER)
+    term_buffer = tf.where(small, tf.cast(0.1 * tf.cast(n, dtype), tf.int32), TERM_BUFFER)
+    base_window = tf.where(small, n - init_buffer - term_buffer, BASE_WINDOW)
+    # too short to estimate a metric, only the step size is adapted
+    init_buffer = tf.where(n < 20, n, init_buffer)
+    return init_buffer, base_window, n - term_buffer
+
+
+def _window_end(end, size, slow_end):
+    # a window too close to the terminal buffer for the next one to fit is
+    # stretched to the end of the slow phase
+    return tf.where(end + 2 * size > slow_end, slow_end, end)
+
+
+def _adapt_metric(model, current_state, step_sizes, inverse_metric, num_warmup_iters, seed, metric):
+    """Warm up the chains with Stan's windowed adaptation of the step size and metric.
+
+    The variance (or covariance, for a dense metric) of every parameter in the
+    unconstrained space is estimated per chain over each slow window, and the
+    dual averaging of the step size restarts whenever the metric is updated.
+    Returns the final state, the averaged step sizes, the inverse metric and the
+    seed to continue from.
+    """
+    num_warmup_iters = tf.convert_to_tensor(num_warmup_iters, tf.int32)
+    init_buffer, base_window, slow_end = _warmup_schedule(num_warmup_iters)
+    bijectors = model.parameter_bijectors()
+
+    def make_kernel(inverse_metric, step_sizes):
+        return _make_kernel(
+            model, step_sizes, num_warmup_iters, _preconditioners(current_state, inverse_metric, metric)
+        )
+
+    def end_window(state, pkr, moments, window_end, window_size):
+        inverse_metric = _regularized_metric(moments)
+        pkr = _bootstrap(make_kernel(inverse_metric, pkr.new_step_size), state)
+        window_size = 2 * window_size
+        window_end = _window_end(window_end + window_size, window_size, slow_end)
+        return pkr, inverse_metric, _zero_moments(state, metric), window_end, window_size
+
+    def step(i, state, pkr, seed, inverse_metric, moments, window_end, window_size):
+        seed, step_seed = tfp.random.split_seed(seed)
+        # the step size is taken from the kernel results, the kernel's own one
+        # is only used to bootstrap
+        kernel = make_kernel(inverse_metric, pkr.new_step_size)
+        state, pkr = kernel.one_step(state, pkr, seed=step_seed)
+        in_slow = (i >= init_buffer) & (i < slow_end)
+        draws = [b.inverse(s) for b, s in zip(bijectors, state)]
+        moments = tf.nest.map_structure(
+            lambda new, old: tf.where(in_slow, new, old), _update_moments(moments, draws, metric), moments
+        )
+        pkr, inverse_metric, moments, window_end, window_size = tf.cond(
+            in_slow & tf.equal(i + 1, window_end),
+            lambda: end_window(state, pkr, moments, window_end, window_size),
+            lambda: (pkr, inverse_metric, moments, window_end, window_size),
+        )
+        return i + 1, state, pkr, seed, inverse_metric, moments, window_end, window_size
+
+    _, state, pkr, seed, inverse_metric, _, _, _ = tf.while_loop(
+        lambda i, *args: i < num_warmup_iters,
+        step,
+        (
+            tf.constant(0),
+            current_state,
+            _bootstrap(make_kernel(inverse_metric, step_sizes), current_state),
+            seed,
+            inverse_metric,
+            _zero_moments(current_state, metric),
+            _window_end(init_buffer + base_window, base_window, slow_end),
+            base_window,
+        ),
+    )
+    step_sizes = tf.nest.map_structure(tf.math.exp, pkr.log_averaging_step)
+    return state, step_sizes, inverse_metric, seed
+
+
+SamplerState = namedtuple("SamplerState", ["position", "step_size", "inverse_metric"])
+SamplerState.__new__.__defaults__ = (None,)
+SamplerState.__doc__ = """State of the chains at the end of a run, from which they can be continued
+or a refit warm-started.
+
+:param position: the state of every chain, a list with one (nchain, ...) array per
+    parameter, in the constrained space
+:type position: list
+:param step_size: the adapted step sizes, shaped as `position`; None to start from
+    the default step size
+:type step_size: list
+:param inverse_metric: the adapted inverse metric (the variances of the parameters
+    in the unconstrained space), shaped as `position` for a diagonal metric, or a
+    (nchain, size, size) covariance per non-scalar parameter for a dense one; None
+    without metric adaptation, or to start from the identity
+:type inverse_metric: list, optional
+"""
+
+
+def _run_nuts(
+    model, nchain, num_main_iters, num_warmup_iters, trace_options=TraceOptions(), seed=None, init=None,
+    metric=None, precision="float64", compile_only=None,
+):
+    num_results = num_main_iters // trace_options.thin
+    max_results = None
+    if compile_only is not None:
+        # a boolean tensor: when true, no iterations run, so that a first call only
+        # compiles the function
+        num_warmup_iters = tf.where(compile_only, 0, num_warmup_iters)
+        num_results, max_results = tf.where(compile_only, 0, num_results), num_results
+    if seed is None:
+        seed = tfp.random.sanitize_seed(None)
+    init_seed, chain_seed = tfp.random.split_seed(seed)
+    current_state = _constrain(model, _initial_states(model, nchain, init_seed, tf.as_dtype(precision)))
+    step_sizes = _initial_step_sizes(current_state)
+    inverse_metric = _unit_metric(current_state, metric) if metric is not None else None
+    if init is not None:
+        # (position, step_size, inverse_metric, use_init) tensors, chosen over the
+        # random initialization when use_init is true
+        position, step_size, init_metric, use_init = init
+        current_state = [tf.where(use_init, p, c) for p, c in zip(position, current_state)]
+        step_sizes = [tf.where(use_init, p, c) for p, c in zip(step_size, step_sizes)]
+        if metric is not None:
+            inverse_metric = [tf.where(use_init, p, c) for p, c in zip(init_metric, inverse_metric)]
+
+    if metric is None:
+        kernel = _make_kernel(model, step_sizes, num_warmup_iters)
+        num_burnin_steps = num_warmup_iters
+    else:
+        current_state, step_sizes, inverse_metric, chain_seed = _adapt_metric(
+            model, current_state, step_sizes, inverse_metric, num_warmup_iters, chain_seed, metric
+        )
+        kernel = _make_kernel(
+            model, step_sizes, 0, _preconditioners(current_state, inverse_metric, metric)
+        )
+        num_burnin_steps = 0
+
+    # Sampling from the chain.
+    trace, final_state, final_results = _sample_chain(
+        kernel,
+        current_state,
+        None,
+        num_results=num_results,
+        num_burnin_steps=num_burnin_steps,
+        trace_fn=_make_trace_fn(trace_options),
+        seed=chain_seed,
+        thin=trace_options.thin,
+        max_results=max_results,
+    )
+    return trace, SamplerState(final_state, final_results.new_step_size, inverse_metric)
+
+
 @tf.function(experimental_compile=True)
 def run_nuts(model, nchain=4, num_main_iters=1000, num_warmup_iters=1000):
     """Draw samples from the model using NUTS.
@@ -32,40 +534,762 @@ def run_nuts(model, nchain=4, num_main_iters=1000, num_warmup_iters=1000):
         2. pkr (previous kernel results) - a dictionary of sampler statistics defined by trace_fn 
     :rtype: tuple
     """
-    initial_states = [
-        tf.random.uniform(s, -2, 2, dtype, name="initializer")
-        for s in model.parameter_shapes(nchain)
-    ]
-    step_sizes = [1e-2 * tf.ones_like(i) for i in initial_states]
-    kernel = tfp.mcmc.TransformedTransitionKernel(
-        tfp.mcmc.nuts.NoUTurnSampler(
-            target_log_prob_fn=lambda *args: model.log_prob(args), step_size=step_sizes
-        ),
-        bijector=model.parameter_bijectors(),
-    )
+    return _run_nuts(model, nchain, num_main_iters, num_warmup_iters)[0]
 
-    kernel = tfp.mcmc.DualAveragingStepSizeAdaptation(
-        kernel,
-        target_accept_prob=tf.cast(0.8, dtype=dtype),
-        # Adapt for the entirety of the trajectory.
-        num_adaptation_steps=num_warmup_iters,
-        step_size_setter_fn=_step_size_setter_fn,
-        step_size_getter_fn=lambda pkr: pkr.inner_results.step_size,
-        log_accept_prob_getter_fn=lambda pkr: pkr.inner_results.log_accept_ratio,
+
+def split_data(data_dict, precision="float64"):
+    """Split model data into the Python integers that fix the model's dimensions and
+    the arrays that can be fed to a compiled sampler as tensors.
+
+    :param data_dict: data for the model, as passed to the model constructor
+    :type data_dict: dict
+    :param precision: dtype of the float arrays, defaults to float64
+    :type precision: str, optional
+    :return: Tuple of two dictionaries:
+        1. static - integer scalars, such as sizes, traced as constants
+        2. arrays - everything else, as numpy arrays (floats in `precision`)
+    :rtype: tuple
+    """
+    static, arrays = {}, {}
+    for name, value in data_dict.items():
+        if isinstance(value, (int, np.integer)) and not isinstance(value, bool):
+            static[name] = int(value)
+            continue
+        value = np.asarray(value)
+        if value.dtype.kind == "f":
+            value = value.astype(precision)
+        arrays[name] = value
+    return static, arrays
+
+
+def stack_data(data_dicts, precision="float64"):
+    """Stack the data of several data sets for batched sampling.
+
+    :param data_dicts: data for the model, one dictionary per data set
+    :type data_dicts: list
+    :param precision: dtype of the float arrays, defaults to float64
+    :type precision: str, optional
+    :raises ValueError: if the data sets disagree on an integer (such as a size)
+    :return: data with every array stacked along a new leading batch axis, and the
+        shared integers
+    :rtype: dict
+    """
+    if not data_dicts:
+        raise ValueError("At least one data set is required")
+    splits = [split_data(data_dict, precision) for data_dict in data_dicts]
+    static = splits[0][0]
+    for other, _ in splits[1:]:
+        if other != static:
+            raise ValueError(
+                "All data sets must share their integer data, got {} and {}".format(static, other)
+            )
+    stacked = dict(static)
+    for name in splits[0][1]:
+        stacked[name] = np.stack([arrays[name] for _, arrays in splits])
+    return stacked
+
+
+class BatchedModel():
+    """A model fit to a batch of data sets at once.
+
+    Chains of all data sets share the chain axis, data set-major: chain `c` of data
+    set `b` is chain `b * nchain + c`. `log_prob` evaluates the model of every data
+    set on its own chains in a single vectorized call. Parameter shapes and
+    bijectors are taken from the first data set, so they may only depend on the
+    integer data.
+
+    :param model_constructor: the model class emitted by the compiler
+    :param static: integer data shared by all data sets
+    :type static: dict
+    :param arrays: data arrays with a leading batch axis
+    :type arrays: dict
+    :param batch_size: Number of data sets
+    :type batch_size: int
+    :param nchain: Number of chains per data set
+    :type nchain: int
+    """
+
+    def __init__(self, model_constructor, static, arrays, batch_size, nchain):
+        self.model_constructor = model_constructor
+        self.static = static
+        self.arrays = arrays
+        self.batch_size = batch_size
+        self.nchain = nchain
+        self.model = model_constructor(
+            **static, **{name: value[0] for name, value in arrays.items()}
+        )
+
+    def parameter_shapes(self, nchain):
+        return self.model.parameter_shapes(nchain)
+
+    def parameter_bijectors(self):
+        return self.model.parameter_bijectors()
+
+    def log_prob(self, params):
+        params = [self._unflatten(p, 1) for p in params]
+
+        def one_data_set(args):
+            arrays, params = args
+            return self.model_constructor(**self.static, **arrays).log_prob(params)
+
+        log_probs = tf.vectorized_map(one_data_set, (self.arrays, params))
+        return tf.reshape(log_probs, [-1])
+
+    def unbatch(self, mcmc_trace):
+        """Split the chain axis of a trace into (data set, chain) axes."""
+        return [self._unflatten(x, 2) for x in mcmc_trace]
+
+    def _unflatten(self, x, chain_axis):
+        shape = tf.shape(x)
+        return tf.reshape(x, tf.concat(
+            [shape[:chain_axis - 1], [self.batch_size, self.nchain], shape[chain_axis:]], 0
+        ))
+
+
+def init_arrays(init, state_shapes, metric_shapes, metric=None, precision="float64"):
+    """Arrays feeding a `SamplerState` to a compiled sampler.
+
+    :param init: state to start the chains from, or None
+    :type init: SamplerState
+    :param state_shapes: shapes of the parameters, with the chain axis
+    :type state_shapes: list
+    :param metric_shapes: shapes of the inverse metric, empty without metric adaptation
+    :type metric_shapes: list
+    :param metric: the adapted metric, one of `METRICS`, defaults to None
+    :type metric: str, optional
+    :param precision: dtype of the arrays, defaults to float64
+    :type precision: str, optional
+    :return: Tuple of three lists of arrays: position, step size and inverse metric, with
+        placeholders (or defaults) for what `init` does not provide
+    :rtype: tuple
+    :raises ValueError: if `init` has an inverse metric but `metric` is None, or its
+        arrays do not have the shapes of the sampler's
+    """
+    if init is None:
+        position = step_size = [np.zeros(shape, precision) for shape in state_shapes]
+    else:
+        if init.inverse_metric is not None and metric is None:
+            # the adapted step sizes only fit the preconditioned space
+            raise ValueError(
+                "The init state has an adapted inverse metric, pass the metric it was adapted for"
+            )
+        position = [np.asarray(p, precision) for p in init.position]
+        _check_shapes("position", position, state_shapes)
+        if init.step_size is None:
+            step_size = [np.full(shape, 1e-2, precision) for shape in state_shapes]
+        else:
+            step_size = [np.asarray(s, precision) for s in init.step_size]
+            _check_shapes("step size", step_size, state_shapes)
+    if init is None or init.inverse_metric is None:
+        inverse_metric = [
+            np.broadcast_to(np.eye(shape[-1]), shape) if _is_dense(state_shape, metric) else np.ones(shape)
+            for shape, state_shape in zip(metric_shapes, state_shapes)
+        ]
+    else:
+        inverse_metric = [np.asarray(m, precision) for m in init.inverse_metric]
+        _check_shapes("inverse metric", inverse_metric, metric_shapes)
+    return position, step_size, [np.asarray(m, precision) for m in inverse_metric]
+
+
+def _check_shapes(name, arrays, shapes):
+    actual = [tuple(np.shape(a)) for a in arrays]
+    expected = [tuple(shape) for shape in shapes]
+    if actual != expected:
+        raise ValueError(
+            "The init state's {} has shapes {}, the sampler expects {}".format(name, actual, expected)
+        )
+
+
+class CompiledSampler():
+    """NUTS sampler traced and XLA-compiled once for a model and a data signature.
+
+    The data arrays and the number of warmup iterations are inputs of the compiled
+    function, so calling the sampler again with new data of the same shapes and
+    dtypes, or with another warmup length, reuses the compiled function. The number
+    of chains and of main iterations fix the shape of the trace and are part of the
+    signature.
+
+    With a `batch_size`, the data arrays carry a leading batch axis (see
+    `stack_data`) and all data sets are fit in one run of a `BatchedModel`.
+
+    :param model_constructor: the model class emitted by the compiler
+    :param static: integer data traced as constants, see `split_data`
+    :type static: dict
+    :param arrays: example data arrays defining the input signature, see `split_data`
+    :type arrays: dict
+    :param nchain: Number of chains to sample
+    :type nchain: int
+    :param num_main_iters: The number of samples to draw
+    :type num_main_iters: int
+    :param batch_size: Number of stacked data sets, defaults to None (a single data set)
+    :type batch_size: int, optional
+    :param trace_options: what to record of every iteration, defaults to everything
+    :type trace_options: TraceOptions, optional
+    :param metric: mass matrix adapted during warmup, one of `METRICS`; defaults to
+        None, adapting the step size only
+    :type metric: str, optional
+    :param precision: dtype of the chains, matching the model code (see
+        `compiler.convert_precision`), defaults to float64
+    :type precision: str, optional
+    """
+
+    def __init__(
+        self, model_constructor, static, arrays, nchain, num_main_iters, batch_size=None,
+        trace_options=TraceOptions(), metric=None, precision="float64",
+    ):
+        _check_metric(metric)
+        self.model_constructor = model_constructor
+        self.static = dict(static)
+        self.nchain = nchain
+        self.num_main_iters = num_main_iters
+        self.batch_size = batch_size
+        self.trace_options = trace_options
+        self.metric = metric
+        self.precision = precision
+        self.input_signature = {
+            name: tf.TensorSpec(value.shape, tf.as_dtype(value.dtype), name=name)
+            for name, value in arrays.items()
+        }
+        self.state_shapes = [
+            tuple(int(d) for d in shape)
+            for shape in self._model(arrays).parameter_shapes(self._total_chains())
+        ]
+        self.metric_shapes = _metric_shapes(self.state_shapes, metric) if metric is not None else []
+        state_dtype = tf.as_dtype(precision)
+        state_signature = [tf.TensorSpec(shape, state_dtype) for shape in self.state_shapes]
+        self.trace_count = 0
+        self.call_count = 0
+        self._function = tf.function(
+            self._run,
+            input_signature=[
+                self.input_signature,
+                tf.TensorSpec([], tf.int32),
+                tf.TensorSpec([2], tf.int32),
+                state_signature,
+                state_signature,
+                [tf.TensorSpec(shape, state_dtype) for shape in self.metric_shapes],
+                tf.TensorSpec([], tf.bool),
+                tf.TensorSpec([], tf.bool),
+            ],
+            experimental_compile=True,
+        )
+
+    def _total_chains(self):
+        return self.nchain if self.batch_size is None else self.batch_size * self.nchain
+
+    def _model(self, arrays):
+        if self.batch_size is None:
+            return self.model_constructor(**self.static, **arrays)
+        return BatchedModel(self.model_constructor, self.static, arrays, self.batch_size, self.nchain)
+
+    def _run(
+        self, arrays, num_warmup_iters, seed, init_position, init_step_size, init_metric, use_init, compile_only
+    ):
+        # only executed while tracing
+        self.trace_count += 1
+        model = self._model(arrays)
+        (mcmc_trace, pkr), state = _run_nuts(
+            model, self._total_chains(), self.num_main_iters, num_warmup_iters, self.trace_options, seed,
+            init=(init_position, init_step_size, init_metric, use_init), metric=self.metric,
+            precision=self.precision, compile_only=compile_only,
+        )
+        if self.batch_size is not None:
+            mcmc_trace = model.unbatch(mcmc_trace)
+        return (mcmc_trace, pkr), state
+
+    def run(self, data_dict, num_warmup_iters=1000, seed=None, init=None, instrumentation=None):
+        """Draw samples as `__call__`, also returning the final state of the chains.
+
+        :param init: state to start the chains from, including the metric to start
+            its adaptation from; defaults to random initialization
+        :type init: SamplerState, optional
+        :param instrumentation: where to record the run, defaults to None. Tracing
+            and XLA compilation, by a first call running no iterations, are timed
+            apart from warmup and sampling, which are timed together as 'sampling';
+            the draws are those of an uninstrumented run. The sampler must trace the
+            statistics of `instrumentation.ITERATION_STATS`, or the complete kernel
+            results
+        :type instrumentation: instrumentation.Instrumentation, optional
+        :return: Tuple of two elements:
+            1. (mcmc_trace, pkr) - as returned by `__call__`
+            2. the final `SamplerState`, with chains of all data sets along one
+               axis when batched
+        :rtype: tuple
+        """
+        arrays = _check_static(self.static, data_dict, self.precision)
+        self.call_count += 1
+        args = (
+            arrays,
+            tf.constant(num_warmup_iters, tf.int32),
+            make_seed(seed),
+            *init_arrays(init, self.state_shapes, self.metric_shapes, self.metric, self.precision),
+            tf.constant(init is not None),
+        )
+        if instrumentation is None:
+            return self._function(*args, tf.constant(False))
+
+        instrumentation.stats.start_fit()
+        if _traced_call(self, instrumentation, args + (tf.constant(False),)):
+            with instrumentation.phase("xla_compile"):
+                self._function(*args, tf.constant(True))
+        with instrumentation.phase("sampling"):
+            (mcmc_trace, pkr), state = self._function(*args, tf.constant(False))
+            stats = _iteration_stats(self.trace_options, pkr)
+        instrumentation.stats.add_iterations(stats)
+        return (mcmc_trace, pkr), state
+
+    def __call__(self, data_dict, num_warmup_iters=1000, seed=None):
+        """Draw samples from the model with the given data using NUTS.
+
+        :param data_dict: data for the model; its integers must match `static`
+        :type data_dict: dict
+        :param num_warmup_iters: The number of warmup iterations, defaults to 1000
+        :type num_warmup_iters: int, optional
+        :param seed: seed of the run; runs with the same inputs and seed are
+            identical. Defaults to a random seed
+        :type seed: int, optional
+        :return: Tuple of two elements:
+            1. mcmc_trace - a list samples drawn from the model, with shapes
+               (num_main_iters // thin, batch_size, nchain, ...) when batched
+            2. pkr (previous kernel results) - kernel results of every iteration,
+               or a dictionary of the traced statistics
+        :rtype: tuple
+        """
+        return self.run(data_dict, num_warmup_iters, seed)[0]
+
+
+class ChunkedSampler():
+    """NUTS sampler running the chains in chunks of a fixed number of iterations.
+
+    The kernel state is carried from one chunk to the next, so the chunks together
+    are a single run of the chains, but only one chunk of the trace is held in
+    memory at a time. Each chunk is XLA-compiled; the last chunk is traced again when
+    it is shorter than the others.
+
+    :param model_constructor: the model class emitted by the compiler
+    :param static: integer data traced as constants, see `split_data`
+    :type static: dict
+    :param nchain: Number of chains to sample
+    :type nchain: int
+    :param chunk_size: Number of iterations per chunk, a multiple of `trace_options.thin`
+    :type chunk_size: int
+    :param trace_options: what to record of every iteration, defaults to everything
+    :type trace_options: TraceOptions, optional
+    :param metric: mass matrix adapted during warmup, one of `METRICS`; defaults to
+        None, adapting the step size only
+    :type metric: str, optional
+    :param precision: dtype of the chains, matching the model code, defaults to float64
+    :type precision: str, optional
+    """
+
+    def __init__(
+        self, model_constructor, static, nchain, chunk_size, trace_options=TraceOptions(), metric=None,
+        precision="float64",
+    ):
+        _check_thin(chunk_size, trace_options.thin)
+        _check_metric(metric)
+        self.model_constructor = model_constructor
+        self.static = dict(static)
+        self.nchain = nchain
+        self.chunk_size = chunk_size
+        self.trace_options = trace_options
+        self.metric = metric
+        self.precision = precision
+        self.trace_count = 0
+        self.call_count = 0
+        self._function = tf.function(self._run_chunk, experimental_compile=True)
+
+    def _run_chunk(
+        self, arrays, current_state, previous_kernel_results, step_sizes, inverse_metric, num_burnin_steps,
+        num_warmup_iters, seed, num_results,
+    ):
+        # only executed while tracing
+        self.trace_count += 1
+        model = self.model_constructor(**self.static, **arrays)
+        init_seed, seed = tfp.random.split_seed(seed)
+        if current_state is None:
+            current_state = _constrain(
+                model, _initial_states(model, self.nchain, init_seed, tf.as_dtype(self.precision))
+            )
+        # step sizes are only used to bootstrap the first chunk, later chunks
+        # continue with the step sizes in previous_kernel_results
+        if step_sizes is None:
+            step_sizes = _initial_step_sizes(current_state)
+        if self.metric is None:
+            kernel = _make_kernel(model, step_sizes, num_warmup_iters)
+        else:
+            if previous_kernel_results is None:
+                # the first chunk warms up, later chunks keep the adapted metric
+                if inverse_metric is None:
+                    inverse_metric = _unit_metric(current_state, self.metric)
+                current_state, step_sizes, inverse_metric, seed = _adapt_metric(
+                    model, current_state, step_sizes, inverse_metric, num_burnin_steps, seed, self.metric,
+                )
+                num_burnin_steps = 0
+            kernel = _make_kernel(
+                model, step_sizes, 0, _preconditioners(current_state, inverse_metric, self.metric)
+            )
+        trace, state, pkr = _sample_chain(
+            kernel,
+            current_state,
+            previous_kernel_results,
+            num_results=num_results // self.trace_options.thin,
+            num_burnin_steps=num_burnin_steps,
+            trace_fn=_make_trace_fn(self.trace_options),
+            seed=seed,
+            thin=self.trace_options.thin,
+        )
+        return trace, state, pkr, inverse_metric
+
+    def chunks(self, data_dict, num_main_iters=1000, num_warmup_iters=1000, seed=None):
+        """Draw samples from the model with the given data, one chunk at a time.
+
+        :param data_dict: data for the model; its integers must match `static`
+        :type data_dict: dict
+        :param num_main_iters: The number of iterations after warmup, a multiple
+            of `trace_options.thin`, defaults to 1000
+        :type num_main_iters: int, optional
+        :param num_warmup_iters: The number of warmup iterations, run before the
+            first chunk, defaults to 1000
+        :type num_warmup_iters: int, optional
+        :param seed: seed of the run, defaults to a random seed
+        :type seed: int, optional
+        :return: generator of (mcmc_trace, pkr) tuples, each covering at most
+            `chunk_size` iterations
+        """
+        _check_thin(num_main_iters, self.trace_options.thin)
+        arrays = {
+            name: tf.convert_to_tensor(value)
+            for name, value in _check_static(self.static, data_dict, self.precision).items()
+        }
+        self.call_count += 1
+        current_state, kernel_results, inverse_metric = None, None, None
+        num_burnin_steps = tf.constant(num_warmup_iters, tf.int32)
+        num_warmup_iters = tf.constant(num_warmup_iters, tf.int32)
+        starts = range(0, num_main_iters, self.chunk_size)
+        seeds = tfp.random.split_seed(make_seed(seed), n=len(starts))
+        for start, chunk_seed in zip(starts, seeds):
+            num_results = min(self.chunk_size, num_main_iters - start)
+            (mcmc_trace, pkr), current_state, kernel_results, inverse_metric = self._function(
+                arrays, current_state, kernel_results, None, inverse_metric, num_burnin_steps, num_warmup_iters,
+                chunk_seed, num_results,
+            )
+            num_burnin_steps = tf.constant(0, tf.int32)
+            yield mcmc_trace, pkr
+
+    def _init(self, arrays, init):
+        # the initial (state, step sizes, inverse metric) of the warmup call
+        if init is None:
+            return None, None, None
+        state_shapes = [
+            tuple(int(d) for d in shape)
+            for shape in self.model_constructor(**self.static, **arrays).parameter_shapes(self.nchain)
+        ]
+        metric_shapes = _metric_shapes(state_shapes, self.metric) if self.metric is not None else []
+        position, step_size, inverse_metric = init_arrays(
+            init, state_shapes, metric_shapes, self.metric, self.precision
+        )
+        return position, step_size, inverse_metric if self.metric is not None else None
+
+    def run(self, data_dict, instrumentation, num_main_iters=1000, num_warmup_iters=1000, seed=None, init=None):
+        """Draw samples from the model as `chunks`, recording every phase of the run.
+
+        Warmup runs as a call of its own, before the chunks. See
+        `instrumentation.Instrumentation` for what is recorded; the sampler must trace
+        the statistics of `instrumentation.ITERATION_STATS`, or the complete kernel
+        results.
+
+        :param data_dict: data for the model; its integers must match `static`
+        :type data_dict: dict
+        :param instrumentation: where to record the run
+        :type instrumentation: instrumentation.Instrumentation
+        :param num_main_iters: The number of iterations after warmup, a multiple
+            of `trace_options.thin`, defaults to 1000
+        :type num_main_iters: int, optional
+        :param num_warmup_iters: The number of warmup iterations, defaults to 1000
+        :type num_warmup_iters: int, optional
+        :param seed: seed of the run, defaults to a random seed
+        :type seed: int, optional
+        :param init: state to start the chains from, as for `CompiledSampler.run`;
+            defaults to random initialization
+        :type init: SamplerState, optional
+        :return: Tuple of two elements:
+            1. (mcmc_trace, pkr) - the chunks concatenated, as returned by
+               `CompiledSampler.__call__`
+            2. the final `SamplerState`
+        :rtype: tuple
+        """
+        _check_thin(num_main_iters, self.trace_options.thin)
+        arrays = {
+            name: tf.convert_to_tensor(value)
+            for name, value in _check_static(self.static, data_dict, self.precision).items()
+        }
+        self.call_count += 1
+        instrumentation.stats.start_fit()
+        starts = range(0, num_main_iters, self.chunk_size)
+        seeds = tfp.random.split_seed(make_seed(seed), n=len(starts) + 1)
+        num_warmup_iters = tf.constant(num_warmup_iters, tf.int32)
+
+        position, step_sizes, inverse_metric = self._init(arrays, init)
+        warmup_args = (
+            arrays, position, None, step_sizes, inverse_metric, num_warmup_iters, num_warmup_iters, seeds[0], 0
+        )
+        if _traced_call(self, instrumentation, warmup_args):
+            # no iterations: XLA compilation only
+            with instrumentation.phase("xla_compile"):
+                self._function(*warmup_args[:5], tf.constant(0, tf.int32), *warmup_args[6:])
+        with instrumentation.phase("warmup"):
+            _, current_state, kernel_results, inverse_metric = self._function(*warmup_args)
+
+        chunks, chunk_times = [], {}
+        compiled = []
+        for start, chunk_seed in zip(starts, seeds[1:]):
+            num_results = min(self.chunk_size, num_main_iters - start)
+            args = (
+                arrays, current_state, kernel_results, None, inverse_metric, tf.constant(0, tf.int32),
+                num_warmup_iters, chunk_seed, num_results,
+            )
+            if _traced_call(self, instrumentation, args):
+                compiled.append(len(chunks))
+            instrumentation.start_profiler(start, start + num_results)
+            begin = time.perf_counter()
+            (mcmc_trace, pkr), current_state, kernel_results, inverse_metric = self._function(*args)
+            stats = _iteration_stats(self.trace_options, pkr)
+            seconds = time.perf_counter() - begin
+            instrumentation.stop_profiler(start + num_results)
+            chunk_times.setdefault(num_results, []).append((len(chunks), seconds))
+            instrumentation.record_chunk(start // self.trace_options.thin, seconds, stats)
+            chunks.append((mcmc_trace, pkr))
+        instrumentation.stop_profiler()
+
+        for num_results, times in chunk_times.items():
+            # the first run of a newly traced chunk also XLA-compiles it
+            others = [seconds for i, seconds in times if i not in compiled]
+            for i, seconds in times:
+                if i in compiled and others:
+                    compile_time = max(seconds - float(np.mean(others)), 0.0)
+                    instrumentation.record_phase("xla_compile", compile_time)
+                    seconds -= compile_time
+                instrumentation.record_phase("sampling", seconds)
+
+        fit = tf.nest.map_structure(lambda *parts: tf.concat(parts, 0), *chunks)
+        return fit, SamplerState(current_state, kernel_results.new_step_size, inverse_metric)
+
+
+def _traced_call(sampler, instrumentation, args):
+    # trace ahead of the call when needed, timing it apart from the run
+    trace_count = sampler.trace_count
+    start = time.perf_counter()
+    sampler._function.get_concrete_function(*args)
+    retraced = sampler.trace_count > trace_count
+    if retraced:
+        instrumentation.stats.retraces += sampler.trace_count - trace_count
+        instrumentation.record_phase("trace", time.perf_counter() - start)
+    return retraced
+
+
+def _iteration_stats(trace_options, pkr):
+    if trace_options.stats is None:
+        nuts = _nuts_results(pkr)
+        stats = {name: STATISTICS[name](nuts) for name in ITERATION_STATS}
+    else:
+        stats = {name: pkr[name] for name in ITERATION_STATS}
+    return {name: np.asarray(value) for name, value in stats.items()}
+
+
+def _check_thin(num_iters, thin):
+    if num_iters % thin:
+        raise ValueError(
+            "The number of iterations ({}) must be a multiple of thin ({})".format(num_iters, thin)
+        )
+
+
+def _check_static(static, data_dict, precision="float64"):
+    other, arrays = split_data(data_dict, precision)
+    if other != static:
+        raise ValueError(
+            "Sampler was compiled for {}, got {}".format(static, other)
+        )
+    return arrays
+
+
+MAX_COMPILED_SAMPLERS = 32
+_compiled_samplers_lock = threading.Lock()
+_compiled_samplers = OrderedDict()
+_compiled_samplers_hits = 0
+_compiled_samplers_misses = 0
+
+SamplerCacheInfo = namedtuple("SamplerCacheInfo", ["hits", "misses", "traces", "currsize"])
+
+
+def compiled_sampler(
+    model_constructor, data_dict, nchain=4, num_main_iters=1000, batch_size=None,
+    trace_options=TraceOptions(), metric=None, precision="float64",
+):
+    """Return the `CompiledSampler` for a model, data signature and trace shape.
+
+    Samplers are cached for the whole process, keeping the `MAX_COMPILED_SAMPLERS`
+    most recently used ones.
+
+    :param model_constructor: the model class emitted by the compiler
+    :param data_dict: data for the model
+    :type data_dict: dict
+    :param nchain: Number of chains to sample, defaults to 4
+    :type nchain: int, optional
+    :param num_main_iters: The number of samples to draw, defaults to 1000
+    :type num_main_iters: int, optional
+    :param batch_size: Number of data sets stacked in `data_dict`, defaults to None
+    :type batch_size: int, optional
+    :param trace_options: what to record of every iteration, defaults to everything
+    :type trace_options: TraceOptions, optional
+    :param metric: mass matrix adapted during warmup, one of `METRICS`, defaults to None
+    :type metric: str, optional
+    :param precision: dtype of the chains and float data, matching the model code,
+        defaults to float64
+    :type precision: str, optional
+    :rtype: CompiledSampler
+    """
+    _check_thin(num_main_iters, trace_options.thin)
+    static, arrays = split_data(data_dict, precision)
+    key = (
+        CompiledSampler,
+        model_constructor,
+        tuple(sorted(static.items())),
+        tuple((name, a.shape, a.dtype.str) for name, a in sorted(arrays.items())),
+        nchain,
+        num_main_iters,
+        batch_size,
+        trace_options,
+        metric,
+        precision,
     )
+    return _cached_sampler(key, lambda: CompiledSampler(
+        model_constructor, static, arrays, nchain, num_main_iters, batch_size, trace_options, metric, precision
+    ))
 
-    # Sampling from the chain.
-    mcmc_trace, pkr = tfp.mcmc.sample_chain(
-        num_results=num_main_iters,
-        num_burnin_steps=num_warmup_iters,
-        current_state=[
-            bijector.forward(state)
-            for bijector, state in zip(model.parameter_bijectors(), initial_states)
-        ],
-        kernel=kernel,
+
+def chunked_sampler(
+    model_constructor, data_dict, nchain=4, chunk_size=100, trace_options=TraceOptions(), metric=None,
+    precision="float64",
+):
+    """Return the `ChunkedSampler` for a model, its integer data and chunk shape.
+
+    Samplers are cached together with the ones of `compiled_sampler`.
+
+    :param model_constructor: the model class emitted by the compiler
+    :param data_dict: data for the model
+    :type data_dict: dict
+    :param nchain: Number of chains to sample, defaults to 4
+    :type nchain: int, optional
+    :param chunk_size: Number of iterations per chunk, defaults to 100
+    :type chunk_size: int, optional
+    :param trace_options: what to record of every iteration, defaults to everything
+    :type trace_options: TraceOptions, optional
+    :param metric: mass matrix adapted during warmup, one of `METRICS`, defaults to None
+    :type metric: str, optional
+    :param precision: dtype of the chains and float data, matching the model code,
+        defaults to float64
+    :type precision: str, optional
+    :rtype: ChunkedSampler
+    """
+    static, _ = split_data(data_dict)
+    key = (
+        ChunkedSampler, model_constructor, tuple(sorted(static.items())), nchain, chunk_size, trace_options,
+        metric, precision,
     )
+    return _cached_sampler(key, lambda: ChunkedSampler(
+        model_constructor, static, nchain, chunk_size, trace_options, metric, precision
+    ))
+
+
+def _cached_sampler(key, make_sampler):
+    global _compiled_samplers_hits, _compiled_samplers_misses
+    with _compiled_samplers_lock:
+        sampler = _compiled_samplers.get(key)
+        if sampler is not None:
+            _compiled_samplers_hits += 1
+            _compiled_samplers.move_to_end(key)
+            return sampler
+        _compiled_samplers_misses += 1
+        sampler = make_sampler()
+        _compiled_samplers[key] = sampler
+        while len(_compiled_samplers) > MAX_COMPILED_SAMPLERS:
+            _compiled_samplers.popitem(last=False)
+    return sampler
+
+
+def sampler_cache_info():
+    """Statistics of the compiled sampler cache.
 
-    return mcmc_trace, pkr
+    :return: hits and misses of `compiled_sampler` and `chunked_sampler`, and of the compiled
+        optimizations of `vi` and `optimize` and generated quantities of `generated` cached with them,
+        the number of traces (and therefore XLA compilations) of the cached functions, and their number
+    :rtype: SamplerCacheInfo
+    """
+    with _compiled_samplers_lock:
+        return SamplerCacheInfo(
+            _compiled_samplers_hits,
+            _compiled_samplers_misses,
+            sum(s.trace_count for s in _compiled_samplers.values()),
+            len(_compiled_samplers),
+        )
+
+
+PrecisionCheck = namedtuple("PrecisionCheck", ["log_prob_error", "gradient_error", "safe"])
+PrecisionCheck.__doc__ = """Accuracy of a model computing in a lower precision.
+
+:param log_prob_error: largest error of the log density, relative to its float64
+    value (absolute below 1)
+:type log_prob_error: float
+:param gradient_error: largest error of any element of the gradient of the log
+    density, relative as `log_prob_error`
+:type gradient_error: float
+:param safe: whether both errors are within the tolerance
+:type safe: bool
+"""
+
+
+def _log_prob_and_gradient(model, position):
+    with tf.GradientTape() as tape:
+        tape.watch(position)
+        log_prob = model.log_prob(position)
+    return log_prob, tape.gradient(log_prob, position)
+
+
+def _relative_error(values, reference):
+    reference = np.asarray(reference, np.float64)
+    error = np.abs(np.asarray(values, np.float64) - reference) / np.maximum(np.abs(reference), 1)
+    return float(np.max(error)) if error.size else 0.0
+
+
+def check_precision(reference, model, position, precision="float32", rtol=1e-3):
+    """Compare the log density and its gradient of a model in a lower precision with
+    the float64 model.
+
+    :param reference: the model computing in float64
+    :param model: the same model computing in `precision` (see
+        `compiler.convert_precision`), with the same data
+    :param position: points at which to compare them, one (num_points, ...) array
+        per parameter in the constrained space
+    :type position: list
+    :param precision: dtype of `model`, defaults to float32
+    :type precision: str, optional
+    :param rtol: largest acceptable relative error, defaults to 1e-3
+    :type rtol: float, optional
+    :rtype: PrecisionCheck
+    """
+    position = [tf.convert_to_tensor(np.asarray(p, np.float64)) for p in position]
+    log_prob, gradient = _log_prob_and_gradient(reference, position)
+    low_log_prob, low_gradient = _log_prob_and_gradient(
+        model, [tf.cast(p, tf.as_dtype(precision)) for p in position]
+    )
+    log_prob_error = _relative_error(low_log_prob, log_prob)
+    gradient_error = max(
+        [_relative_error(low, high) for low, high in zip(low_gradient, gradient) if high is not None] or [0.0]
+    )
+    # non-finite errors, such as an overflow to inf, are never safe
+    safe = bool(log_prob_error <= rtol and gradient_error <= rtol)
+    return PrecisionCheck(log_prob_error, gradient_error, safe)
 
 
 def merge_chains(a):
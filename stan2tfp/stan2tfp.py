@@ -1,23 +1,69 @@
 # -*- coding: utf-8 -*-
-from subprocess import run, PIPE
+from collections import OrderedDict
+import hashlib
 import os
-import pkg_resources
-import sys
-import tempfile
+import threading
+import types
 
-import tensorflow as tf
-import tensorflow_probability as tfp
 import numpy as np
 
-tfd = tfp.distributions
-tfb = tfp.bijectors
-dtype = tf.float64
+from stan2tfp import compiler
+from stan2tfp.cache import CompilerCache, FitCache
+from stan2tfp.instrumentation import ITERATION_STATS, phase
+from stan2tfp.storage import DrawStore
+
+# TensorFlow is only imported once a model's TFP code is executed, and the modules
+# built on it (sampling, parallel, diagnostics) when they are first used, so
+# compiling models does not pay for it.
+
+MAX_LOADED_MODELS = 64
+_loaded_models_lock = threading.Lock()
+_loaded_models = OrderedDict()
+
+
+def load_tfp_code(tfp_code):
+    """Execute TFP code emitted by the compiler as a module.
+
+    Modules are shared by the whole process: executing code identical to one of the
+    `MAX_LOADED_MODELS` most recently loaded models returns the existing module.
+
+    Parameters
+    ----------
+    tfp_code : bytes
+        The TFP model code.
+
+    Returns
+    -------
+    module
+        A module whose `model` attribute is the model constructor.
+    """
+    with _loaded_models_lock:
+        module = _loaded_models.get(tfp_code)
+        if module is not None:
+            _loaded_models.move_to_end(tfp_code)
+            return module
+
+    name = "stan2tfp_model_" + hashlib.sha256(tfp_code).hexdigest()[:16]
+    module = types.ModuleType(name)
+    exec(tfp_code, module.__dict__)
+
+    with _loaded_models_lock:
+        # another thread may have loaded the same code in the meantime
+        module = _loaded_models.setdefault(tfp_code, module)
+        _loaded_models.move_to_end(tfp_code)
+        while len(_loaded_models) > MAX_LOADED_MODELS:
+            _loaded_models.popitem(last=False)
+    return module
+
 
 class Stan2tfp():
     
-    slots = ['compiler_path','tfp_code','stan_model_code','parameter_shapes','parameter_bijectors', 'model','model_constructor']
+    slots = ['compiler_path','compiler_cache','tfp_code','stan_model_code','data_dict','sampler_state','parameter_shapes','parameter_bijectors', 'model','model_constructor','precision','instrumentation']
 
-    def __init__(self, stan_file_path=None, stan_model_code=None, data_dict=None):
+    def __init__(
+        self, stan_file_path=None, stan_model_code=None, data_dict=None, compiler_cache=True, precision="float64",
+        instrumentation=None,
+    ):
         """Construct a TensorFlow Probability model from a Stan model.
         
         Parameters
@@ -35,42 +81,121 @@ class Stan2tfp():
             
             Data for the model can be provided later using the `init_model` function,
             but must be provided before sampling.
+
+        compiler_cache : bool or CompilerCache, optional
+            Where to look up previously compiled TFP code before calling the compiler, True by default.
+            True uses a `CompilerCache` in the default cache directory (`STAN2TFP_CACHE_DIR`, or
+            `~/.cache/stan2tfp`), False bypasses the cache, and a `CompilerCache` instance selects
+            another directory or size bound.
+
+        precision : string, optional
+            Floating point precision of the model and sampler, 'float64' by default. 'float32' is faster and
+            halves the memory of traces, but is only accurate enough for some models; see `check_precision`.
+
+        instrumentation : instrumentation.Instrumentation, optional
+            If given, records the time spent compiling, loading and sampling the model, the number of
+            retraces and per-iteration sampler statistics, see `stan2tfp.instrumentation`. Not instrumented
+            by default.
         
         Raises
         ------
         ValueError
-            If both stan_file_path and stan_model_code are None.
+            If both stan_file_path and stan_model_code are None, or the precision is unknown.
         FileNotFoundError
             If stan_file_path is not a valid path.
+        compiler.StanCompilerError
+            If the model does not compile.
         """        
         super().__init__()
+        if precision not in compiler.PRECISIONS:
+            raise ValueError("Unknown precision {}, expected one of {}".format(precision, list(compiler.PRECISIONS)))
         self.parameter_shapes = None
         self.parameter_bijectors = None
+        self.instrumentation = instrumentation
         self._set_compiler_path()
+        if compiler_cache is True:
+            compiler_cache = CompilerCache()
+        self.compiler_cache = compiler_cache or None
 
-        # call the compiler
         if stan_file_path is None:
             if stan_model_code is None:
                 raise ValueError("Either stan_model_code or stan_file_path must be provided to create a Model object")
-            else:
-                self.stan_model_code = stan_model_code
-                self.tfp_code = self._tfp_from_stan_model_code(stan_model_code)
+            self.stan_model_code = stan_model_code
         else:
             if not os.path.exists(stan_file_path):
                 raise FileNotFoundError(stan_file_path)
             with open(stan_file_path, 'r') as f:
                 self.stan_model_code = f.read()
-            self.tfp_code = self._tfp_from_stan_file(stan_file_path)
-        
-        # execute tfp_code in the current namespace
-        exec_dict = {}
-        exec(self.tfp_code, exec_dict)
-        self.model_constructor = exec_dict["model"]
 
+        # call the compiler, unless this exact model was compiled before
+        with phase(self.instrumentation, "compile"):
+            tfp_code = compiler.compile_model(
+                self.stan_model_code, stan_file_path, self.compiler_path, self.compiler_cache
+            )
+        self._set_tfp_code(tfp_code, data_dict, precision)
+
+    @classmethod
+    def from_tfp_code(
+        cls, tfp_code, stan_model_code=None, data_dict=None, precision="float64", instrumentation=None
+    ):
+        """Construct a model from TFP code compiled beforehand, without calling the compiler.
+
+        Parameters
+        ----------
+        tfp_code : bytes or string
+            TFP code emitted by the compiler, such as the output of `get_tfp_code` or `compiler.compile_model`.
+        stan_model_code : string, optional
+            The Stan model the code was compiled from, kept as `stan_model_code`.
+        data_dict : dict, optional
+            Data for the model, as for the constructor.
+        precision : string, optional
+            Floating point precision of the model and sampler, as for the constructor.
+        instrumentation : instrumentation.Instrumentation, optional
+            Where to record the phases of fits, as for the constructor.
+
+        Returns
+        -------
+        Stan2tfp
+            The model.
+        """
+        if precision not in compiler.PRECISIONS:
+            raise ValueError("Unknown precision {}, expected one of {}".format(precision, list(compiler.PRECISIONS)))
+        self = cls.__new__(cls)
+        self.parameter_shapes = None
+        self.parameter_bijectors = None
+        self.compiler_path = None
+        self.compiler_cache = None
+        self.instrumentation = instrumentation
+        self.stan_model_code = stan_model_code
+        if isinstance(tfp_code, str):
+            tfp_code = tfp_code.encode("UTF-8")
+        self._set_tfp_code(tfp_code, data_dict, precision)
+        return self
+
+    def _set_tfp_code(self, tfp_code, data_dict, precision):
+        self.tfp_code = tfp_code
+        self.precision = precision
+        self._model_constructor = None
+        self.data_dict = None
+        self.model = None
+        self.sampler_state = None
         if data_dict is not None:
-            self.model = self.model_constructor(**data_dict)
-        else:
-            self.model = None
+            self.init_model(data_dict)
+
+    @property
+    def model_constructor(self):
+        """The model class defined by the TFP code, computing in `precision`.
+
+        The TFP code (and with it TensorFlow) is executed on first access, or the module of an identical model
+        is reused.
+        """
+        if self._model_constructor is None:
+            with phase(self.instrumentation, "load"):
+                self._model_constructor = load_tfp_code(self._precision_tfp_code()).model
+        return self._model_constructor
+
+    def _precision_tfp_code(self):
+        return compiler.convert_precision(self.tfp_code, self.precision)
 
     def init_model(self, data_dict):
         """Instantiate a TFP model with data. Initialization is required for sampling.  
@@ -83,13 +208,22 @@ class Stan2tfp():
 
             If data has been passed previously (by the constructor or the init_model function),
             it will be overwritten. This is useful for calling the same model with different data.
+            Float data is converted to the model's `precision`.
         """        
-        self.model = self.model_constructor(**data_dict)
-        self.parameter_bijectors = self.model.parameter_bijectors()
-        self.parameter_shapes = self.model.parameter_shapes(1)
+        from stan2tfp import sampling
 
-    @tf.function(experimental_compile=True)
-    def sample(self, nchain=4, num_main_iters=1000, num_warmup_iters=1000):
+        model_constructor = self.model_constructor
+        with phase(self.instrumentation, "init_model"):
+            self.data_dict = data_dict
+            static, arrays = sampling.split_data(data_dict, self.precision)
+            self.model = model_constructor(**static, **arrays)
+            self.parameter_bijectors = self.model.parameter_bijectors()
+            self.parameter_shapes = self.model.parameter_shapes(1)
+
+    def sample(
+        self, nchain=4, num_main_iters=1000, num_warmup_iters=1000, keep=None, stats=None, thin=1, processes=None,
+        seed=None, fit_cache=None, init=None, metric=None,
+    ):
         """Draw samples from the model using NUTS.
         
         Parameters
@@ -102,51 +236,678 @@ class Stan2tfp():
             Positive integer specifying number of warmup (aka burin) iterations.
             As `warmup` also specifies the number of iterations used for stepsize
             adaption, warmup samples should not be used for inference. 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to trace, all of them by default.
+        stats : list of string, optional
+            Names of the sampler statistics to trace, from `sampling.STATISTICS` (step_size, log_accept_ratio,
+            tree_depth, diverging, leapfrogs, target_log_prob). By default the complete kernel results are traced.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        processes : int, optional
+            If given, the chains are split into this many groups, each sampled in its own worker process
+            (see `stan2tfp.parallel`), and the results are returned as numpy arrays. Every chain has its own
+            seed, so the draws do not depend on the number of processes. By default all chains run in this
+            process as one batched computation.
+        seed : int, optional
+            Seed of the run; runs of the same model with the same data, settings and seed give identical
+            traces. Random by default.
+        fit_cache : bool or FitCache, optional
+            Where to look up and store the result, keyed by the model, data, settings and seed. True uses a
+            `FitCache` in the default cache directory. A cache hit returns the stored numpy arrays without
+            running the sampler, and a miss returns the fit as numpy arrays too. Requires a `seed`; `stats`
+            default to all statistics of `sampling.STATISTICS`. Not cached by default.
+        init : sampling.SamplerState or string, optional
+            State to start the chains from, such as the `sampler_state` of a previous run: its positions,
+            adapted step sizes and, with a `metric`, adapted inverse metric. Pass `num_warmup_iters=0` to
+            continue the chains, or a short warmup to warm-start a refit on updated data. 'map' starts every
+            chain from its own mode of the density in the unconstrained space, found with L-BFGS, jittered
+            (see `optimize.jittered_optima`), which lets a shorter warmup reach the typical set. By default
+            chains start from uniform(-2, 2) draws in the unconstrained space, with a step size of 1e-2.
+        metric : string, optional
+            Mass matrix estimated during warmup in the unconstrained space, with Stan's windowed adaptation:
+            'diag' (the variance of every parameter) or 'dense' (the covariance within every parameter).
+            By default only the step size is adapted.
         
         Returns
         -------
         (mcmc_trace, pkr) : tuple
-            mcmc_trace - a list samples drawn from the model
-            pkr (previous kernel results) - a dictionary of sampler statistics as defined by trace_fn 
+            mcmc_trace - a list samples drawn from the model, of the parameters in `keep`
+            pkr (previous kernel results) - the kernel results, or a dictionary of the sampler statistics in `stats`
+
+            The final state of the chains is kept in `sampler_state`, unless the chains ran in other processes
+            or the fit is cached: with a `fit_cache`, `sampler_state` is None whether the fit was found or not.
+
+            With an `instrumentation`, the draws are those of an uninstrumented fit, unless it has an `on_chunk`
+            callback or a profiler window: those run the chains in chunks (see `instrumentation.Instrumentation`),
+            which draw other samples with the same seed. Chains running in other processes are only timed as a
+            whole.
         """      
+        import tensorflow as tf
+
+        from stan2tfp import parallel, sampling
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+
+        self.sampler_state = None
+        if isinstance(init, str) and init != "map":
+            raise ValueError("Unknown init {}, expected 'map' or a SamplerState".format(init))
+        if fit_cache:
+            if seed is None:
+                raise ValueError("Caching a fit requires a seed")
+            if init is not None and init != "map":
+                raise ValueError("Fits started from an init state cannot be cached")
+            if fit_cache is True:
+                fit_cache = FitCache()
+            if stats is None:
+                stats = list(sampling.STATISTICS)
+            settings = dict(
+                nchain=nchain, num_main_iters=num_main_iters, num_warmup_iters=num_warmup_iters,
+                keep=keep, stats=list(stats), thin=thin, processes=processes, seed=seed, metric=metric,
+            )
+            if self.instrumentation is not None and self.instrumentation.chunked and processes is None:
+                # chunked fits draw other samples
+                settings["chunk_size"] = self.instrumentation.chunk_size
+            if init is not None:
+                settings["init"] = init
+            key = fit_cache.key(self.stan_model_code or "", self._precision_tfp_code(), self.data_dict, settings)
+            fit = fit_cache.load_fit(key)
+            if fit is None:
+                fit = self.sample(
+                    nchain, num_main_iters, num_warmup_iters, keep, stats, thin, processes, seed, init=init,
+                    metric=metric,
+                )
+                fit = tf.nest.map_structure(np.asarray, fit)
+                fit_cache.store_fit(key, *fit)
+            # a stored fit has no final state; neither has a fit that was just stored
+            self.sampler_state = None
+            return fit
+
+        if processes is not None:
+            if init is not None:
+                raise ValueError("Chains running in other processes cannot start from an init state")
+            with phase(self.instrumentation, "sampling"):
+                return parallel.sample_in_processes(
+                    self._precision_tfp_code(), self.data_dict, nchain, num_main_iters, num_warmup_iters,
+                    self._trace_options(self.model, keep, stats, thin), processes=processes, seed=seed,
+                    metric=metric, precision=self.precision,
+                )
+
+        if init == "map":
+            from stan2tfp import optimize
+
+            init = optimize.jittered_optima(
+                self.model_constructor, self.data_dict, nchain, seed=seed, precision=self.precision
+            )
+
+        if self.instrumentation is not None:
+            return self._sample_instrumented(
+                nchain, num_main_iters, num_warmup_iters, keep, stats, thin, seed, init, metric
+            )
+
+        sampler = self.compiled_sampler(nchain, num_main_iters, keep, stats, thin, metric)
+        fit, self.sampler_state = sampler.run(self.data_dict, num_warmup_iters, seed, init)
+        return fit
+
+    def _sample_instrumented(self, nchain, num_main_iters, num_warmup_iters, keep, stats, thin, seed, init, metric):
+        from stan2tfp import sampling
+
+        traced_stats = None
+        if stats is not None:
+            # the per-iteration statistics are traced as well, and left out of the result
+            traced_stats = list(stats) + [name for name in ITERATION_STATS if name not in stats]
+        if self.instrumentation.chunked:
+            sampler = sampling.chunked_sampler(
+                self.model_constructor, self.data_dict, nchain, self.instrumentation.chunk_size,
+                self._trace_options(self.model, keep, traced_stats, thin), metric, self.precision,
+            )
+            (mcmc_trace, pkr), self.sampler_state = sampler.run(
+                self.data_dict, self.instrumentation, num_main_iters, num_warmup_iters, seed, init
+            )
+        else:
+            sampler = self.compiled_sampler(nchain, num_main_iters, keep, traced_stats, thin, metric)
+            (mcmc_trace, pkr), self.sampler_state = sampler.run(
+                self.data_dict, num_warmup_iters, seed, init, self.instrumentation
+            )
+        if stats is not None:
+            pkr = {name: pkr[name] for name in stats}
+        return mcmc_trace, pkr
+
+    async def sample_async(self, executor=None, **kwargs):
+        """Draw samples as `sample`, without blocking the asyncio event loop.
+
+        Sampling runs in `executor`, which bounds the number of concurrent fits.
+
+        Parameters
+        ----------
+        executor : aio.SamplingExecutor, optional
+            Where to run the sampler, `aio.default_executor()` by default.
+        **kwargs
+            Arguments of `sample`.
+
+        Returns
+        -------
+        (mcmc_trace, pkr) : tuple
+            As returned by `sample`.
+        """
+        from stan2tfp import aio
+
+        return await aio.sample_async(self, executor, **kwargs)
+
+    def compiled_sampler(self, nchain=4, num_main_iters=1000, keep=None, stats=None, thin=1, metric=None):
+        """The compiled NUTS sampler used by `sample` for the current data.
+
+        Samplers are traced and XLA-compiled once per model, data shapes and dtypes,
+        number of chains and number of main iterations, and shared by every instance
+        of the same model. Refitting on new data of the same shapes, or with another
+        number of warmup iterations, reuses the compiled sampler.
+
+        Parameters
+        ----------
+        nchain : int, optional
+            Positive integer specifying number of chains, 4 by default.
+        num_main_iters : int, optional
+            Positive integer specifying how many iterations for each chain after warmup, 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to trace, all of them by default.
+        stats : list of string, optional
+            Names of the sampler statistics to trace, from `sampling.STATISTICS` (step_size, log_accept_ratio,
+            tree_depth, diverging, leapfrogs, target_log_prob). By default the complete kernel results are traced.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        sampling.CompiledSampler
+            The sampler; its `trace_count` counts traces (and XLA compilations).
+        """
+        from stan2tfp import sampling
+
         if self.model is None:
-            return ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
-
-        initial_states = [
-            tf.random.uniform(s, -2, 2, dtype, name="initializer")
-            for s in self.model.parameter_shapes(nchain)
-        ]
-        step_sizes = [1e-2 * tf.ones_like(i) for i in initial_states]
-        kernel = tfp.mcmc.TransformedTransitionKernel(
-            tfp.mcmc.nuts.NoUTurnSampler(
-                target_log_prob_fn=lambda *args: self.model.log_prob(args), step_size=step_sizes
-            ),
-            bijector=self.model.parameter_bijectors(),
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        return sampling.compiled_sampler(
+            self.model_constructor, self.data_dict, nchain, num_main_iters,
+            trace_options=self._trace_options(self.model, keep, stats, thin), metric=metric,
+            precision=self.precision,
         )
 
-        kernel = tfp.mcmc.DualAveragingStepSizeAdaptation(
-            kernel,
-            target_accept_prob=tf.cast(0.8, dtype=dtype),
-            # Adapt for the entirety of the trajectory.
-            num_adaptation_steps=num_warmup_iters,
-            step_size_setter_fn=self._step_size_setter_fn,
-            step_size_getter_fn=lambda pkr: pkr.inner_results.step_size,
-            log_accept_prob_getter_fn=lambda pkr: pkr.inner_results.log_accept_ratio,
+    def export(self, path, nchain=4, num_main_iters=1000, keep=None, stats=None, thin=1, metric=None):
+        """Export the compiled sampler for the current data shapes as a SavedModel.
+
+        Load the export with `export.ExportedModel`, which samples without the compiler, the TFP code or
+        retracing; see `export.export`.
+
+        Parameters
+        ----------
+        path : string
+            Directory of the export.
+        nchain : int, optional
+            Positive integer specifying number of chains, 4 by default.
+        num_main_iters : int, optional
+            Positive integer specifying how many iterations for each chain after warmup, 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to trace, all of them by default.
+        stats : list of string, optional
+            Names of the sampler statistics to trace, from `sampling.STATISTICS`, all of them by default.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        string
+            `path`.
+        """
+        from stan2tfp import export
+
+        return export.export(self, path, nchain, num_main_iters, keep, stats, thin, metric)
+
+    def sample_chunks(
+        self, chunk_size=100, nchain=4, num_main_iters=1000, num_warmup_iters=1000, sink=None,
+        keep=None, stats=None, thin=1, seed=None, metric=None,
+    ):
+        """Draw samples from the model using NUTS, in chunks of `chunk_size` iterations.
+
+        The chains run as in `sample`, but the trace is produced one chunk at a time and
+        the kernel state is carried between chunks, so peak memory is proportional to
+        `chunk_size` instead of `num_main_iters`.
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            Positive integer specifying the number of iterations per chunk, 100 by default.
+        nchain : int, optional
+            Positive integer specifying number of chains, 4 by default.
+        num_main_iters : int, optional
+            Positive integer specifying how many iterations for each chain after warmup, 1000 by default.
+        num_warmup_iters : int, optional
+            Positive integer specifying number of warmup (aka burin) iterations, 1000 by default.
+        sink : callable, optional
+            If given, called as `sink(mcmc_trace, pkr)` with every chunk, and nothing is returned.
+        keep : list of string, optional
+            Names of the parameters to trace, all of them by default.
+        stats : list of string, optional
+            Names of the sampler statistics to trace, from `sampling.STATISTICS` (step_size, log_accept_ratio,
+            tree_depth, diverging, leapfrogs, target_log_prob). By default the complete kernel results are traced.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        seed : int, optional
+            Seed of the run; runs of the same model with the same data, settings and seed give identical
+            traces. Random by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        generator
+            (mcmc_trace, pkr) of every chunk, shaped as the output of `sample` with `chunk_size`
+            iterations (fewer for the last chunk). None if `sink` is given.
+        """
+        from stan2tfp import sampling
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+
+        sampler = sampling.chunked_sampler(
+            self.model_constructor, self.data_dict, nchain, chunk_size,
+            self._trace_options(self.model, keep, stats, thin), metric, self.precision,
         )
+        chunks = sampler.chunks(self.data_dict, num_main_iters, num_warmup_iters, seed)
+        if sink is None:
+            return chunks
+        for mcmc_trace, pkr in chunks:
+            sink(mcmc_trace, pkr)
 
-        # Sampling from the chain.
-        mcmc_trace, pkr = tfp.mcmc.sample_chain(
-            num_results=num_main_iters,
-            num_burnin_steps=num_warmup_iters,
-            current_state=[
-                bijector.forward(state)
-                for bijector, state in zip(self.model.parameter_bijectors(), initial_states)
-            ],
-            kernel=kernel,
+    def sample_to_store(
+        self, path, chunk_size=100, nchain=4, num_main_iters=1000, num_warmup_iters=1000, keep=None, thin=1,
+        seed=None, metric=None,
+    ):
+        """Draw samples from the model using NUTS, writing them to a memory-mapped `DrawStore`.
+
+        Sampling runs as in `sample_chunks`, so only one chunk of the trace is held in memory.
+
+        Parameters
+        ----------
+        path : string
+            Directory of the store.
+        chunk_size : int, optional
+            Positive integer specifying the number of iterations per chunk, 100 by default.
+        nchain : int, optional
+            Positive integer specifying number of chains, 4 by default.
+        num_main_iters : int, optional
+            Positive integer specifying how many iterations for each chain after warmup, 1000 by default.
+        num_warmup_iters : int, optional
+            Positive integer specifying number of warmup (aka burin) iterations, 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to store, all of them by default.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is stored, 1 by default.
+        seed : int, optional
+            Seed of the run; runs of the same model with the same data, settings and seed give identical
+            traces. Random by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        DrawStore
+            The store, reopened read only.
+        """
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+
+        names = self.parameter_names()
+        indices = range(len(names)) if keep is None else [names.index(name) for name in keep]
+        store = DrawStore.create(
+            path,
+            [names[i] for i in indices],
+            [tuple(int(d) for d in self.parameter_shapes[i][1:]) for i in indices],
+            nchain,
+            num_main_iters // thin,
+            dtype=self.precision,
+        )
+        self.sample_chunks(
+            chunk_size, nchain, num_main_iters, num_warmup_iters, sink=store.write, keep=keep, stats=(), thin=thin,
+            seed=seed, metric=metric,
         )
+        return DrawStore.open(path)
+
+    def sample_until(
+        self, max_r_hat=1.01, min_ess=400, chunk_size=100, max_iters=10000, nchain=4, num_warmup_iters=1000,
+        keep=None, thin=1, seed=None, metric=None,
+    ):
+        """Draw samples from the model using NUTS until the chains have converged.
+
+        Sampling runs as in `sample_chunks`. After every chunk, running R-hat and ESS estimates are updated
+        (see `diagnostics.OnlineDiagnostics`), and sampling stops once every element of the traced parameters
+        reaches the targets, or after `max_iters` iterations.
+
+        Parameters
+        ----------
+        max_r_hat : float, optional
+            Largest acceptable R-hat, 1.01 by default.
+        min_ess : float, optional
+            Smallest acceptable effective sample size, over all chains, 400 by default.
+        chunk_size : int, optional
+            Positive integer specifying the number of iterations between checks, 100 by default.
+        max_iters : int, optional
+            Positive integer specifying the largest number of iterations for each chain after warmup,
+            10000 by default.
+        nchain : int, optional
+            Positive integer specifying number of chains, 4 by default.
+        num_warmup_iters : int, optional
+            Positive integer specifying number of warmup (aka burin) iterations, 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to trace and monitor, all of them by default.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        seed : int, optional
+            Seed of the run; runs of the same model with the same data, settings and seed give identical
+            traces. Random by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        (mcmc_trace, monitor) : tuple
+            mcmc_trace - a list samples drawn from the model, of the parameters in `keep`, as numpy arrays
+            monitor - the `diagnostics.OnlineDiagnostics` of the trace; `monitor.converged(max_r_hat, min_ess)`
+            is False if sampling stopped at `max_iters`
+        """
+        from stan2tfp import diagnostics
+
+        monitor = diagnostics.OnlineDiagnostics()
+        chunks = []
+        for mcmc_trace, _ in self.sample_chunks(
+            chunk_size, nchain, max_iters, num_warmup_iters, keep=keep, stats=(), thin=thin, seed=seed,
+            metric=metric,
+        ):
+            mcmc_trace = [np.asarray(x) for x in mcmc_trace]
+            chunks.append(mcmc_trace)
+            monitor.update(mcmc_trace)
+            if monitor.converged(max_r_hat, min_ess):
+                break
+        return [np.concatenate(parts) for parts in zip(*chunks)], monitor
+
+    def optimize(self, nstart=4, max_iters=1000, tolerance=1e-8, jacobian=False, seed=None):
+        """Find the posterior mode (the MAP estimate) with L-BFGS.
+
+        The optimization runs in the unconstrained space, through the parameter bijectors, from `nstart` random
+        starting points at once, in a single XLA-compiled call. It is compiled once per model, data shapes and
+        settings, and reused by later calls, including the optima of `sample(init='map')`.
+
+        Parameters
+        ----------
+        nstart : int, optional
+            Positive integer specifying the number of random starting points, 4 by default.
+        max_iters : int, optional
+            Positive integer specifying the largest number of L-BFGS iterations, 1000 by default.
+        tolerance : float, optional
+            Convergence tolerance of the gradient, 1e-8 by default.
+        jacobian : bool, optional
+            If True, the density of the unconstrained parameters is maximized, including the log Jacobian of
+            their map to the constrained space, as sampled by NUTS. By default the posterior density of the
+            constrained parameters is, as in Stan.
+        seed : int, optional
+            Seed of the starting points. Random by default.
+
+        Returns
+        -------
+        (estimate, result) : tuple
+            estimate - the value of every parameter at the highest mode found, in the constrained space
+            result - the `optimize.OptimizationResult` of every start
+        """
+        from stan2tfp import optimize
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        result = optimize.optimize(
+            self.model_constructor, self.data_dict, nstart, max_iters, tolerance, jacobian, seed, self.precision
+        )
+        i = optimize.best(result)
+        return [p[i] for p in result.position], result
+
+    def fit_vi(
+        self, family="meanfield", num_steps=5000, learning_rate=1e-2, sample_size=1, num_draws=1000, nchain=4,
+        seed=None,
+    ):
+        """Approximate the posterior with ADVI, much faster than sampling it with NUTS.
+
+        A Gaussian is fit to the posterior in the unconstrained space of all parameters, by maximizing the
+        evidence lower bound with Adam in a single XLA-compiled loop (see `stan2tfp.vi`), compiled once per
+        model, data shapes and settings and reused by later fits, as the sampler of `sample`. The approximation
+        tends to underestimate posterior variances; use it for exploration, or to start NUTS::
+
+            mcmc_trace, fit = model.fit_vi()
+            model.sample(init=fit.sampler_state(metric="diag"), metric="diag", num_warmup_iters=200)
+
+        Parameters
+        ----------
+        family : string, optional
+            'meanfield' (a diagonal covariance) or 'fullrank' (a full covariance), 'meanfield' by default.
+        num_steps : int, optional
+            Positive integer specifying the number of optimization steps, 5000 by default.
+        learning_rate : float, optional
+            Learning rate of Adam, 1e-2 by default.
+        sample_size : int, optional
+            Positive integer specifying the number of draws estimating the gradient at every step, 1 by default.
+        num_draws : int, optional
+            Positive integer specifying the number of draws per chain returned, 1000 by default.
+        nchain : int, optional
+            Positive integer specifying the number of chains the draws are shaped into, 4 by default.
+        seed : int, optional
+            Seed of the fit and the draws. Random by default.
+
+        Returns
+        -------
+        (mcmc_trace, fit) : tuple
+            mcmc_trace - independent draws of the approximation, shaped as the trace returned by `sample`
+            fit - the `vi.VIFit`, with the ELBO of every step, more draws and states to start NUTS from
+        """
+        from stan2tfp import vi
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        fit = vi.fit(
+            self.model_constructor, self.data_dict, family, num_steps, learning_rate, sample_size, seed,
+            self.precision,
+        )
+        return fit.sample(num_draws, nchain, None if seed is None else seed + 1), fit
+
+    def parameter_names(self):
+        """Names of the model parameters, in the order of the trace.
+
+        Returns
+        -------
+        list of string
+            The names given by the model, or `param_0`, `param_1`, ... if it does not provide any.
+        """
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        return self._parameter_names(self.model)
+
+    def summary(self, mcmc_trace, keep=None, quantiles=(0.05, 0.5, 0.95)):
+        """Summarize a trace: mean, sd, quantiles, split R-hat and bulk and tail ESS of every parameter element.
+
+        Parameters
+        ----------
+        mcmc_trace : list
+            Draws of the parameters, as returned by `sample`.
+        keep : list of string, optional
+            Names of the parameters in the trace, if `sample` was called with `keep`. All of them by default.
+        quantiles : tuple of float, optional
+            Quantiles to report, between 0 and 1; (0.05, 0.5, 0.95) by default.
+
+        Returns
+        -------
+        diagnostics.Summary
+            A table with one row per parameter element, such as `theta[0]`.
+        """
+        from stan2tfp import diagnostics
+
+        names = self.parameter_names() if keep is None else list(keep)
+        return diagnostics.summary(mcmc_trace, names, quantiles)
+
+    def generate_quantities(self, mcmc_trace, fn, chunk_size=1000, seed=None):
+        """Evaluate derived quantities and posterior predictive draws over all draws of a trace.
+
+        `fn` computes the quantities of a single draw, such as transformed parameters or draws of the model's
+        distributions; it is vectorized over chunks of draws and XLA-compiled, instead of looping over the
+        draws in Python. The compiled function is cached per `fn` object, data signature and chunk size, so
+        calling again with the same `fn` does not recompile.
+
+        Parameters
+        ----------
+        mcmc_trace : list
+            Draws of all parameters, as returned by `sample` without `keep`.
+        fn : callable
+            Called as `fn(model, params, seed)`, where `model` is the model instance with its data, `params`
+            a dict of the parameters of one draw by name, and `seed` a stateless seed of shape [2], distinct for
+            every draw, for predictive draws such as `tfd.Normal(theta, model.sigma).sample(seed=seed)`.
+            Returns a dict of tensors.
+        chunk_size : int, optional
+            Positive integer specifying the number of draws evaluated in one call, 1000 by default.
+        seed : int, optional
+            Seed of the predictive draws. Random by default.
+
+        Returns
+        -------
+        dict
+            Every quantity returned by `fn`, shape (n_chains * n_iter, ...), aligned with `merge_chains`
+            of the trace.
+        """
+        from stan2tfp import generated
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        draws = [self.merge_chains(np.asarray(x)) for x in mcmc_trace]
+        return generated.generate(
+            self.model_constructor, self.data_dict, fn, draws, self.parameter_names(), chunk_size, seed,
+            self.precision,
+        )
+
+    def check_precision(self, mcmc_trace=None, precision="float32", num_points=100, rtol=1e-3, seed=None):
+        """Check whether the model is accurate enough in a lower precision.
+
+        The log density and its gradient are computed in float64 and in `precision` at the same points and
+        compared. Comparing at draws of a float64 fit checks the typical set; by default the points are drawn
+        as the initial states of the chains, uniform(-2, 2) in the unconstrained space.
+
+        Parameters
+        ----------
+        mcmc_trace : list, optional
+            Draws of all parameters, as returned by `sample` without `keep`; `num_points` of them, evenly
+            spaced, are compared.
+        precision : string, optional
+            The lower precision, 'float32' by default.
+        num_points : int, optional
+            Positive integer specifying the number of points to compare, 100 by default.
+        rtol : float, optional
+            Largest acceptable relative error of the log density and of every element of its gradient,
+            1e-3 by default.
+        seed : int, optional
+            Seed of the random points. Random by default.
+
+        Returns
+        -------
+        sampling.PrecisionCheck
+            The largest errors, and whether they are within `rtol`.
+        """
+        from stan2tfp import sampling
+
+        if self.model is None:
+            raise ValueError("The model class has not been instantiated. Call init_model with the the observed data.")
+        static, arrays = sampling.split_data(self.data_dict)
+        reference = load_tfp_code(self.tfp_code).model(**static, **arrays)
+        static, arrays = sampling.split_data(self.data_dict, precision)
+        model = load_tfp_code(compiler.convert_precision(self.tfp_code, precision)).model(**static, **arrays)
+        if mcmc_trace is None:
+            position = sampling._constrain(
+                reference, sampling._initial_states(reference, num_points, sampling.make_seed(seed))
+            )
+        else:
+            draws = [self.merge_chains(np.asarray(x)) for x in mcmc_trace]
+            indices = np.linspace(0, len(draws[0]) - 1, min(num_points, len(draws[0]))).astype(int)
+            position = [x[indices] for x in draws]
+        return sampling.check_precision(reference, model, position, precision, rtol)
+
+    @staticmethod
+    def _parameter_names(model):
+        if hasattr(model, "parameter_names"):
+            return list(model.parameter_names())
+        return ["param_{}".format(i) for i in range(len(model.parameter_shapes(1)))]
+
+    def _trace_options(self, model, keep, stats, thin):
+        from stan2tfp import sampling
+
+        if keep is not None:
+            names = self._parameter_names(model)
+            for name in keep:
+                if name not in names:
+                    raise ValueError("Unknown parameter {}, expected one of {}".format(name, names))
+            keep = tuple(names.index(name) for name in keep)
+        if stats is not None:
+            stats = tuple(stats)
+        return sampling.TraceOptions(keep, stats, thin)
+
+    def sample_batch(
+        self, data_dicts, nchain=4, num_main_iters=1000, num_warmup_iters=1000, keep=None, stats=None, thin=1,
+        seed=None, metric=None,
+    ):
+        """Fit the model to several data sets in a single run of NUTS.
+
+        The data sets are stacked along a batch axis and every one of them gets its own
+        `nchain` chains with their own step size and metric adaptation, but all chains advance
+        together in one vectorized computation. The data sets must agree on their
+        integer data (such as sizes).
+
+        Parameters
+        ----------
+        data_dicts : list of dict
+            Data for the model, one dictionary per data set.
+        nchain : int, optional
+            Positive integer specifying number of chains per data set, 4 by default.
+        num_main_iters : int, optional
+            Positive integer specifying how many iterations for each chain after warmup, 1000 by default.
+        num_warmup_iters : int, optional
+            Positive integer specifying number of warmup (aka burin) iterations, 1000 by default.
+        keep : list of string, optional
+            Names of the parameters to trace, all of them by default.
+        stats : list of string, optional
+            Names of the sampler statistics to trace, from `sampling.STATISTICS` (step_size, log_accept_ratio,
+            tree_depth, diverging, leapfrogs, target_log_prob). By default the complete kernel results are traced.
+        thin : int, optional
+            Positive integer; one in every `thin` iterations is recorded, 1 by default.
+        seed : int, optional
+            Seed of the run; runs of the same model with the same data, settings and seed give identical
+            traces. Random by default.
+        metric : string, optional
+            Mass matrix adapted during warmup, 'diag' or 'dense', see `sample`. None by default.
+
+        Returns
+        -------
+        (mcmc_trace, pkr) : tuple
+            mcmc_trace - a list samples drawn from the model, with shapes (num_main_iters // thin, len(data_dicts), nchain, ...);
+            `x[:, b]` is the trace of data set `b`.
+            pkr (previous kernel results) - sampler statistics, with the chains of all data sets along one axis
+        """
+        from stan2tfp import sampling
+
+        data_dict = sampling.stack_data(data_dicts, self.precision)
+        model = self.model
+        if model is None:
+            # only resolves the names in `keep`
+            static, arrays = sampling.split_data(data_dicts[0], self.precision)
+            model = self.model_constructor(**static, **arrays)
+        sampler = sampling.compiled_sampler(
+            self.model_constructor, data_dict, nchain, num_main_iters, batch_size=len(data_dicts),
+            trace_options=self._trace_options(model, keep, stats, thin), metric=metric, precision=self.precision,
+        )
+        return sampler(data_dict, num_warmup_iters, seed)
 
-        return mcmc_trace, pkr
-    
     def merge_chains(self, a):
         """Merge samples from different chains to a single numpy array
         
@@ -184,29 +945,4 @@ class Stan2tfp():
             f.writelines(self.get_tfp_code())
 
     def _set_compiler_path(self):
-        plat = sys.platform
-        if plat not in ['darwin', 'linux', 'win32']:
-            raise OSError("OS {} is not supported".format(plat))
-        self.compiler_path = pkg_resources.resource_filename(
-            __name__, "/bin/{}-stan2tfp.exe".format(plat)
-        )
-
-    def _tfp_from_stan_file(self, stan_file_path):
-        cmd = [self.compiler_path, stan_file_path]
-        print("Compiling stan file to tfp file...")
-        proc = run(cmd, stdout=PIPE, stderr=PIPE)
-        tfp_code = proc.stdout
-        return tfp_code
-    
-    def _tfp_from_stan_model_code(self, stan_model_code):
-        fd, path = tempfile.mkstemp(prefix="name",suffix="asda")
-        with open(fd, "w") as f:
-            f.write(stan_model_code)
-        tfp_code = self._tfp_from_stan_file(path)
-        os.unlink(path)
-        return tfp_code
-
-    def _step_size_setter_fn(self, pkr, new_step_size):
-        return pkr._replace(
-            inner_results=pkr.inner_results._replace(step_size=new_step_size)
-        )
\ No newline at end of file
+        self.compiler_path = compiler.default_compiler_path()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Memory-mapped on-disk storage of draws."""
+import json
+import os
+
+import numpy as np
+
+META_FILE = "meta.json"
+
+
+class DrawStore():
+    """Draws of a sampling run, stored as one memory-mapped `.npy` file per parameter.
+
+    Each parameter is preallocated with shape (num_draws, nchain, ...), the layout of
+    the trace returned by `Stan2tfp.sample`, and filled as chunks of the trace are
+    written. A store is reopened lazily: a parameter is mapped only when accessed,
+    and only the pages actually read are loaded, so several processes can share the
+    same draws without copying them.
+
+    Create stores with `DrawStore.create` and reopen them with `DrawStore.open`.
+
+    Parameters
+    ----------
+    path : string
+        Directory of the store.
+    mode : string, optional
+        'r' (read only, the default) or 'r+' (read and write).
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        self.names = meta["names"]
+        self.shapes = {name: tuple(shape) for name, shape in meta["shapes"].items()}
+        self.nchain = meta["nchain"]
+        self.num_draws = meta["num_draws"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.count = meta["count"]
+        self._arrays = {}
+
+    @classmethod
+    def create(cls, path, names, shapes, nchain, num_draws, dtype="float64"):
+        """Preallocate an empty store.
+
+        Parameters
+        ----------
+        path : string
+            Directory of the store, created if needed.
+        names : list of string
+            Parameter names, in the order of the trace.
+        shapes : list of tuple
+            Shape of a single draw of each parameter.
+        nchain : int
+            Number of chains.
+        num_draws : int
+            Number of draws per chain to preallocate.
+        dtype : string, optional
+            Dtype of the draws, 'float64' by default.
+
+        Returns
+        -------
+        DrawStore
+            The store, open for writing.
+        """
+        os.makedirs(path, exist_ok=True)
+        for name, shape in zip(names, shapes):
+            np.lib.format.open_memmap(
+                os.path.join(path, name + ".npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=(num_draws, nchain) + tuple(shape),
+            )
+        meta = dict(
+            names=list(names),
+            shapes={name: [int(d) for d in shape] for name, shape in zip(names, shapes)},
+            nchain=nchain,
+            num_draws=num_draws,
+            dtype=np.dtype(dtype).str,
+            count=0,
+        )
+        _write_meta(path, meta)
+        return cls(path, mode="r+")
+
+    @classmethod
+    def open(cls, path, mode="r"):
+        """Open an existing store, see `DrawStore`."""
+        return cls(path, mode)
+
+    def __getitem__(self, name):
+        """Draws of parameter `name` written so far, shape (count, nchain, ...)."""
+        return self._array(name)[:self.count]
+
+    def _array(self, name):
+        if name not in self.shapes:
+            raise KeyError(name)
+        if name not in self._arrays:
+            self._arrays[name] = np.load(
+                os.path.join(self.path, name + ".npy"), mmap_mode=self.mode
+            )
+        return self._arrays[name]
+
+    def __len__(self):
+        return self.count
+
+    def merged(self, name):
+        """Draws of parameter `name` with the chains merged, as `Stan2tfp.merge_chains`."""
+        a = self[name]
+        return np.reshape(a, (a.shape[0] * a.shape[1],) + a.shape[2:])
+
+    def write(self, mcmc_trace, pkr=None):
+        """Append a chunk of a trace.
+
+        Can be used as the `sink` of `Stan2tfp.sample_chunks`.
+
+        Parameters
+        ----------
+        mcmc_trace : list
+            Draws of every parameter, in the order of `names`, shape (n, nchain, ...).
+        pkr : optional
+            Sampler statistics of the chunk; ignored.
+        """
+        if self.mode == "r":
+            raise ValueError("DrawStore {} is read only".format(self.path))
+        n = int(np.shape(mcmc_trace[0])[0])
+        if self.count + n > self.num_draws:
+            raise ValueError(
+                "DrawStore {} has room for {} more draws, cannot write {}".format(
+                    self.path, self.num_draws - self.count, n
+                )
+            )
+        for name, draws in zip(self.names, mcmc_trace):
+            self._array(name)[self.count:self.count + n] = np.asarray(draws)
+        self.count += n
+        self.flush()
+
+    def flush(self):
+        """Flush written draws to disk and record how many there are."""
+        for array in self._arrays.values():
+            if isinstance(array, np.memmap):
+                array.flush()
+        meta = dict(
+            names=self.names,
+            shapes={name: list(shape) for name, shape in self.shapes.items()},
+            nchain=self.nchain,
+            num_draws=self.num_draws,
+            dtype=self.dtype.str,
+            count=self.count,
+        )
+        _write_meta(self.path, meta)
+
+
+def _write_meta(path, meta):
+    # readers always see a complete metadata file
+    tmp_path = os.path.join(path, META_FILE + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp_path, os.path.join(path, META_FILE))
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Automatic differentiation variational inference (ADVI).
+
+A Gaussian approximation of the posterior is fit in the unconstrained space of
+all parameters, flattened into one vector, by stochastic gradient ascent on the
+evidence lower bound (ELBO). The whole optimization runs as a single XLA-compiled
+loop, traced once per model, data signature and settings and cached with the
+compiled samplers (see `sampling.compiled_sampler`).
+"""
+import numpy as np
+import tensorflow as tf
+import tensorflow_probability as tfp
+
+from stan2tfp import sampling
+
+tfd = tfp.distributions
+
+FAMILIES = ("meanfield", "fullrank")
+"""Approximating families: a Gaussian with diagonal covariance, or with full covariance."""
+
+# Adam's decay rates and the offset of its denominator
+BETA_1 = 0.9
+BETA_2 = 0.999
+EPSILON = 1e-8
+
+
+def _scale_tril(family, raw):
+    # the diagonal is kept positive through exp, so zeros are the identity
+    if family == "meanfield":
+        return tf.linalg.diag(tf.exp(raw))
+    return tf.linalg.set_diag(tf.linalg.band_part(raw, -1, 0), tf.exp(tf.linalg.diag_part(raw)))
+
+
+def _surrogate(family, loc, raw):
+    if family == "meanfield":
+        return tfd.MultivariateNormalDiag(loc, scale_diag=tf.exp(raw))
+    return tfd.MultivariateNormalTriL(loc, scale_tril=_scale_tril(family, raw))
+
+
+def _optimize(target, family, params, num_steps, learning_rate, sample_size, seed):
+    """Maximize the ELBO with Adam, drawing a stateless seed for every step.
+
+    Steps whose loss or gradient is not finite (such as draws far in the tails)
+    leave the parameters unchanged. Returns the final parameters and the negative
+    ELBO estimate of every step.
+    """
+    dtype = params[0].dtype
+
+    def loss_fn(params, seed):
+        surrogate = _surrogate(family, *params)
+        z = surrogate.sample(sample_size, seed=seed)
+        return -tf.reduce_mean(target(z) - surrogate.log_prob(z))
+
+    def step(i, params, m, v, seed, losses):
+        seed, step_seed = tfp.random.split_seed(seed)
+        with tf.GradientTape() as tape:
+            tape.watch(params)
+            loss = loss_fn(params, step_seed)
+        grads = tape.gradient(loss, params)
+        finite = tf.math.is_finite(loss)
+        for g in grads:
+            finite &= tf.reduce_all(tf.math.is_finite(g))
+        t = tf.cast(i + 1, dtype)
+        new_params, new_m, new_v = [], [], []
+        for p, g, m_i, v_i in zip(params, grads, m, v):
+            m_i = tf.where(finite, BETA_1 * m_i + (1 - BETA_1) * g, m_i)
+            v_i = tf.where(finite, BETA_2 * v_i + (1 - BETA_2) * tf.square(g), v_i)
+            update = learning_rate * (m_i / (1 - BETA_1 ** t)) / (tf.sqrt(v_i / (1 - BETA_2 ** t)) + EPSILON)
+            new_params.append(tf.where(finite, p - update, p))
+            new_m.append(m_i)
+            new_v.append(v_i)
+        return i + 1, new_params, new_m, new_v, seed, losses.write(i, loss)
+
+    zeros = [tf.zeros_like(p) for p in params]
+    _, params, _, _, _, losses = tf.while_loop(
+        lambda i, *args: i < num_steps,
+        step,
+        (tf.constant(0), params, zeros, zeros, seed, tf.TensorArray(dtype, size=num_steps)),
+    )
+    return params, losses.stack()
+
+
+class CompiledADVI():
+    """The ADVI optimization traced and XLA-compiled once for a model, a data signature and settings.
+
+    The data arrays, the starting point and the seed are inputs of the compiled function, so fitting
+    again, to new data of the same shapes and dtypes, reuses it.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    static : dict
+        Integer data traced as constants, see `sampling.split_data`.
+    arrays : dict
+        Example data arrays defining the input signature, see `sampling.split_data`.
+    family, num_steps, learning_rate, sample_size, precision
+        Settings of the fit, see `fit`.
+    """
+
+    def __init__(self, model_constructor, static, arrays, family, num_steps, learning_rate, sample_size, precision):
+        self.model_constructor = model_constructor
+        self.static = dict(static)
+        self.family = family
+        self.num_steps = num_steps
+        self.learning_rate = learning_rate
+        self.sample_size = sample_size
+        self.precision = precision
+        self.event_shapes = sampling.event_shapes(model_constructor(**static, **arrays))
+        dim = sum(int(np.prod(shape)) for shape in self.event_shapes)
+        dtype = tf.as_dtype(precision)
+        self.trace_count = 0
+        self._function = tf.function(
+            self._optimize,
+            input_signature=[
+                {
+                    name: tf.TensorSpec(value.shape, tf.as_dtype(value.dtype), name=name)
+                    for name, value in arrays.items()
+                },
+                [tf.TensorSpec([dim], dtype), tf.TensorSpec([dim] if family == "meanfield" else [dim, dim], dtype)],
+                tf.TensorSpec([2], tf.int32),
+            ],
+            experimental_compile=True,
+        )
+
+    def _optimize(self, arrays, params, seed):
+        # only executed while tracing
+        self.trace_count += 1
+        model = self.model_constructor(**self.static, **arrays)
+        target = sampling.target_log_prob_fn(model, self.event_shapes)
+        return _optimize(
+            target, self.family, params, self.num_steps, self.learning_rate, self.sample_size, seed
+        )
+
+    def run(self, data_dict, loc, raw, seed):
+        """Maximize the ELBO from the parameters (`loc`, `raw`), returning them and the ELBO of every step."""
+        arrays = sampling._check_static(self.static, data_dict, self.precision)
+        (loc, raw), losses = self._function(arrays, [loc, raw], seed)
+        return loc, raw, -np.asarray(losses)
+
+
+def compiled_advi(
+    model_constructor, data_dict, family="meanfield", num_steps=5000, learning_rate=1e-2, sample_size=1,
+    precision="float64",
+):
+    """Return the `CompiledADVI` for a model, data signature and settings.
+
+    They are cached together with the compiled samplers, see `sampling.sampler_cache_info`.
+
+    Returns
+    -------
+    CompiledADVI
+        The compiled optimization; its `trace_count` counts traces (and XLA compilations).
+    """
+    if family not in FAMILIES:
+        raise ValueError("Unknown family {}, expected one of {}".format(family, list(FAMILIES)))
+    static, arrays = sampling.split_data(data_dict, precision)
+    key = (
+        CompiledADVI,
+        model_constructor,
+        tuple(sorted(static.items())),
+        tuple((name, a.shape, a.dtype.str) for name, a in sorted(arrays.items())),
+        family,
+        num_steps,
+        learning_rate,
+        sample_size,
+        precision,
+    )
+    return sampling._cached_sampler(key, lambda: CompiledADVI(
+        model_constructor, static, arrays, family, num_steps, learning_rate, sample_size, precision
+    ))
+
+
+def fit(
+    model_constructor, data_dict, family="meanfield", num_steps=5000, learning_rate=1e-2, sample_size=1, seed=None,
+    precision="float64",
+):
+    """Fit a Gaussian approximation of the posterior of a model, see `Stan2tfp.fit_vi`.
+
+    The mean starts at a random point, drawn as the initial state of a chain, and the
+    covariance at the identity.
+
+    Parameters
+    ----------
+    model_constructor
+        The model class emitted by the compiler.
+    data_dict : dict
+        Data for the model.
+    family : string, optional
+        One of `FAMILIES`, 'meanfield' by default.
+    num_steps : int, optional
+        Number of optimization steps, 5000 by default.
+    learning_rate : float, optional
+        Learning rate of Adam, 1e-2 by default.
+    sample_size : int, optional
+        Number of draws estimating the gradient of the ELBO at every step, 1 by default.
+    seed : int, optional
+        Seed of the fit. Random by default.
+    precision : string, optional
+        Floating point precision of the model, 'float64' by default.
+
+    Returns
+    -------
+    VIFit
+        The approximation.
+    """
+    advi = compiled_advi(model_constructor, data_dict, family, num_steps, learning_rate, sample_size, precision)
+    static, arrays = sampling.split_data(data_dict, precision)
+    model = model_constructor(**static, **arrays)
+    dtype = tf.as_dtype(precision)
+    init_seed, fit_seed = tfp.random.split_seed(sampling.make_seed(seed))
+    loc = tf.concat(
+        [tf.reshape(s, [-1]) for s in sampling._initial_states(model, 1, init_seed, dtype)], 0
+    )
+    dim = int(loc.shape[0])
+    raw = tf.zeros([dim] if family == "meanfield" else [dim, dim], dtype)
+    loc, raw, elbo = advi.run(data_dict, loc, raw, fit_seed)
+    return VIFit(model, family, np.asarray(loc), np.asarray(_scale_tril(family, raw)), elbo)
+
+
+class VIFit():
+    """A Gaussian approximation of the posterior in the unconstrained space.
+
+    Attributes
+    ----------
+    family : string
+        One of `FAMILIES`.
+    loc : ndarray
+        Mean of the approximation, shape (dim,), over all parameters flattened in order.
+    scale_tril : ndarray
+        Cholesky factor of its covariance, shape (dim, dim); diagonal for 'meanfield'.
+    elbo : ndarray
+        Estimate of the ELBO at every optimization step, to check convergence.
+    """
+
+    def __init__(self, model, family, loc, scale_tril, elbo):
+        self.model = model
+        self.family = family
+        self.loc = loc
+        self.scale_tril = scale_tril
+        self.elbo = elbo
+        self._event_shapes = sampling.event_shapes(model)
+
+    def covariance(self):
+        """Covariance of the approximation in the unconstrained space, shape (dim, dim)."""
+        return self.scale_tril @ self.scale_tril.T
+
+    def sample(self, num_draws=1000, nchain=4, seed=None):
+        """Draws of the approximation, shaped as the trace returned by `Stan2tfp.sample`.
+
+        Parameters
+        ----------
+        num_draws : int, optional
+            Number of draws per chain, 1000 by default.
+        nchain : int, optional
+            Number of chains, 4 by default; the draws are independent, the chains only shape the trace.
+        seed : int, optional
+            Seed of the draws. Random by default.
+
+        Returns
+        -------
+        list of ndarray
+            Draws of every parameter in the constrained space, shape (num_draws, nchain, ...).
+        """
+        surrogate = tfd.MultivariateNormalTriL(self.loc, scale_tril=self.scale_tril)
+        z = surrogate.sample(num_draws * nchain, seed=sampling.make_seed(seed))
+        bijectors = self.model.parameter_bijectors()
+        return [
+            np.reshape(np.asarray(b.forward(x)), (num_draws, nchain) + shape)
+            for b, x, shape in zip(bijectors, sampling.unflatten(z, self._event_shapes), self._event_shapes)
+        ]
+
+    def sampler_state(self, nchain=4, metric=None, seed=None):
+        """A state to start NUTS from, with every chain at an independent draw of the approximation.
+
+        Parameters
+        ----------
+        nchain : int, optional
+            Number of chains, 4 by default.
+        metric : string, optional
+            The metric that `Stan2tfp.sample` will adapt, 'diag' or 'dense'. If given, the inverse metric starts
+            at the variances (or covariances within every parameter) of the approximation. None by default.
+        seed : int, optional
+            Seed of the draws. Random by default.
+
+        Returns
+        -------
+        sampling.SamplerState
+            Positions and inverse metric; the step size starts at its default.
+        """
+        position = [x[0] for x in self.sample(1, nchain, seed)]
+        inverse_metric = None
+        if metric is not None:
+            sampling._check_metric(metric)
+            covariance = self.covariance()
+            inverse_metric, start = [], 0
+            for shape in self._event_shapes:
+                size = int(np.prod(shape))
+                block = covariance[start:start + size, start:start + size]
+                start += size
+                if sampling._is_dense((nchain,) + shape, metric):
+                    part = np.broadcast_to(block, (nchain, size, size))
+                else:
+                    part = np.broadcast_to(np.reshape(np.diag(block), shape), (nchain,) + shape)
+                inverse_metric.append(np.array(part))
+        return sampling.SamplerState(position, None, inverse_metric)
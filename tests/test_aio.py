@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.aio`."""
+
+
+import asyncio
+import os
+import unittest
+
+from stan2tfp import aio
+from stan2tfp.compiler import StanCompilerError
+from stan2tfp.instrumentation import Instrumentation
+
+STAN_FILE = os.path.join(os.path.dirname(__file__), "eight_schools_ncp.stan")
+DATA = dict(J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18])
+
+
+class TestAio(unittest.TestCase):
+    """Tests for the asyncio API."""
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_create_model_and_sample_concurrently(self):
+        executor = aio.SamplingExecutor(max_concurrency=2)
+        self.addCleanup(executor.shutdown)
+
+        async def fit():
+            model = await aio.create_model(STAN_FILE, data_dict=DATA, compiler_cache=False, executor=executor)
+            return await asyncio.gather(*[
+                model.sample_async(executor, num_main_iters=100, num_warmup_iters=100, stats=(), seed=seed)
+                for seed in range(3)
+            ])
+
+        fits = self.loop.run_until_complete(fit())
+        self.assertEqual(len(fits), 3)
+        for mcmc_trace, _ in fits:
+            self.assertEqual(mcmc_trace[2].shape, (100, 4, 8))
+
+    def test_create_instrumented_model(self):
+        instrumentation = Instrumentation()
+        model = self.loop.run_until_complete(aio.create_model(
+            STAN_FILE, data_dict=DATA, compiler_cache=False, instrumentation=instrumentation
+        ))
+        self.assertIs(model.instrumentation, instrumentation)
+        for name in ("compile", "load", "init_model"):
+            self.assertIn(name, instrumentation.stats.phases)
+
+    def test_compile_error(self):
+        with self.assertRaises(StanCompilerError):
+            self.loop.run_until_complete(aio.compile_model("model { x ~ normal(0, 1); }"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.cache`."""
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from stan2tfp.cache import CompilerCache, DiskCache, FitCache
+
+
+class TestDiskCache(unittest.TestCase):
+    """Tests for the on-disk caches."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def test_roundtrip_and_clear(self):
+        cache = DiskCache(self.tmp.name)
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", b"model code")
+        self.assertEqual(cache.get("a"), b"model code")
+        cache.clear()
+        self.assertIsNone(cache.get("a"))
+
+    def test_evicts_least_recently_used(self):
+        cache = DiskCache(self.tmp.name, max_size=10)
+        cache.put("a", b"12345")
+        os.utime(cache.path("a"), (0, 0))
+        cache.put("b", b"12345")
+        os.utime(cache.path("b"), (1, 1))
+        cache.get("a")
+        cache.put("c", b"12345")
+        self.assertIsNotNone(cache.get("a"))
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("c"))
+
+    def test_compiler_key(self):
+        compiler = os.path.join(self.tmp.name, "stanc")
+        with open(compiler, "wb") as f:
+            f.write(b"v1")
+        cache = CompilerCache(self.tmp.name)
+        key = cache.key("model {}", compiler)
+        self.assertEqual(key, cache.key("model {}", compiler))
+        self.assertNotEqual(key, cache.key("model { }", compiler))
+        with open(compiler, "wb") as f:
+            f.write(b"v2 binary")
+        self.assertNotEqual(key, cache.key("model {}", compiler))
+
+    def test_fit_roundtrip(self):
+        cache = FitCache(self.tmp.name)
+        data = dict(J=2, y=np.array([1.0, 2.0]))
+        key = cache.key("model {}", b"code", data, dict(seed=1))
+        self.assertNotEqual(key, cache.key("model {}", b"code", dict(J=2, y=[1.0, 2.5]), dict(seed=1)))
+        self.assertNotEqual(key, cache.key("model {}", b"code", data, dict(seed=2)))
+        self.assertIsNone(cache.load_fit(key))
+
+        mu = np.arange(8.0).reshape(4, 2)
+        cache.store_fit(key, [mu], dict(diverging=np.zeros((4, 2), bool)))
+        mcmc_trace, stats = cache.load_fit(key)
+        np.testing.assert_array_equal(mcmc_trace[0], mu)
+        self.assertEqual(list(stats), ["diverging"])
+        means, sds = cache.load_summary(key)
+        self.assertEqual(float(means[0]), 3.5)
+
+
+if __name__ == "__main__":
+    unittest.main()
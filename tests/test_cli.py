@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.cli`."""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from click.testing import CliRunner
+
+from stan2tfp import cli
+
+STAN_FILE = os.path.join(os.path.dirname(__file__), "eight_schools_ncp.stan")
+
+
+class TestCli(unittest.TestCase):
+    """Tests for the compiler command line."""
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.runner = CliRunner()
+        # keep compiled models out of the user's cache
+        environ = mock.patch.dict(os.environ, STAN2TFP_CACHE_DIR=self.tmp.name)
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def test_compiles_and_skips_up_to_date_modules(self):
+        args = [STAN_FILE, "--output-dir", self.tmp.name, "--no-cache"]
+        result = self.runner.invoke(cli.main, args)
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("compiled", result.output)
+        output = os.path.join(self.tmp.name, "eight_schools_ncp.py")
+        with open(output) as f:
+            self.assertTrue(f.readline().startswith("# stan2tfp source hash:"))
+            self.assertIn("class model", f.read())
+
+        result = self.runner.invoke(cli.main, args)
+        self.assertIn("up to date", result.output)
+        result = self.runner.invoke(cli.main, args + ["--force"])
+        self.assertIn("compiled", result.output)
+
+    def test_compiles_several_files_in_parallel(self):
+        stan_files = []
+        for name in ["a", "b", "c"]:
+            stan_files.append(os.path.join(self.tmp.name, name + ".stan"))
+            shutil.copy(STAN_FILE, stan_files[-1])
+        result = self.runner.invoke(cli.main, stan_files + ["--jobs", "3", "--no-cache"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        for name in ["a", "b", "c"]:
+            self.assertTrue(os.path.exists(os.path.join(self.tmp.name, name + ".py")))
+
+    def test_rejects_colliding_outputs(self):
+        other = os.path.join(self.tmp.name, "eight_schools_ncp.stan")
+        shutil.copy(STAN_FILE, other)
+        result = self.runner.invoke(cli.main, [STAN_FILE, other, "--output-dir", self.tmp.name, "--no-cache"])
+        self.assertNotEqual(result.exit_code, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
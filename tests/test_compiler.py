@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.compiler`."""
+
+
+import os
+import unittest
+
+from stan2tfp.compiler import CompilerPool, StanCompilerError
+
+STAN_FILE = os.path.join(os.path.dirname(__file__), "eight_schools_ncp.stan")
+
+
+class TestCompiler(unittest.TestCase):
+    """Tests for compiling Stan models."""
+
+    def test_error_location(self):
+        error = StanCompilerError(
+            "model.stan", 1, "Semantic error in 'model.stan', line 3, column 4 to column 9:\n...\n"
+        )
+        self.assertEqual((error.line, error.column), (3, 4))
+        self.assertIn("model.stan", str(error))
+        self.assertEqual(StanCompilerError("model.stan", 1, "").line, None)
+
+    def test_pool_compiles_concurrently(self):
+        with open(STAN_FILE) as f:
+            stan_model_code = f.read()
+        with CompilerPool(max_workers=2) as pool:
+            first, second = pool.submit(stan_model_code), pool.submit(stan_model_code)
+            broken = pool.submit("parameters { real mu; } model { mu ~ normal(0, ; }")
+            self.assertIn(b"class model", first.result())
+            self.assertEqual(first.result(), second.result())
+            with self.assertRaises(StanCompilerError) as cm:
+                broken.result()
+            self.assertNotEqual(cm.exception.returncode, 0)
+            self.assertEqual(cm.exception.line, 1)
+            results = pool.compile_files([STAN_FILE, STAN_FILE])
+        self.assertEqual(results[0], results[1])
+
+
+if __name__ == "__main__":
+    unittest.main()
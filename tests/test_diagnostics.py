@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.diagnostics`."""
+
+
+import unittest
+
+import numpy as np
+
+from stan2tfp.diagnostics import OnlineDiagnostics, RunningMoments, element_names, summary
+
+
+class TestSummary(unittest.TestCase):
+    """Tests for the posterior summary."""
+
+    def test_independent_draws(self):
+        rng = np.random.RandomState(0)
+        mu = rng.normal(size=(1000, 4))
+        theta = 3 + 2 * rng.normal(size=(1000, 4, 2, 3))
+        table = summary([mu, theta], ["mu", "theta"])
+
+        self.assertEqual(table.names[:3], ["mu", "theta[0,0]", "theta[0,1]"])
+        self.assertEqual(len(table), 7)
+        self.assertEqual(list(table.columns), ["mean", "sd", "5%", "50%", "95%", "r_hat", "ess_bulk", "ess_tail"])
+        np.testing.assert_allclose(table["mean"][1:], 3, atol=0.2)
+        np.testing.assert_allclose(table["sd"][1:], 2, atol=0.2)
+        np.testing.assert_allclose(table["50%"], np.median(np.c_[mu.reshape(-1), theta.reshape(4000, 6)], 0))
+        np.testing.assert_allclose(table["r_hat"], 1, atol=0.01)
+        self.assertTrue(np.all(table["ess_bulk"] > 2000))
+        self.assertTrue(np.all(table["ess_tail"] > 1000))
+        self.assertIn("theta[1,2]", str(table))
+
+    def test_unmixed_chains(self):
+        rng = np.random.RandomState(0)
+        draws = rng.normal(size=(500, 4)) + np.arange(4) * 3
+        row = summary([draws], ["x"]).row("x")
+        self.assertGreater(row["r_hat"], 1.5)
+        self.assertLess(row["ess_bulk"], 100)
+
+    def test_element_names(self):
+        self.assertEqual(element_names("mu", ()), ["mu"])
+        self.assertEqual(element_names("theta", (2,)), ["theta[0]", "theta[1]"])
+
+
+class TestOnlineDiagnostics(unittest.TestCase):
+    """Tests for the running diagnostics."""
+
+    def test_running_moments_match_batch(self):
+        x = np.random.RandomState(0).normal(size=(250, 3))
+        moments = RunningMoments()
+        for chunk in np.array_split(x, 7):
+            moments.update(chunk)
+        self.assertEqual(moments.count, 250)
+        np.testing.assert_allclose(moments.mean, x.mean(0))
+        np.testing.assert_allclose(moments.variance(), x.var(0, ddof=1))
+
+    def test_converges_on_independent_draws(self):
+        rng = np.random.RandomState(0)
+        monitor = OnlineDiagnostics()
+        for _ in range(10):
+            monitor.update([rng.normal(size=(100, 4)), rng.normal(size=(100, 4, 2))])
+        self.assertEqual(monitor.num_draws, 1000)
+        np.testing.assert_allclose(monitor.r_hat(), 1, atol=0.01)
+        self.assertTrue(np.all(monitor.ess() > 2000))
+        self.assertTrue(monitor.converged())
+
+    def test_unmixed_chains_do_not_converge(self):
+        rng = np.random.RandomState(0)
+        monitor = OnlineDiagnostics()
+        for _ in range(10):
+            monitor.update([rng.normal(size=(100, 4)) + np.arange(4)])
+        self.assertGreater(monitor.r_hat()[0], 1.1)
+        self.assertFalse(monitor.converged())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the startup cost of `import stan2tfp`."""
+
+
+import json
+import subprocess
+import sys
+import unittest
+
+# modules that must only be imported once a model is executed or sampled
+HEAVY_MODULES = ["tensorflow", "tensorflow_probability", "pkg_resources"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import stan2tfp
+from stan2tfp import cache, compiler, storage
+elapsed = time.perf_counter() - start
+print(json.dumps(dict(elapsed=elapsed, modules=sorted(m for m in {} if m in sys.modules))))
+""".format(HEAVY_MODULES)
+
+
+class TestImport(unittest.TestCase):
+    """Tests that importing the package stays cheap."""
+
+    def test_import_does_not_load_tensorflow(self):
+        # a fresh interpreter, as the test runner may have imported tensorflow already
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT], stdout=subprocess.PIPE, check=True
+        ).stdout
+        result = json.loads(out.decode("UTF-8").splitlines()[-1])
+        self.assertEqual(result["modules"], [])
+        self.assertLess(result["elapsed"], 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -4,10 +4,16 @@
 """Tests for `stan2tfp` package."""
 
 
+import os
+import tempfile
 import unittest
-from click.testing import CliRunner
 import numpy as np
 from stan2tfp import Stan2tfp
+from stan2tfp.cache import FitCache
+from stan2tfp.export import ExportedModel
+from stan2tfp.instrumentation import Instrumentation
+from stan2tfp.sampling import sampler_cache_info
+from stan2tfp.stan2tfp import load_tfp_code
 import pkg_resources
 
 
@@ -78,6 +84,398 @@ model {
         self.assertAlmostEqual(significant_mean(tau), 3, delta=2)
         self.assertAlmostEqual(significant_mean(theta_tilde), 0.08, delta=0.1)
 
+    def test_load_tfp_code_reuses_modules(self):
+        module = load_tfp_code(b"class model():\n    pass\n")
+        self.assertIs(module, load_tfp_code(b"class model():\n    pass\n"))
+        self.assertIsNot(module, load_tfp_code(b"class model():\n    x = 1\n"))
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+        )
+        other = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+        )
+        self.assertIs(model.model_constructor, other.model_constructor)
+
+    def test_refit_reuses_compiled_sampler(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        model.sample(num_main_iters=10, num_warmup_iters=10)
+        sampler = model.compiled_sampler(num_main_iters=10)
+        model.init_model(dict(
+            J=8, y=[8, 28, 3, -7, 1, -1, 12, 18], sigma=[10, 15, 11, 16, 11, 9, 18, 10]
+        ))
+        mcmc_trace, _ = model.sample(num_main_iters=10, num_warmup_iters=20)
+        self.assertIs(model.compiled_sampler(num_main_iters=10), sampler)
+        self.assertEqual(sampler.trace_count, 1)
+        self.assertEqual(sampler.call_count, 2)
+        self.assertEqual(mcmc_trace[2].shape, (10, 4, 8))
+
+    def test_sample_batch(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            )
+        )
+        data_dicts = [
+            dict(J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]),
+            dict(J=8, y=[128, 108, 97, 107, 99, 101, 118, 112], sigma=[15, 10, 16, 11, 9, 11, 10, 18]),
+        ]
+        mcmc_trace, _ = model.sample_batch(data_dicts)
+        mu = mcmc_trace[0]
+        self.assertEqual(mu.shape, (1000, 2, 4))
+        self.assertAlmostEqual(significant_mean(model.merge_chains(mu[:, 0])), 4, delta=2)
+        self.assertGreater(np.mean(mu[:, 1]), 10)
+
+    def test_sample_chunks(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        chunks = list(model.sample_chunks(chunk_size=300))
+        self.assertEqual([c[0][0].shape[0] for c in chunks], [300, 300, 300, 100])
+        mu = np.concatenate([model.merge_chains(c[0][0]) for c in chunks])
+        self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+
+    def test_sample_selected_trace(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        mcmc_trace, stats = model.sample(
+            keep=[model.parameter_names()[1]], stats=["diverging", "tree_depth"], thin=2
+        )
+        self.assertEqual(len(mcmc_trace), 1)
+        self.assertEqual(mcmc_trace[0].shape, (500, 4))
+        self.assertEqual(sorted(stats), ["diverging", "tree_depth"])
+        self.assertEqual(stats["tree_depth"].shape, (500, 4))
+        self.assertAlmostEqual(significant_mean(model.merge_chains(mcmc_trace[0])), 3, delta=2)
+
+    def test_sample_in_processes(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        mcmc_trace, _ = model.sample(processes=2, stats=["diverging"])
+        mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+
+        self.assertEqual(theta_tilde.shape, (4000, 8))
+        self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+        self.assertAlmostEqual(significant_mean(tau), 3, delta=2)
+
+        # chains are seeded one by one, whatever the groups
+        two, _ = model.sample(num_main_iters=100, num_warmup_iters=100, processes=2, stats=(), seed=7)
+        four, _ = model.sample(num_main_iters=100, num_warmup_iters=100, processes=4, stats=(), seed=7)
+        for a, b in zip(two, four):
+            np.testing.assert_array_equal(a, b)
+
+    def test_seeded_sampling_is_reproducible(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        first, _ = model.sample(num_main_iters=100, num_warmup_iters=100, stats=(), seed=42)
+        second, _ = model.sample(num_main_iters=100, num_warmup_iters=100, stats=(), seed=42)
+        other, _ = model.sample(num_main_iters=100, num_warmup_iters=100, stats=(), seed=43)
+        for a, b in zip(first, second):
+            np.testing.assert_array_equal(a, b)
+        self.assertFalse(np.array_equal(first[0], other[0]))
+
+    def test_fit_cache_returns_numpy(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = FitCache(cache_dir)
+            fits = [
+                model.sample(num_main_iters=100, num_warmup_iters=100, seed=5, fit_cache=cache) for _ in range(2)
+            ]
+            for mcmc_trace, stats in fits:
+                self.assertTrue(all(isinstance(x, np.ndarray) for x in mcmc_trace))
+                self.assertTrue(all(isinstance(x, np.ndarray) for x in stats.values()))
+                self.assertIsNone(model.sampler_state)
+            for a, b in zip(fits[0][0], fits[1][0]):
+                np.testing.assert_array_equal(a, b)
+
+    def test_warm_start(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        model.sample(num_main_iters=100, stats=())
+        state = model.sampler_state
+        self.assertEqual(state.position[2].shape, (4, 8))
+
+        mcmc_trace, stats = model.sample(num_warmup_iters=0, stats=["step_size"], init=state)
+        mean_step_size = np.concatenate([np.reshape(s, (4, -1)) for s in state.step_size], axis=1).mean(axis=1)
+        np.testing.assert_allclose(stats["step_size"][0], mean_step_size)
+        mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+        self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+        self.assertAlmostEqual(significant_mean(tau), 3, delta=2)
+
+    def test_metric_adaptation(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        for metric, theta_metric_shape in [("diag", (4, 8)), ("dense", (4, 8, 8))]:
+            mcmc_trace, _ = model.sample(stats=(), seed=1, metric=metric)
+            inverse_metric = model.sampler_state.inverse_metric
+            self.assertEqual(inverse_metric[0].shape, (4,))
+            self.assertEqual(inverse_metric[2].shape, theta_metric_shape)
+            self.assertTrue(np.all(np.asarray(inverse_metric[0]) > 0))
+            mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+            self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+            self.assertAlmostEqual(significant_mean(tau), 3, delta=2)
+
+        # continuing a metric fit needs its metric, and the same number of chains
+        state = model.sampler_state
+        with self.assertRaises(ValueError):
+            model.sample(num_warmup_iters=0, init=state)
+        with self.assertRaises(ValueError):
+            model.sample(nchain=2, num_warmup_iters=0, init=state, metric="dense")
+        model.sample(num_main_iters=100, num_warmup_iters=0, stats=(), init=state, metric="dense")
+
+    def test_sample_until_converged(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        mcmc_trace, monitor = model.sample_until(min_ess=100, max_iters=2000, seed=3)
+        self.assertTrue(monitor.converged(1.01, 100))
+        self.assertLess(mcmc_trace[0].shape[0], 2000)
+        self.assertEqual(mcmc_trace[0].shape[0], monitor.num_draws)
+
+    def test_export_and_load(self):
+        data_dict = dict(
+            J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+        )
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=data_dict
+        )
+        with tempfile.TemporaryDirectory() as tmp:
+            model.export(tmp, num_main_iters=100)
+            exported = ExportedModel(tmp)
+            self.assertEqual(exported.parameter_names(), model.parameter_names())
+            self.assertEqual(exported.get_tfp_code(), model.get_tfp_code())
+
+            mcmc_trace, stats = exported.sample(data_dict, num_warmup_iters=100, seed=1)
+            expected, _ = model.sample(num_main_iters=100, num_warmup_iters=100, seed=1)
+            for a, b in zip(mcmc_trace, expected):
+                np.testing.assert_allclose(a, b)
+            self.assertIn("diverging", stats)
+            self.assertEqual(exported.sampler_state.position[2].shape, (4, 8))
+
+            params = [np.asarray(x[-1]) for x in mcmc_trace]
+            np.testing.assert_allclose(
+                exported.log_prob(params, data_dict), model.model.log_prob(params)
+            )
+
+    def test_float32_precision(self):
+        data_dict = dict(
+            J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+        )
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=data_dict,
+            precision="float32",
+        )
+        self.assertNotIn(b"float64", model._precision_tfp_code())
+        mcmc_trace, _ = model.sample(stats=(), seed=1)
+        self.assertEqual(mcmc_trace[0].dtype.name, "float32")
+        self.assertEqual(model.sampler_state.step_size[0].dtype.name, "float32")
+        mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+        self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+        self.assertAlmostEqual(significant_mean(tau), 3, delta=2)
+
+        check = model.check_precision(mcmc_trace, seed=1)
+        self.assertTrue(check.safe)
+        self.assertLess(check.log_prob_error, 1e-4)
+        with self.assertRaises(ValueError):
+            Stan2tfp.from_tfp_code(model.tfp_code, precision="float16")
+
+    def test_instrumentation(self):
+        chunks = []
+        with tempfile.TemporaryDirectory() as tmp:
+            instrumentation = Instrumentation(
+                chunk_size=50, on_chunk=lambda start, stats: chunks.append(start), profile_dir=tmp,
+                profile_iters=(50, 100),
+            )
+            model = Stan2tfp(stan_file_path=
+                pkg_resources.resource_filename(
+                    __name__, "../tests/eight_schools_ncp.stan"
+                ),
+                data_dict=dict(
+                    J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+                ),
+                instrumentation=instrumentation,
+            )
+            mcmc_trace, stats = model.sample(num_main_iters=200, num_warmup_iters=200, stats=("step_size",), seed=1)
+            self.assertTrue(os.listdir(tmp))
+        self.assertEqual(list(stats), ["step_size"])
+        self.assertEqual(mcmc_trace[0].shape, (200, 4))
+        self.assertEqual(chunks, [0, 50, 100, 150])
+        fit_stats = instrumentation.stats
+        for name in ("compile", "load", "init_model", "trace", "xla_compile", "warmup", "sampling"):
+            self.assertIn(name, fit_stats.phases)
+        self.assertEqual(fit_stats.retraces, 2)
+        self.assertEqual(fit_stats.leapfrogs.shape, (200, 4))
+        self.assertTrue(np.all(fit_stats.tree_depth >= 1))
+        self.assertEqual(model.sampler_state.position[2].shape, (4, 8))
+
+        model.sample(num_main_iters=200, num_warmup_iters=200, stats=("step_size",), seed=2)
+        self.assertEqual(instrumentation.stats.retraces, 2)
+
+    def test_instrumentation_keeps_draws(self):
+        data_dict = dict(J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18])
+        stan_file_path = pkg_resources.resource_filename(__name__, "../tests/eight_schools_ncp.stan")
+        instrumentation = Instrumentation()
+        instrumented = Stan2tfp(stan_file_path=stan_file_path, data_dict=data_dict, instrumentation=instrumentation)
+        model = Stan2tfp(stan_file_path=stan_file_path, data_dict=data_dict)
+        kwargs = dict(num_main_iters=100, num_warmup_iters=100, stats=("step_size",), seed=3)
+        first, _ = instrumented.sample(**kwargs)
+        for a, b in zip(first, model.sample(**kwargs)[0]):
+            np.testing.assert_array_equal(a, b)
+        for name in ("trace", "xla_compile", "sampling"):
+            self.assertIn(name, instrumentation.stats.phases)
+        self.assertEqual(instrumentation.stats.leapfrogs.shape, (100, 4))
+
+        # and supports init, chunked or not
+        instrumented.sample(init=instrumented.sampler_state, **dict(kwargs, num_warmup_iters=0))
+        instrumented.sample(init="map", **kwargs)
+        instrumentation.on_chunk = lambda start, stats: None
+        mcmc_trace, _ = instrumented.sample(init=instrumented.sampler_state, **dict(kwargs, num_warmup_iters=0))
+        self.assertEqual(mcmc_trace[0].shape, (100, 4))
+
+    def test_fit_vi(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        for family in ["meanfield", "fullrank"]:
+            mcmc_trace, fit = model.fit_vi(family, seed=1)
+            self.assertEqual([x.shape for x in mcmc_trace], [(1000, 4), (1000, 4), (1000, 4, 8)])
+            mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+            self.assertAlmostEqual(significant_mean(mu), 4, delta=2)
+            self.assertTrue(np.all(tau > 0))
+            self.assertGreater(fit.elbo[-100:].mean(), fit.elbo[:100].mean())
+
+        # refitting reuses the compiled optimization
+        traces = sampler_cache_info().traces
+        model.fit_vi("fullrank", seed=2)
+        self.assertEqual(sampler_cache_info().traces, traces)
+
+        init = fit.sampler_state(metric="dense", seed=2)
+        self.assertEqual(init.inverse_metric[2].shape, (4, 8, 8))
+        mcmc_trace, _ = model.sample(stats=(), seed=3, init=init, metric="dense", num_warmup_iters=300)
+        self.assertAlmostEqual(significant_mean(model.merge_chains(mcmc_trace[0])), 4, delta=2)
+        with self.assertRaises(ValueError):
+            model.fit_vi("lowrank")
+
+    def test_optimize_and_map_init(self):
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(
+                J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=[15, 10, 16, 11, 9, 11, 10, 18]
+            )
+        )
+        (mu, tau, theta_tilde), result = model.optimize(seed=1)
+        self.assertEqual(theta_tilde.shape, (8,))
+        self.assertEqual(result.unconstrained.shape, (4, 10))
+        # without the Jacobian the mode is at tau = 0, where mu is the precision-weighted mean of y
+        self.assertAlmostEqual(float(mu), 4.6, delta=0.5)
+        self.assertLess(float(tau), 0.1)
+        traces = sampler_cache_info().traces
+        model.optimize(seed=2)
+        self.assertEqual(sampler_cache_info().traces, traces)
+
+        mcmc_trace, _ = model.sample(stats=(), seed=2, init="map", num_warmup_iters=300)
+        self.assertAlmostEqual(significant_mean(model.merge_chains(mcmc_trace[0])), 4, delta=2)
+        with self.assertRaises(ValueError):
+            model.sample(init="mode")
+
+    def test_generate_quantities(self):
+        import tensorflow_probability as tfp
+
+        sigma = np.array([15, 10, 16, 11, 9, 11, 10, 18], np.float64)
+        model = Stan2tfp(stan_file_path=
+            pkg_resources.resource_filename(
+                __name__, "../tests/eight_schools_ncp.stan"
+            ),
+            data_dict=dict(J=8, y=[28, 8, -3, 7, -1, 1, 18, 12], sigma=sigma)
+        )
+        mcmc_trace, _ = model.sample(num_main_iters=500, stats=(), seed=1)
+
+        def quantities(model, params, seed):
+            theta = params["mu"] + params["tau"] * params["theta_tilde"]
+            return {"theta": theta, "y_rep": tfp.distributions.Normal(theta, sigma).sample(seed=seed)}
+
+        generated = model.generate_quantities(mcmc_trace, quantities, chunk_size=300, seed=2)
+        mu, tau, theta_tilde = [model.merge_chains(x) for x in mcmc_trace]
+        self.assertEqual(generated["y_rep"].shape, (2000, 8))
+        np.testing.assert_allclose(generated["theta"], mu[:, None] + tau[:, None] * theta_tilde)
+        self.assertAlmostEqual(float(np.std(generated["y_rep"] - generated["theta"], axis=0).mean()), 12.5, delta=1.5)
+        traces = sampler_cache_info().traces
+        repeated = model.generate_quantities(mcmc_trace, quantities, chunk_size=300, seed=2)
+        np.testing.assert_array_equal(repeated["y_rep"], generated["y_rep"])
+        self.assertEqual(sampler_cache_info().traces, traces)
+        empty = model.generate_quantities([x[:0] for x in mcmc_trace], quantities)
+        self.assertEqual(empty["y_rep"].shape, (0, 8))
+        self.assertEqual(empty["theta"].dtype, np.float64)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for `stan2tfp.storage`."""
+
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from stan2tfp.storage import DrawStore
+
+
+class TestDrawStore(unittest.TestCase):
+    """Tests for the memory-mapped draw store."""
+
+    def test_write_chunks_and_reopen(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "draws")
+            store = DrawStore.create(path, ["mu", "theta"], [(), (3,)], nchain=2, num_draws=5)
+            mu = np.arange(10.0).reshape(5, 2)
+            theta = np.arange(30.0).reshape(5, 2, 3)
+            store.write([mu[:3], theta[:3]])
+            store.write([mu[3:], theta[3:]])
+            with self.assertRaises(ValueError):
+                store.write([mu[:1], theta[:1]])
+
+            reopened = DrawStore.open(path)
+            self.assertEqual(len(reopened), 5)
+            self.assertEqual(reopened.shapes["theta"], (3,))
+            np.testing.assert_array_equal(reopened["theta"], theta)
+            np.testing.assert_array_equal(reopened.merged("mu"), mu.reshape(10))
+            with self.assertRaises(ValueError):
+                reopened.write([mu, theta])
+
+
+if __name__ == "__main__":
+    unittest.main()